@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+## Reads the load balancer access logs written by the stack (see MOODLE-ALB-LOG-BUCKET in the
+## stack outputs) and reports which Moodle pages get the most requests, which are slowest and
+## which return server errors, to find the pages that are eating the capacity.
+##
+##   python alb_latency.py s3://bucket/alb/AWSLogs/123456789012/elasticloadbalancing/eu-west-2/2023/05/
+##   python alb_latency.py ./downloaded-logs --top 30
+##
+## Log files are streamed a line at a time, latencies go into fixed size histograms and the
+## number of endpoints is capped, so memory use doesn't grow with the size of the log set.
+## https://docs.aws.amazon.com/elasticloadbalancing/latest/application/load-balancer-access-logs.html
+
+import argparse
+import gzip
+import heapq
+import io
+import math
+import os
+import re
+import sys
+from collections import Counter, defaultdict
+
+## The fields up to the request line, the rest of the line isn't needed
+LOG_LINE = re.compile(
+    r'(?P<type>\S+) (?P<time>\S+) (?P<elb>\S+) (?P<client>\S+) (?P<target>\S+) '
+    r'(?P<request_processing_time>\S+) (?P<target_processing_time>\S+) (?P<response_processing_time>\S+) '
+    r'(?P<elb_status_code>\S+) (?P<target_status_code>\S+) (?P<received_bytes>\S+) (?P<sent_bytes>\S+) '
+    r'"(?P<method>\S+) (?P<url>\S+) (?P<protocol>[^"]*)"')
+
+TIMINGS = ("request_processing_time", "target_processing_time", "response_processing_time")
+
+## Endpoints listed on their own, requests to any others (scanner probes...) are counted as OTHER
+MAX_ENDPOINTS = 1000
+OTHER = "(other)"
+
+
+class LatencyHistogram:
+    """ Latencies in logarithmic buckets, percentiles are within GROWTH (5%) of the real value """
+    SMALLEST = 0.0001       # seconds, anything faster is counted in the first bucket
+    GROWTH = 1.05
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if seconds <= self.SMALLEST:
+            self.buckets[0] += 1
+        else:
+            self.buckets[1 + int(math.log(seconds / self.SMALLEST, self.GROWTH))] += 1
+
+    def percentile(self, percent):
+        """ Upper bound of the bucket holding the percentile, never more than the largest value seen """
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.SMALLEST * self.GROWTH ** bucket, self.max)
+        return self.max
+
+
+def read_local(path):
+    """ Lines from a log file, or from every log file under a directory """
+    if os.path.isdir(path):
+        for directory, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                if name.endswith((".log", ".log.gz")):
+                    yield from read_local(os.path.join(directory, name))
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as log_file:
+        yield from log_file
+
+
+def read_s3(url, client=None):
+    """ Lines from every log file under an s3://bucket/prefix, streamed without downloading them """
+    bucket, _, prefix = url[len("s3://"):].partition("/")
+    if client is None:
+        import boto3
+        client = boto3.client("s3")
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            if not item["Key"].endswith((".log", ".log.gz")):
+                continue
+            body = client.get_object(Bucket=bucket, Key=item["Key"])["Body"]
+            stream = gzip.GzipFile(fileobj=body) if item["Key"].endswith(".gz") else body
+            yield from io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+
+
+def read_lines(sources, client=None):
+    for source in sources:
+        if source.startswith("s3://"):
+            yield from read_s3(source, client)
+        else:
+            yield from read_local(source)
+
+
+def parse_lines(lines):
+    """ Log entries as dicts, lines that aren't ALB access log entries are skipped """
+    for line in lines:
+        match = LOG_LINE.match(line)
+        if match:
+            yield match.groupdict()
+
+
+def endpoint(url):
+    """ The Moodle script a URL runs, e.g. /pluginfile.php/12/mod_resource/... is /pluginfile.php.
+    Other paths are grouped by their first directory, e.g. /theme/image.php... is /theme/* """
+    path = url.split("://", 1)[-1]
+    path = "/" + path.split("/", 1)[1] if "/" in path else "/"
+    path = path.split("?", 1)[0]
+    script_end = path.find(".php")
+    if script_end >= 0:
+        return path[:script_end + len(".php")]
+    directory, slash, _ = path[1:].partition("/")
+    return f"/{directory}/*" if slash else path
+
+
+def seconds(value):
+    """ Processing times are -1 when the request never reached a target or the connection closed """
+    try:
+        value = float(value)
+    except ValueError:
+        return None
+    return value if value >= 0 else None
+
+
+class LatencyReport:
+    """ Request counts and latencies by endpoint, the slowest requests and 5xx responses """
+
+    def __init__(self, top=20):
+        self.top = top
+        self.requests = Counter()
+        self.errors = Counter()
+        self.latency = defaultdict(lambda: {timing: LatencyHistogram() for timing in TIMINGS})
+        self.slowest = []   # heap of the top slowest (seconds, url)
+
+    def add(self, entry):
+        name = endpoint(entry["url"])
+        if name not in self.requests and len(self.requests) >= MAX_ENDPOINTS:
+            name = OTHER
+        self.requests[name] += 1
+        if entry["elb_status_code"].startswith("5"):
+            self.errors[name] += 1
+
+        total = 0.0
+        for timing in TIMINGS:
+            value = seconds(entry[timing])
+            if value is not None:
+                self.latency[name][timing].add(value)
+                total += value
+        slow = (total, entry["method"] + " " + entry["url"].split("?", 1)[0])
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, slow)
+        elif slow > self.slowest[0]:
+            heapq.heappushpop(self.slowest, slow)
+
+    def add_all(self, entries):
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def busiest(self):
+        """ Endpoints by the total target time they used, the capacity they take from the tasks """
+        return sorted(self.requests, key=lambda name: -self.latency[name]["target_processing_time"].total)[:self.top]
+
+    def print(self, out=sys.stdout):
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.0f}"
+
+        total = sum(self.requests.values())
+        print(f"{total} requests to {len(self.requests)} endpoints", file=out)
+        print(file=out)
+        print("Busiest endpoints by total target processing time, latencies in ms", file=out)
+        print(f'{"endpoint":<50} {"requests":>9} {"total s":>9} {"p50":>7} {"p95":>7} {"p99":>7} {"max":>7} '
+            f'{"req p95":>7} {"resp p95":>8}', file=out)
+        for name in self.busiest():
+            target = self.latency[name]["target_processing_time"]
+            print(f'{name[:50]:<50} {self.requests[name]:>9} {target.total:>9.1f} {ms(target.percentile(50)):>7} '
+                f'{ms(target.percentile(95)):>7} {ms(target.percentile(99)):>7} {ms(target.max if target.count else None):>7} '
+                f'{ms(self.latency[name]["request_processing_time"].percentile(95)):>7} '
+                f'{ms(self.latency[name]["response_processing_time"].percentile(95)):>8}', file=out)
+        print(file=out)
+        print("Slowest requests (ms)", file=out)
+        for total_seconds, url in sorted(self.slowest, reverse=True):
+            print(f"{ms(total_seconds):>9}  {url}", file=out)
+        print(file=out)
+        print("5xx hotspots", file=out)
+        if not self.errors:
+            print(" None", file=out)
+        for name, count in self.errors.most_common(self.top):
+            print(f"{count:>9}  {100 * count / self.requests[name]:5.1f}%  {name}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Request counts and latency percentiles by Moodle endpoint from ALB access logs")
+    parser.add_argument("sources", nargs="+", help="log files, directories or s3://bucket/prefix")
+    parser.add_argument("--top", type=int, default=20, help="number of endpoints and requests to list (default 20)")
+    args = parser.parse_args(argv)
+
+    report = LatencyReport(top=args.top).add_all(parse_lines(read_lines(args.sources)))
+    report.print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import os
+from dataclasses import fields
 
 import aws_cdk as cdk
 
-from moodle_serverless.moodle_serverless_stack import MoodleServerlessStackV2
+from moodle_serverless.moodle_serverless_stack import moodle_stacks
+from moodle_serverless.performance_lint import PerformanceLint
+from moodle_serverless.profiles import MoodleProfile, profile_from_context
 
 
 app = cdk.App()
@@ -14,23 +17,52 @@ props = {
     "hosted_zone_name": app.node.try_get_context("hosted_zone_name")
     }
 
-MoodleServerlessStackV2(app, "MoodleServerlessStackV2",
-    # If you don't specify 'env', this stack will be environment-agnostic.
-    # Account/Region-dependent features and context lookups will not work,
-    # but a single synthesized template can be deployed anywhere.
+## Stacks to synthesize, each with a sizing profile (see moodle_serverless/profiles.py)
+## e.g. cdk.json context "stacks": {"MoodleServerlessStackProd": {"profile": "prod", "domain_name": "..."}}
+## or a single stack with `cdk deploy -c profile=prod MoodleServerlessStackV2`
+## Settings given directly in context, e.g. `-c max_capacity=6`, override the profile of the single stack
+## Each entry is deployed as three stacks, <id>-Network and <id>-Data hold the VPC and Moodle's state,
+## <id> is the app stack, which can be deployed alone with `cdk deploy --exclusively <id>`.
+## With the CDN there is a fourth, <id>-Edge in us-east-1, for CloudFront's certificate
+stacks = app.node.try_get_context("stacks") or {
+    "MoodleServerlessStackV2": {
+        "profile": app.node.try_get_context("profile") or "dev",
+        **{setting.name: app.node.try_get_context(setting.name) for setting in fields(MoodleProfile)
+            if setting.name != "name" and app.node.try_get_context(setting.name) is not None}
+        }
+    }
+
+for stack_id, stack_settings in stacks.items():
+    if isinstance(stack_settings, str):
+        stack_settings = {"profile": stack_settings}
+    # DNS settings can differ per stack, everything else is part of the profile
+    stack_settings = dict(stack_settings)
+    stack_props = {key: stack_settings.pop(key, value) for key, value in props.items()}
+    profile = profile_from_context(stack_settings)
+
+    ## The data stack takes the VPC from the network stack, the app stack takes both
+    site_stacks = moodle_stacks(app, stack_id,
+        # If you don't specify 'env', this stack will be environment-agnostic.
+        # Account/Region-dependent features and context lookups will not work,
+        # but a single synthesized template can be deployed anywhere.
+
+        # Uncomment the next line to specialize this stack for the AWS Account
+        # and Region that are implied by the current CLI configuration.
 
-    # Uncomment the next line to specialize this stack for the AWS Account
-    # and Region that are implied by the current CLI configuration.
+        #env=cdk.Environment(account=os.getenv('CDK_DEFAULT_ACCOUNT'), region=os.getenv('CDK_DEFAULT_REGION')),
 
-    #env=cdk.Environment(account=os.getenv('CDK_DEFAULT_ACCOUNT'), region=os.getenv('CDK_DEFAULT_REGION')),
+        # Uncomment the next line if you know exactly what Account and Region you
+        # want to deploy the stack to. */
 
-    # Uncomment the next line if you know exactly what Account and Region you
-    # want to deploy the stack to. */
+        env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=stack_props,
+        profile=profile
 
-    env=cdk.Environment(account='131458236732', region='eu-west-2'),
-    props=props
+        # For more information, see https://docs.aws.amazon.com/cdk/latest/guide/environments.html
+        )
 
-    # For more information, see https://docs.aws.amazon.com/cdk/latest/guide/environments.html
-    )
+    ## Performance anti-patterns are reported at synth, as errors for the checks in the profile's lint_errors
+    for stack in filter(None, site_stacks):     # no edge stack without the CDN
+        cdk.Aspects.of(stack).add(PerformanceLint(profile))
 
 app.synth()
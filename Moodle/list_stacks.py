@@ -4,57 +4,189 @@
 ## see their status and retrieve their outputs without having to go to the 
 ## AWS Managament Console.
 ## Tim Wornell
+##
+## More regions and accounts (AWS CLI profiles) can be listed together, e.g.
+##   python3 list_stacks.py --regions eu-west-2,us-east-1 --profiles lms-stag,lms-prod
+## and --json prints the stacks without asking for input, for scripts.
+
+import argparse
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.exceptions import ClientError
 
+def parse_arn(arn):
+    """ arn:partition:service:region:account:resource as a dict """
+    parts = arn.split(':', 5)
+    if len(parts) != 6 or parts[0] != 'arn':
+        raise ValueError(f'Not an ARN: {arn}')
+    return dict(zip(('arn', 'partition', 'service', 'region', 'account', 'resource'), parts))
+
+## Secrets Manager clients by session (AWS CLI profile) and region, made once and shared by the threads
+## that fetch secrets. A stack's secrets are read with the session it was listed with, see stack_session
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+## The session each CloudFormation client was made from, and each listed stack was found with, by StackId
+_client_sessions = {}
+_stack_sessions = {}
+
+## Secret values already fetched, by ARN, kept for SECRET_CACHE_SECONDS
+SECRET_CACHE_SECONDS = 300
+_secret_cache = {}
+
+## BatchGetSecretValue takes up to 20 secrets at a time
+SECRET_BATCH_SIZE = 20
+
+def secrets_client(region, session=None):
+    """ Secrets Manager client for the session, the default credentials when there is none """
+    global _session
+    with _clients_lock:
+        if (session, region) not in _clients:
+            if session is None:
+                _session = _session or boto3.session.Session()
+            _clients[session, region] = (session or _session).client('secretsmanager', region_name=region)
+        return _clients[session, region]
+
+def stack_session(stack):
+    """ The session (AWS CLI profile) a stack was listed with, None for the default credentials """
+    return _stack_sessions.get(stack['StackId'])
+
+def secret_name(arn):
+    """ The secret name from its ARN, without the 6 character suffix Secrets Manager adds """
+    resource = parse_arn(arn)['resource']
+    return re.sub(r'-[A-Za-z0-9]{6}$', '', resource[len('secret:'):])
+
+def secret_arns(stack):
+    """ Stack outputs that are Secrets Manager secret ARNs """
+    return [output['OutputValue'] for output in stack.get('Outputs', [])
+        if output['OutputValue'].startswith('arn:') and parse_arn(output['OutputValue'])['service'] == 'secretsmanager']
+
+def _batch_get_secrets(client, arns):
+    values = {}
+    for start in range(0, len(arns), SECRET_BATCH_SIZE):
+        kwargs = {'SecretIdList': arns[start:start + SECRET_BATCH_SIZE]}
+        while True:
+            response = client.batch_get_secret_value(**kwargs)
+            for secret in response['SecretValues']:
+                values[secret['ARN']] = secret.get('SecretString')
+            if response.get('Errors'):
+                # e.g. no permission for one secret, let the single gets report it
+                break
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+    return values
+
+def _get_secret(client, arn):
+    # For a list of exceptions thrown, see
+    # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
+    return client.get_secret_value(SecretId=arn)['SecretString']
+
+def get_secrets(arns, session=None, max_workers=8):
+    """ Secret values by ARN, read with the session's credentials. Each region's secrets are fetched
+    with one BatchGetSecretValue call, with concurrent GetSecretValue calls for any it doesn't return
+    (older botocore, no secretsmanager:BatchGetSecretValue permission) """
+    now = time.monotonic()
+    values = {arn: _secret_cache[arn][0] for arn in arns if arn in _secret_cache and _secret_cache[arn][1] > now}
+    by_region = {}
+    for arn in arns:
+        if arn not in values:
+            by_region.setdefault(parse_arn(arn)['region'], []).append(arn)
+
+    for region, region_arns in by_region.items():
+        client = secrets_client(region, session)
+        try:
+            values.update(_batch_get_secrets(client, region_arns))
+        except (ClientError, AttributeError):
+            pass
+        missing = [arn for arn in region_arns if arn not in values]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            values.update(zip(missing, pool.map(lambda arn: _get_secret(client, arn), missing)))
+
+    expires = time.monotonic() + SECRET_CACHE_SECONDS
+    for arn in arns:
+        _secret_cache[arn] = (values[arn], expires)
+    return values
+
 def print_secret(item, i):
     value = stacks['Stacks'][item]['Outputs'][i]['OutputValue']
-    start_string = value.find(':secret:')+8
-    end_string = len(value)-7
-    secret_name = value[start_string:end_string]
-    print(f' Secret Name:       {secret_name}')
-    region_name = "eu-west-2"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-        )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
+    print(f' Secret Name:       {secret_name(value)}')
 
     # Decrypts secret using the associated KMS key.
-    secret = get_secret_value_response['SecretString']
+    secret = get_secrets([value], stack_session(stacks['Stacks'][item]))[value]
     print(f' Secret Value:      {secret}')
 
-def pull_stacks():
-    client = boto3.client('cloudformation')
-    
+def cloudformation_clients(profiles=None, regions=None):
+    """ A CloudFormation client for each AWS CLI profile (account) and region, clients from one
+    session share its credentials. Clients are made here, not in the threads, as sessions aren't thread safe """
+    sessions = [boto3.session.Session(profile_name=profile) for profile in profiles or [None]]
+    clients = []
+    for session in sessions:
+        for region in regions or [session.region_name]:
+            client = session.client('cloudformation', region_name=region)
+            _client_sessions[client] = session
+            clients.append(client)
+    return sessions, clients
+
+def describe_all_stacks(client):
+    """ Every stack in the client's account and region, describe_stacks only returns a page at a time """
+    stacks = []
+    for page in client.get_paginator('describe_stacks').paginate():
+        stacks.extend(page['Stacks'])
+    return stacks
+
+def account_alias(session):
+    aliases = session.client('iam').list_account_aliases()['AccountAliases']
+    return aliases[0] if aliases else None
+
+def pull_stacks(clients, sessions=(), max_workers=8):
+    """ Stacks from all the clients at once, with the regions, accounts and account aliases they came from """
     try:
-        alias = boto3.client('iam').list_account_aliases()['AccountAliases'][0]
-        stacks = client.describe_stacks()
-        region = stacks['Stacks'][0]['StackId'][23:32]
-        account = stacks['Stacks'][0]['StackId'][33:45]
-        return stacks, region, account, alias
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            found = list(pool.map(describe_all_stacks, clients))
+            aliases = [alias for alias in pool.map(account_alias, sessions) if alias]
     except Exception as error:
         print(f'{error}\n')
         print('Have you logged in? Have your credentials expired?')
         exit()
 
+    stacks = {'Stacks': [stack for client_stacks in found for stack in client_stacks]}
+    for client, client_stacks in zip(clients, found):
+        for stack in client_stacks:
+            _stack_sessions[stack['StackId']] = _client_sessions.get(client)
+    arns = [parse_arn(stack['StackId']) for stack in stacks['Stacks']]
+    regions = sorted({client.meta.region_name for client in clients})
+    accounts = sorted({arn['account'] for arn in arns})
+    return stacks, ', '.join(regions), ', '.join(accounts), ', '.join(aliases)
+
+def stacks_json(stacks):
+    """ The stacks for --json, outputs as a dict """
+    listing = []
+    for stack in stacks['Stacks']:
+        arn = parse_arn(stack['StackId'])
+        listing.append({
+            'StackName': stack['StackName'],
+            'StackStatus': stack['StackStatus'],
+            'Region': arn['region'],
+            'Account': arn['account'],
+            'Description': stack.get('Description'),
+            'CreationTime': stack['CreationTime'].isoformat(),
+            'LastUpdatedTime': stack['LastUpdatedTime'].isoformat() if 'LastUpdatedTime' in stack else None,
+            'Outputs': {output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', [])}
+            })
+    return json.dumps(listing, indent=2)
+
 def print_output():
     #print(stacks)
     ## create labels and set to display as green text
     label = ['  status:  ', '    created:  ', 'Stack Name: ', 'Description: ', 'Updated: ', ' at: ',
-            'Outputs:']
+            'Outputs:', '    region:  ']
     for i in range(len(label)):
         label[i] = f'\x1b[0;32;40m{label[i]}\x1b[0m'
 
@@ -72,7 +204,8 @@ def print_output():
     for i in range(len(stacks['Stacks'])):
         print(f' {i}: '+stacks['Stacks'][i]['StackName']
                 +label[0]+stacks['Stacks'][i]['StackStatus']
-                +label[1]+stacks['Stacks'][i]['CreationTime'].strftime('%d/%m/%Y'))
+                +label[1]+stacks['Stacks'][i]['CreationTime'].strftime('%d/%m/%Y')
+                +label[7]+parse_arn(stacks['Stacks'][i]['StackId'])['region'])
 
     ## take stack number as input and display select information
     while True:
@@ -102,10 +235,16 @@ def print_output():
                 pass
             try:
                 print(label[6])
+                ## fetch all the stack's secrets together, print_secret then reads them from the cache.
+                ## If one can't be read the others are still fetched one by one as the outputs are printed
+                try:
+                    get_secrets(secret_arns(stacks['Stacks'][item]), stack_session(stacks['Stacks'][item]))
+                except Exception:
+                    pass
                 for i in range(len(stacks['Stacks'][item]['Outputs'])):
                     print(' '+stacks['Stacks'][item]['Outputs'][i]['OutputKey']
                     +':     '+stacks['Stacks'][item]['Outputs'][i]['OutputValue'])
-                    if stacks['Stacks'][item]['Outputs'][i]['OutputValue'].find('secret') > 0:
+                    if stacks['Stacks'][item]['Outputs'][i]['OutputValue'] in secret_arns(stacks['Stacks'][item]):
                         print_secret(item, i)
             except:
                 print(' None')
@@ -115,8 +254,23 @@ def print_output():
             print('Try again')
             pass
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='List deployed CloudFormation stacks and their outputs')
+    parser.add_argument('--regions', help='comma separated regions, default is the region of each profile')
+    parser.add_argument('--profiles', help='comma separated AWS CLI profiles for other accounts, default is the current credentials')
+    parser.add_argument('--json', action='store_true', help='print the stacks as JSON instead of asking for input')
+    args = parser.parse_args(argv)
+    args.regions = args.regions.split(',') if args.regions else None
+    args.profiles = args.profiles.split(',') if args.profiles else None
+    return args
+
 if __name__ == '__main__':
     
-    stacks, region, account, alias = pull_stacks()
+    args = parse_args()
+    sessions, clients = cloudformation_clients(args.profiles, args.regions)
+    stacks, region, account, alias = pull_stacks(clients, sessions)
     #alias = boto3.client('iam').list_account_aliases()['AccountAliases'][0]
-    print_output()
\ No newline at end of file
+    if args.json:
+        print(stacks_json(stacks))
+    else:
+        print_output()
@@ -0,0 +1,130 @@
+## Locust scenarios for the Moodle journeys that load a deployment the most when a class is online:
+## logging in, viewing the course, attempting a quiz and downloading course files.
+## Run with run.sh, against the docker-compose stand-in or a deployed site, see README.md.
+##
+## Settings are environment variables:
+##   MOODLE_USERNAME_FORMAT  learner usernames, {n} is the user number (default tool_generator_{n:06d},
+##                           the users made by Moodle's test course generator)
+##   MOODLE_USERS            how many learners there are (default 100)
+##   MOODLE_PASSWORD         learners' password
+##   MOODLE_COURSE_ID        course to view (default 2, the first course on a new site)
+##   MOODLE_QUIZ_CMID        course module id of a quiz to attempt, quiz attempts are skipped without it
+##   MOODLE_FILE_URLS        comma separated /pluginfile.php/... URLs to download, skipped without them
+##   LOAD_STAGES             concurrency ramp as seconds:users pairs, e.g. 60:50,300:500,600:500
+##                           holds 50 users until 60 seconds, ramps to 500 by 300 seconds and holds
+##                           them until 600 seconds (default 60:10,300:100,420:100)
+##   LOAD_SPAWN_RATE         most users started per second (default 10)
+
+import itertools
+import os
+import random
+import re
+
+from locust import HttpUser, LoadTestShape, between, task
+
+USERNAME_FORMAT = os.getenv("MOODLE_USERNAME_FORMAT", "tool_generator_{n:06d}")
+USERS = int(os.getenv("MOODLE_USERS", "100"))
+PASSWORD = os.getenv("MOODLE_PASSWORD", "moodle")
+COURSE_ID = os.getenv("MOODLE_COURSE_ID", "2")
+QUIZ_CMID = os.getenv("MOODLE_QUIZ_CMID")
+FILE_URLS = [url.strip() for url in os.getenv("MOODLE_FILE_URLS", "").split(",") if url.strip()]
+
+LOGIN_TOKEN = re.compile(r'name="logintoken" value="([^"]+)"')
+SESSKEY = re.compile(r'"sesskey":"([^"]+)"')
+ATTEMPT_ID = re.compile(r"attempt=(\d+)")
+
+## Each simulated learner logs in as the next user, wrapping round when there are more learners than users
+user_numbers = itertools.count(1)
+
+
+def parse_stages(stages):
+    """ "60:50,300:500" as [(60, 50), (300, 500)], end time in seconds and the number of users by then """
+    parsed = []
+    for stage in stages.split(","):
+        end, _, users = stage.partition(":")
+        parsed.append((int(end), int(users)))
+    if [end for end, _ in parsed] != sorted(end for end, _ in parsed):
+        raise ValueError(f"LOAD_STAGES end times should go up: {stages}")
+    return parsed
+
+
+class MoodleLearner(HttpUser):
+    """ A learner working through a course, pausing 5-15 seconds between pages """
+    wait_time = between(5, 15)
+
+    def on_start(self):
+        self.username = USERNAME_FORMAT.format(n=(next(user_numbers) - 1) % USERS + 1)
+        self.sesskey = None
+        self.login()
+
+    def login(self):
+        with self.client.get("/login/index.php", name="/login/index.php [form]", catch_response=True) as response:
+            token = LOGIN_TOKEN.search(response.text)
+            if not token:
+                response.failure("no login token on the login page")
+                return
+        with self.client.post("/login/index.php", name="/login/index.php [submit]", catch_response=True, data={
+                "username": self.username,
+                "password": PASSWORD,
+                "logintoken": token.group(1),
+                }) as response:
+            sesskey = SESSKEY.search(response.text)
+            if not sesskey or "/login/index.php" in response.url:
+                response.failure(f"login failed for {self.username}")
+                return
+            self.sesskey = sesskey.group(1)
+
+    @task(10)
+    def view_course(self):
+        self.client.get(f"/course/view.php?id={COURSE_ID}", name="/course/view.php")
+
+    @task(3)
+    def view_dashboard(self):
+        self.client.get("/my/", name="/my/")
+
+    @task(4)
+    def download_file(self):
+        if FILE_URLS:
+            self.client.get(random.choice(FILE_URLS), name="/pluginfile.php")
+
+    @task(2)
+    def attempt_quiz(self):
+        if not QUIZ_CMID or not self.sesskey:
+            return
+        self.client.get(f"/mod/quiz/view.php?id={QUIZ_CMID}", name="/mod/quiz/view.php")
+        with self.client.post("/mod/quiz/startattempt.php", name="/mod/quiz/startattempt.php", catch_response=True, data={
+                "cmid": QUIZ_CMID,
+                "sesskey": self.sesskey,
+                }) as response:
+            attempt = ATTEMPT_ID.search(response.url)
+            if not attempt:
+                response.failure("quiz attempt not started")
+                return
+        # Learners read the questions before submitting
+        self.client.get(f"/mod/quiz/summary.php?attempt={attempt.group(1)}&cmid={QUIZ_CMID}", name="/mod/quiz/summary.php")
+        self.client.post("/mod/quiz/processattempt.php", name="/mod/quiz/processattempt.php", data={
+            "attempt": attempt.group(1),
+            "cmid": QUIZ_CMID,
+            "finishattempt": "1",
+            "timeup": "0",
+            "slots": "",
+            "sesskey": self.sesskey,
+            })
+
+
+class StagesShape(LoadTestShape):
+    """ Concurrency ramp from LOAD_STAGES, users change linearly from one stage to the next """
+    stages = parse_stages(os.getenv("LOAD_STAGES", "60:10,300:100,420:100"))
+    spawn_rate = float(os.getenv("LOAD_SPAWN_RATE", "10"))
+
+    def tick(self):
+        run_time = self.get_run_time()
+        start, users_before = 0, 0
+        for end, users in self.stages:
+            if run_time < end:
+                if start == 0:
+                    return users, self.spawn_rate
+                progress = (run_time - start) / (end - start)
+                return round(users_before + (users - users_before) * progress), self.spawn_rate
+            start, users_before = end, users
+        return None     # last stage finished, stop the test
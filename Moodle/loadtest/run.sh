@@ -0,0 +1,19 @@
+#!/bin/bash
+# Run the Locust scenarios without the web UI and keep the throughput and latency percentile
+# reports (CSV and HTML) in reports/<name>-<time>.
+# Usage: ./run.sh <name> [url]
+#   ./run.sh local                                  the docker-compose stand-in
+#   ./run.sh prod https://lms.example.org           a deployed stack
+# The ramp and the course are set with the variables at the top of locustfile.py.
+
+set -o errexit
+
+name="${1:?a name for the report, e.g. the profile being tested}"
+host="${2:-http://moodle:8080}"
+report="reports/$name-$(date +%Y%m%d-%H%M%S)"
+
+cd "$(dirname "$0")"
+mkdir -p "$report"
+docker compose --profile loadtest run --rm locust -f locustfile.py --headless --host "$host" \
+    --csv "$report/locust" --csv-full-history --html "$report/report.html" --only-summary
+echo "Reports in $report"
@@ -0,0 +1,19 @@
+#!/bin/bash
+# Make a test course with learners in the docker-compose Moodle, with Moodle's test course generator.
+# Usage: ./setup.sh [size], size XS, S (100 learners, default), M (1000), L (10000)
+# The learners are tool_generator_000001... with the password in MOODLE_PASSWORD (default moodle).
+
+set -o errexit
+
+size="${1:-S}"
+password="${MOODLE_PASSWORD:-moodle}"
+moodle_cli() {
+    local script="$1"
+    shift
+    docker compose exec -T -u daemon moodle /opt/bitnami/php/bin/php "/opt/bitnami/moodle/$script" "$@"
+}
+
+cd "$(dirname "$0")"
+moodle_cli admin/cli/cfg.php --name=tool_generator_users_password --set="$password"
+moodle_cli admin/tool/generator/cli/maketestcourse.php --shortname="LOADTEST$size" --size="$size" --bypasscheck | tee /dev/stderr \
+    | grep -o 'course/view.php?id=[0-9]*' | sed 's/.*id=/MOODLE_COURSE_ID=/'
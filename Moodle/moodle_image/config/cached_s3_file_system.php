@@ -0,0 +1,80 @@
+<?php
+// tool_objectfs S3 file system with a read-through cache on the task's ephemeral storage.
+// tool_objectfs reads files that are only in S3 straight from the bucket every time, this keeps
+// a copy of each one read in MOODLE_OBJECTFS_CACHE_DIR, removing the least recently used files
+// once they take up more than MOODLE_OBJECTFS_CACHE_SIZE bytes. Every task has its own cache.
+// Files over the pre-signed URL size are downloaded from S3 by the browser and never cached here.
+
+namespace moodle_extra;
+
+class cached_s3_file_system extends \tool_objectfs\s3_file_system {
+
+    /**
+     * Path for reading a file, the cached copy for files that are only in S3.
+     *
+     * @param string $contenthash
+     * @return string
+     */
+    protected function get_remote_path_from_hash($contenthash) {
+        $path = parent::get_remote_path_from_hash($contenthash);
+        $cachedir = getenv('MOODLE_OBJECTFS_CACHE_DIR');
+        $cachesize = (int) getenv('MOODLE_OBJECTFS_CACHE_SIZE');
+        // Local files in filedir on EFS are read where they are
+        if (!$cachedir || $cachesize <= 0 || !preg_match('#^[a-z0-9]+://#', $path)) {
+            return $path;
+        }
+
+        $cachedpath = $cachedir . '/' . substr($contenthash, 0, 2) . '/' . $contenthash;
+        if (is_readable($cachedpath)) {
+            touch($cachedpath);     // most recently used
+            return $cachedpath;
+        }
+
+        // Copied under a temporary name so other requests never read a partial file
+        if (!is_dir(dirname($cachedpath))) {
+            @mkdir(dirname($cachedpath), 0770, true);
+        }
+        $temppath = $cachedpath . '.' . uniqid('', true) . '.tmp';
+        if (!@copy($path, $temppath) || sha1_file($temppath) !== $contenthash
+                || filesize($temppath) > $cachesize) {
+            @unlink($temppath);
+            return $path;
+        }
+        rename($temppath, $cachedpath);
+        $this->trim_cache($cachedir, $cachesize);
+        return $cachedpath;
+    }
+
+    /**
+     * Remove the least recently used files until the cache fits in its size.
+     * Only files over the objectfs size threshold are cached, so there aren't many to go through.
+     *
+     * @param string $cachedir
+     * @param int $cachesize bytes
+     */
+    protected function trim_cache($cachedir, $cachesize) {
+        $files = [];
+        $total = 0;
+        foreach (glob($cachedir . '/*/*') ?: [] as $file) {
+            if (substr($file, -4) === '.tmp' || !($stat = @stat($file))) {
+                continue;
+            }
+            $files[$file] = $stat['mtime'];
+            $total += $stat['size'];
+        }
+        if ($total <= $cachesize) {
+            return;
+        }
+        asort($files);
+        foreach (array_keys($files) as $file) {
+            $size = (int) @filesize($file);
+            // another request may have removed it already
+            if (@unlink($file)) {
+                $total -= $size;
+            }
+            if ($total <= $cachesize) {
+                break;
+            }
+        }
+    }
+}
@@ -0,0 +1,85 @@
+<?php
+// Settings taken from the Fargate task environment, included from config.php before lib/setup.php.
+// Anything that isn't set in the environment is left to Moodle's defaults.
+
+// Node local caches on the task's ephemeral storage, they don't need to be shared between tasks.
+// tempdir and cachedir stay in moodledata on EFS, Moodle needs them shared across the cluster.
+if ($localcachedir = getenv('MOODLE_LOCALCACHEDIR')) {
+    $CFG->localcachedir = $localcachedir;
+}
+if ($localrequestdir = getenv('MOODLE_LOCALREQUESTDIR')) {
+    $CFG->localrequestdir = $localrequestdir;
+}
+
+// Aurora reader endpoint for read-only queries (db_engine aurora-serverless)
+// https://docs.moodle.org/dev/Database_read_replicas
+if ($readonlyhost = getenv('MOODLE_DATABASE_READONLY_HOST')) {
+    $CFG->dboptions['readonly'] = [
+        'instance' => [$readonlyhost],
+        'connecttimeout' => 2,
+    ];
+}
+
+// Sessions and the application cache in ElastiCache Redis (enable_redis)
+if ($redishost = getenv('MOODLE_REDIS_HOST')) {
+    $redisport = getenv('MOODLE_REDIS_PORT') ?: 6379;
+
+    $CFG->session_handler_class = '\core\session\redis';
+    $CFG->session_redis_host = $redishost;
+    $CFG->session_redis_port = (int) $redisport;
+    $CFG->session_redis_prefix = 'sess_';
+    $CFG->session_redis_acquire_lock_timeout = 120;
+    $CFG->session_redis_lock_expire = 7200;
+
+    // MUC stores can only be set from config.php with the tool_forcedcache plugin (see plugins/README.md)
+    if (file_exists('/opt/bitnami/moodle/admin/tool/forcedcache/version.php')) {
+        $CFG->alternative_cache_factory_class = 'tool_forcedcache_cache_factory';
+        $CFG->tool_forcedcache_config_array = [
+            'stores' => [
+                'redis' => [
+                    'type' => 'redis',
+                    'config' => [
+                        'server' => $redishost . ':' . $redisport,
+                        'prefix' => 'muc_',
+                    ],
+                ],
+            ],
+            'rules' => [
+                'application' => [['stores' => ['redis']]],
+                'session' => [['stores' => ['redis']]],
+                'request' => [],
+            ],
+            'definitionoverrides' => [],
+        ];
+    }
+}
+
+// Large files in S3 with tool_objectfs (enable_objectfs), the task role gives access to the bucket.
+// Files over the size threshold are moved out of filedir on EFS by the objectfs scheduled tasks,
+// files read back from S3 are kept in a size limited cache on the task's ephemeral storage.
+// https://github.com/catalyst/moodle-tool_objectfs
+if (($objectfsbucket = getenv('MOODLE_OBJECTFS_BUCKET'))
+        && file_exists('/opt/bitnami/moodle/admin/tool/objectfs/version.php')) {
+    // Loaded when the file storage is set up, after lib/setup.php has registered the plugin classes it extends
+    spl_autoload_register(function($classname) {
+        if ($classname === 'moodle_extra\cached_s3_file_system') {
+            require_once('/opt/bitnami/moodle-extra/cached_s3_file_system.php');
+        }
+    });
+    $CFG->alternative_file_system_class = '\moodle_extra\cached_s3_file_system';
+    $CFG->forced_plugin_settings['tool_objectfs'] = [
+        'enabletasks' => 1,
+        'filesystem' => '\moodle_extra\cached_s3_file_system',
+        's3_usesdkcreds' => 1,
+        's3_bucket' => $objectfsbucket,
+        's3_region' => getenv('MOODLE_OBJECTFS_REGION'),
+        'sizethreshold' => (int) getenv('MOODLE_OBJECTFS_SIZE_THRESHOLD'),
+        'minimumage' => (int) getenv('MOODLE_OBJECTFS_MINIMUM_AGE'),
+        'deletelocal' => 1,
+        'consistencydelay' => 600,
+        'maxtaskruntime' => 1800,
+        'enablepresignedurls' => 1,
+        'presignedminfilesize' => (int) getenv('MOODLE_OBJECTFS_PRESIGNED_MIN_SIZE'),
+        'expirationtime' => 600,
+    ];
+}
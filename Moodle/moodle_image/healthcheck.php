@@ -0,0 +1,15 @@
+<?php
+// Load balancer health check, cheap enough to be requested every few seconds by every target.
+// ABORT_AFTER_CONFIG stops lib/setup.php straight after $CFG is set up, so this checks that
+// Apache and PHP answer and Moodle is configured without opening a database connection or a
+// session. Shared services (database, EFS, Redis) are left out on purpose, an outage there
+// would otherwise mark every task unhealthy and have them all replaced at once.
+
+define('ABORT_AFTER_CONFIG', true);
+define('NO_MOODLE_COOKIES', true);
+
+require(__DIR__ . '/config.php');
+
+header('Content-Type: text/plain');
+header('Cache-Control: no-store');
+echo 'OK';
@@ -0,0 +1,13 @@
+#!/bin/bash
+# Include the environment driven settings in config.php, before lib/setup.php runs.
+# Run by the bitnami image after Moodle is set up. config.php is a link to the copy persisted on EFS,
+# so the include is added once and kept for the tasks that restore it.
+
+set -o errexit
+
+config_file="/opt/bitnami/moodle/config.php"
+extra_config="/opt/bitnami/moodle-extra/config-extra.php"
+
+if ! grep -q "$extra_config" "$config_file"; then
+    sed -i --follow-symlinks "s|^require_once(__DIR__ . '/lib/setup.php');|require_once('$extra_config');\n&|" "$config_file"
+fi
@@ -1,72 +1,361 @@
+import os
+import re
+from typing import NamedTuple, Optional
+
 from aws_cdk import (
     Duration,
+    Environment,
     RemovalPolicy,
+    Size,
     Stack,
+    Token,
     aws_ecs as ecs,
+    aws_ecr_assets as ecr_assets,
     aws_ecs_patterns as ecs_patterns,
     aws_ec2 as ec2,
     aws_rds as rds,
     aws_efs as efs,
+    aws_elasticache as elasticache,
     aws_iam as iam,
     aws_wafv2 as waf,
     aws_certificatemanager as cert_man,
     aws_route53 as rt53,
+    aws_route53_targets as rt53_targets,
+    aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as origins,
+    aws_applicationautoscaling as appscaling,
+    aws_cloudwatch as cloudwatch,
+    aws_cloudwatch_actions as cloudwatch_actions,
+    aws_logs as logs,
     #aws_lambda as lambda_,
     #aws_apigateway as apigateway,
-    #aws_s3 as s3,
+    aws_s3 as s3,
     #aws_lambda_event_sources as event_sources,
     aws_secretsmanager as secretsmanager,
+    aws_sns as sns,
+    aws_sns_subscriptions as sns_subscriptions,
     CfnOutput as CfnOutput,
-    #aws_elasticloadbalancingv2 as elbv2
+    aws_elasticloadbalancingv2 as elbv2
 )
 from constructs import Construct
 
-class MoodleServerlessStackV2(Stack):
-    def __init__(self, scope: Construct, construct_id: str, props: dict, **kwargs) -> None:
+from .profiles import MoodleProfile
+
+## Bitnami Moodle image the tasks run, and the prebaked image is built from. Pinned so every task and
+## build has the same Moodle code, the plugin refs in moodle_image/Dockerfile are updated with it
+MOODLE_IMAGE = "bitnami/moodle:4.1.3"
+
+## ecs.CpuArchitecture isn't an enum, map the names used in profiles
+CPU_ARCHITECTURES = {
+    "X86_64": ecs.CpuArchitecture.X86_64,
+    "ARM64": ecs.CpuArchitecture.ARM64,     # Graviton
+    }
+## The prebaked image is built for the tasks' architecture, not the architecture of the machine running cdk deploy
+IMAGE_PLATFORMS = {
+    "X86_64": ecr_assets.Platform.LINUX_AMD64,
+    "ARM64": ecr_assets.Platform.LINUX_ARM64,
+    }
+
+## OpenTelemetry collector sidecar config (enable_tracing), passed to the ADOT collector in AOT_CONFIG_CONTENT
+## Spans from PHP come in over OTLP on the task's localhost and go out to X-Ray in batches
+## https://aws-otel.github.io/docs/setup/ecs/config-through-ssm
+TRACING_COLLECTOR_CONFIG = """\
+receivers:
+  otlp:
+    protocols:
+      http:
+        endpoint: 127.0.0.1:4318
+processors:
+  resourcedetection:
+    detectors: [env, ecs]
+  batch/traces:
+    timeout: 1s
+    send_batch_size: 50
+exporters:
+  awsxray:
+    region: {region}
+service:
+  pipelines:
+    traces:
+      receivers: [otlp]
+      processors: [resourcedetection, batch/traces]
+      exporters: [awsxray]
+"""
+
+## Header CloudFront adds to origin requests, the ALB web ACL blocks requests without its secret value
+ORIGIN_VERIFY_HEADER = "X-Origin-Verify"
+
+
+def hosted_zone(scope: Construct, props: dict) -> rt53.IHostedZone:
+    """ The site's Route 53 zone. Hosted zones are global, so with hosted_zone_id in the props the
+    stacks in every region use it as it is, otherwise the zone is looked up by domain name """
+    if props.get("hosted_zone_id"):
+        return rt53.HostedZone.from_hosted_zone_attributes(scope, "TwilightZone",
+            hosted_zone_id=props["hosted_zone_id"],
+            zone_name=props.get("hosted_zone_name") or props["domain_name"])
+    return rt53.HostedZone.from_lookup(scope, "TwilightZone", domain_name=props["domain_name"])
+
+
+def waf_rules(profile: MoodleProfile) -> list:
+    """ WAF rules built from the profile's table, see DEFAULT_WAF_RULES in profiles.py. Rate limits count
+    requests per client IP, the web ACL has to see the client's own address (CloudFront, or the ALB without it) """
+    rules = list()
+    for rule in profile.all_waf_rules:
+        action = "count" if profile.waf_count_only else rule["action"]
+        visibility_config = waf.CfnWebACL.VisibilityConfigProperty(
+            cloud_watch_metrics_enabled=True,
+            metric_name=rule.get("metric", rule["name"]),
+            sampled_requests_enabled=True,
+        )
+        if rule["type"] == "rate":
+            """ Per client IP request limits, over the limit gets 429 Too Many Requests """
+            scope_down = []
+            if rule.get("path"):
+                scope_down.append(waf.CfnWebACL.StatementProperty(
+                    byte_match_statement=waf.CfnWebACL.ByteMatchStatementProperty(
+                        field_to_match=waf.CfnWebACL.FieldToMatchProperty(uri_path={}),
+                        positional_constraint="STARTS_WITH",
+                        search_string=rule["path"],
+                        text_transformations=[waf.CfnWebACL.TextTransformationProperty(priority=0, type="LOWERCASE")]
+                    )))
+            if rule.get("method"):
+                scope_down.append(waf.CfnWebACL.StatementProperty(
+                    byte_match_statement=waf.CfnWebACL.ByteMatchStatementProperty(
+                        field_to_match=waf.CfnWebACL.FieldToMatchProperty(method={}),
+                        positional_constraint="EXACTLY",
+                        search_string=rule["method"],
+                        text_transformations=[waf.CfnWebACL.TextTransformationProperty(priority=0, type="NONE")]
+                    )))
+            if len(scope_down) > 1:
+                scope_down_statement = waf.CfnWebACL.StatementProperty(
+                    and_statement=waf.CfnWebACL.AndStatementProperty(statements=scope_down))
+            else:
+                scope_down_statement = scope_down[0] if scope_down else None
+            if action == "block":
+                rule_action = waf.CfnWebACL.RuleActionProperty(block=waf.CfnWebACL.BlockActionProperty(
+                    custom_response=waf.CfnWebACL.CustomResponseProperty(response_code=429)))
+            else:
+                rule_action = waf.CfnWebACL.RuleActionProperty(count={})
+            rules.append(waf.CfnWebACL.RuleProperty(
+                name=rule["name"],
+                priority=rule["priority"],
+                action=rule_action,
+                statement=waf.CfnWebACL.StatementProperty(
+                    rate_based_statement=waf.CfnWebACL.RateBasedStatementProperty(
+                        limit=rule["limit"],   # requests in 5 minutes
+                        scope_down_statement=scope_down_statement,
+                        aggregate_key_type="IP"
+                    )
+                ),
+                visibility_config=visibility_config
+            ))
+        else:
+            """ AWS managed rule groups, "count" only reports what the group would block """
+            managed_rule_group_configs = None
+            if rule["rule_group"] == "AWSManagedRulesBotControlRuleSet":
+                managed_rule_group_configs = [waf.CfnWebACL.ManagedRuleGroupConfigProperty(
+                    aws_managed_rules_bot_control_rule_set=waf.CfnWebACL.AWSManagedRulesBotControlRuleSetProperty(
+                        inspection_level="COMMON"   # self-identifying bots and scrapers, TARGETED costs more
+                    ))]
+            rules.append(waf.CfnWebACL.RuleProperty(
+                name=rule["name"],
+                priority=rule["priority"],
+                override_action=waf.CfnWebACL.OverrideActionProperty(count={}) if action == "count" \
+                    else waf.CfnWebACL.OverrideActionProperty(none={}),
+                statement=waf.CfnWebACL.StatementProperty(
+                    managed_rule_group_statement=waf.CfnWebACL.ManagedRuleGroupStatementProperty(
+                        name=rule["rule_group"],
+                        vendor_name='AWS',
+                        excluded_rules=[],
+                        managed_rule_group_configs=managed_rule_group_configs
+                    )
+                ),
+                visibility_config=visibility_config
+            ))
+    return rules
+
+
+class MoodleNetworkStack(Stack):
+    """ VPC, NAT instances and VPC endpoints, shared by the data and app stacks """
+    def __init__(self, scope: Construct, construct_id: str, profile: MoodleProfile = None, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        ## Capacity settings, see profiles.py
+        profile = profile or MoodleProfile()
+
         ## Nat Instance
         # Create a new NAT instance
         nat_gateway_provider = ec2.NatProvider.instance(
-            instance_type=ec2.InstanceType('t3.nano')
+            instance_type=ec2.InstanceType(profile.nat_instance_type)
             )
 
         ## VPC
         ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_ec2/Vpc.html
         vpc = ec2.Vpc(self, "Vpc",
-            max_azs=2,   # default is all AZs in region = 3
-            nat_gateways=1, # default is one in each zone. Cheaper for us to create a NAT instance?
+            max_azs=profile.max_azs,   # default is all AZs in region = 3
+            nat_gateways=profile.nat_gateways, # default is one in each zone. Cheaper for us to create a NAT instance?
             nat_gateway_provider=nat_gateway_provider
             )
-              
-        ## RDS DATABASE - mysql
-        ## https://aws.amazon.com/rds/instance-types/
-        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_rds/DatabaseInstance.html
-        data_base = rds.DatabaseInstance(self, "moodle-db",
-            vpc=vpc,
-            engine=rds.DatabaseInstanceEngine.mysql(version=rds.MysqlEngineVersion.VER_8_0_31),
-            instance_type=ec2.InstanceType('t4g.micro'), #https://aws.amazon.com/rds/mysql/pricing/?pg=pr&loc=2
-            allocated_storage=5,
-            max_allocated_storage=20, #GiB
-            database_name="moodledb",
-            credentials=rds.Credentials.from_generated_secret("dbadmin",
-                exclude_characters='(" %+~`#$&*()|[]}{:;<>?!\'/^-,@_=\\'), # generate secret password for dbuser
-            removal_policy=RemovalPolicy.DESTROY      # dev
+
+        ## VPC endpoints, keep AWS service traffic (image pulls, secrets, logs) off the NAT instance
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_ec2/InterfaceVpcEndpoint.html
+        # ECR image layers are served from S3, the gateway endpoint is free
+        vpc.add_gateway_endpoint("S3Endpoint",
+            service=ec2.GatewayVpcEndpointAwsService.S3
             )
+        if profile.vpc_interface_endpoints:
+            interface_endpoints = {
+                "EcrApiEndpoint": ec2.InterfaceVpcEndpointAwsService.ECR,
+                "EcrDockerEndpoint": ec2.InterfaceVpcEndpointAwsService.ECR_DOCKER,
+                "SecretsManagerEndpoint": ec2.InterfaceVpcEndpointAwsService.SECRETS_MANAGER,
+                "CloudWatchLogsEndpoint": ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS,
+                }
+            if profile.vpc_efs_endpoint:     # EFS API calls only, NFS traffic already goes to the mount targets
+                interface_endpoints["EfsEndpoint"] = ec2.InterfaceVpcEndpointAwsService.ELASTIC_FILESYSTEM
+            for endpoint_id, endpoint_service in interface_endpoints.items():
+                vpc.add_interface_endpoint(endpoint_id,
+                    service=endpoint_service,
+                    private_dns_enabled=True,   # default, the usual service hostnames resolve to the endpoint
+                    subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS)
+                    )
+
+        self.vpc = vpc
+        self.nat_gateway_provider = nat_gateway_provider
+
+
+class MoodleDataStack(Stack):
+    """ Database, EFS file system, Redis, the objectfs bucket and secrets, everything holding Moodle's state """
+    def __init__(self, scope: Construct, construct_id: str, network: MoodleNetworkStack, profile: MoodleProfile = None,
+            **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        ## Capacity settings, see profiles.py
+        profile = profile or MoodleProfile()
+        vpc = network.vpc
+
+        ## RDS DATABASE - mysql
+        ## "instance" is a single small MySQL instance (cheap dev profile),
+        ## "aurora-serverless" is Aurora MySQL Serverless v2 with reader instances for read-only queries
+        db_engine = profile.db_engine
+        db_credentials = rds.Credentials.from_generated_secret("dbadmin",
+            exclude_characters='(" %+~`#$&*()|[]}{:;<>?!\'/^-,@_=\\') # generate secret password for dbuser
+        ## MySQL settings for Moodle, slow queries are logged to a file that is exported to CloudWatch Logs
+        ## https://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_LogAccess.MySQL.LogFileSize.html
+        db_parameters = {
+            "tmp_table_size": str(profile.db_tmp_table_size_mib * 1024 * 1024),
+            "max_heap_table_size": str(profile.db_tmp_table_size_mib * 1024 * 1024),   # caps tmp_table_size
+            "slow_query_log": "1",
+            "long_query_time": str(profile.db_long_query_time),
+            "log_output": "FILE"
+            }
+        if profile.db_max_connections:
+            db_parameters["max_connections"] = str(profile.db_max_connections)
+        db_log_retention = logs.RetentionDays[profile.db_log_retention]
+        if db_engine == "instance":
+            db_engine_version = rds.DatabaseInstanceEngine.mysql(version=rds.MysqlEngineVersion.VER_8_0_31)
+            db_parameters["innodb_buffer_pool_size"] = f"{{DBInstanceClassMemory*{profile.db_buffer_pool_percent}/100}}"
+            db_parameter_group = rds.ParameterGroup(self, "MoodleDbParameters",
+                engine=db_engine_version,
+                description="Moodle MySQL settings",
+                parameters=db_parameters
+                )
+            ## https://aws.amazon.com/rds/instance-types/
+            ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_rds/DatabaseInstance.html
+            data_base = rds.DatabaseInstance(self, "moodle-db",
+                vpc=vpc,
+                engine=db_engine_version,
+                instance_type=ec2.InstanceType(profile.db_instance_type), #https://aws.amazon.com/rds/mysql/pricing/?pg=pr&loc=2
+                allocated_storage=profile.db_allocated_storage,
+                max_allocated_storage=profile.db_max_allocated_storage, #GiB
+                storage_type=rds.StorageType[profile.db_storage_type],
+                iops=profile.db_iops,
+                storage_throughput=profile.db_storage_throughput,
+                parameter_group=db_parameter_group,
+                enable_performance_insights=profile.db_performance_insights,
+                cloudwatch_logs_exports=list(profile.db_log_exports),
+                cloudwatch_logs_retention=db_log_retention,
+                database_name="moodledb",
+                credentials=db_credentials,
+                removal_policy=RemovalPolicy.DESTROY      # dev
+                )
+            db_writer_address = data_base.db_instance_endpoint_address
+            db_reader_address = None
+            db_endpoint_port = data_base.db_instance_endpoint_port
+        else:   # aurora-serverless
+            ## https://docs.aws.amazon.com/AmazonRDS/latest/AuroraUserGuide/aurora-serverless-v2.html
+            ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_rds/DatabaseCluster.html
+            ## Aurora manages the storage and sizes the buffer pool with the ACUs
+            db_engine_version = rds.DatabaseClusterEngine.aurora_mysql(version=rds.AuroraMysqlEngineVersion.VER_3_03_0) # MySQL 8.0 compatible
+            db_parameter_group = rds.ParameterGroup(self, "MoodleDbParameters",
+                engine=db_engine_version,
+                description="Moodle Aurora MySQL instance settings",
+                parameters=db_parameters
+                )
+            data_base = rds.DatabaseCluster(self, "moodle-db-cluster",
+                engine=db_engine_version,
+                instance_props=rds.InstanceProps(
+                    vpc=vpc,
+                    instance_type=ec2.InstanceType('serverless'),   # db.serverless, capacity set in ACUs below
+                    parameter_group=db_parameter_group,
+                    enable_performance_insights=profile.db_performance_insights
+                    ),
+                instances=1 + profile.db_readers,   # writer plus readers
+                cloudwatch_logs_exports=list(profile.db_log_exports),
+                cloudwatch_logs_retention=db_log_retention,
+                default_database_name="moodledb",
+                credentials=db_credentials,
+                storage_encrypted=True,
+                removal_policy=RemovalPolicy.DESTROY      # dev
+                )
+            # DatabaseCluster has no serverless v2 properties in this CDK version
+            data_base.node.default_child.add_property_override("ServerlessV2ScalingConfiguration", {
+                "MinCapacity": profile.db_min_acu,
+                "MaxCapacity": profile.db_max_acu
+                })
+            db_writer_address = data_base.cluster_endpoint.hostname
+            db_reader_address = data_base.cluster_read_endpoint.hostname
+            db_endpoint_port = Token.as_string(data_base.cluster_endpoint.port)
 
         # EFS elastic file system
+        # Bursting throughput drains its credits on big course backup restores, ELASTIC or PROVISIONED avoid that
+        # https://docs.aws.amazon.com/efs/latest/ug/performance.html
+        efs_throughput_mode = efs.ThroughputMode[profile.efs_throughput_mode]
+        efs_performance_mode = efs.PerformanceMode[profile.efs_performance_mode]
+        efs_provisioned_throughput = None
+        if efs_throughput_mode == efs.ThroughputMode.PROVISIONED:
+            efs_provisioned_throughput = Size.mebibytes(profile.efs_provisioned_throughput_mibps)
         file_system = efs.FileSystem(self, "MoodleEfsFileSystem",
             vpc=vpc,
-            lifecycle_policy=efs.LifecyclePolicy.AFTER_14_DAYS,  # files are not transitioned to infrequent access (IA) storage by default
-            performance_mode=efs.PerformanceMode.GENERAL_PURPOSE,  # default
-            out_of_infrequent_access_policy=efs.OutOfInfrequentAccessPolicy.AFTER_1_ACCESS,
+            # files are not transitioned to infrequent access (IA) storage by default
+            lifecycle_policy=None if profile.efs_lifecycle_policy == "NONE" else efs.LifecyclePolicy[profile.efs_lifecycle_policy],
+            performance_mode=efs_performance_mode,
+            throughput_mode=efs_throughput_mode,
+            provisioned_throughput_per_second=efs_provisioned_throughput,
+            out_of_infrequent_access_policy=None if profile.efs_out_of_infrequent_access_policy == "NONE" else \
+                efs.OutOfInfrequentAccessPolicy[profile.efs_out_of_infrequent_access_policy],
             removal_policy=RemovalPolicy.DESTROY # dev
             )
 
-        ## EFS access point
+        ## EFS access point, only moodledata is on shared storage, the Moodle code is in the image
         access_point = efs.AccessPoint(self, "MoodleEfsAccessPoint",
             file_system=file_system,
-            path="/",
+            path="/moodledata",
+            create_acl=efs.Acl(
+                owner_uid="0",
+                owner_gid="0",
+                permissions="755"
+                ),
+            posix_user=efs.PosixUser(
+                uid="0",
+                gid="0"
+                )
+            )
+
+        ## EFS access point for the config.php written by the first install, bitnami's persisted
+        ## Moodle directory. New tasks find it there and restore the site instead of installing it again
+        config_access_point = efs.AccessPoint(self, "MoodleConfigAccessPoint",
+            file_system=file_system,
+            path="/moodle",
             create_acl=efs.Acl(
                 owner_uid="0",
                 owner_gid="0",
@@ -78,50 +367,314 @@ class MoodleServerlessStackV2(Stack):
                 )
             )
 
+        ## RDS Proxy, pools the connections opened by every PHP worker in every task
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_rds/DatabaseProxy.html
+        db_proxy = None
+        if profile.enable_db_proxy:
+            db_proxy = data_base.add_proxy("MoodleDbProxy",
+                secrets=[data_base.secret],     # same generated secret the tasks use
+                vpc=vpc,
+                max_connections_percent=profile.db_proxy_max_connections_percent,  # of the DB max_connections
+                max_idle_connections_percent=profile.db_proxy_max_idle_connections_percent,
+                idle_client_timeout=Duration.seconds(profile.db_proxy_idle_client_timeout),
+                borrow_timeout=Duration.seconds(profile.db_proxy_borrow_timeout),
+                require_tls=False,      # Moodle's mysqli driver connects without TLS by default
+                # Moodle sets the same session variables on every connection, don't pin connections for them
+                session_pinning_filters=[rds.SessionPinningFilter.EXCLUDE_VARIABLE_SETS]
+                )
+            data_base.connections.allow_default_port_from(db_proxy)
+            if db_reader_address:
+                # Read-only proxy endpoint, pools the connections to the reader instances.
+                # Endpoint names are unique in the account and region, so it is named after the stack
+                endpoint_prefix = re.sub(r"-+", "-", re.sub(r"[^a-z0-9]", "-", self.stack_name.lower()))[:55].strip("-")
+                reader_endpoint = rds.CfnDBProxyEndpoint(self, "MoodleDbProxyReader",
+                    db_proxy_name=db_proxy.db_proxy_name,
+                    db_proxy_endpoint_name=f"{endpoint_prefix}-reader",
+                    target_role="READ_ONLY",
+                    vpc_subnet_ids=vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS).subnet_ids,
+                    vpc_security_group_ids=[group.security_group_id for group in db_proxy.connections.security_groups]
+                    )
+                db_reader_address = reader_endpoint.attr_endpoint
+
+        ## Moodle admin password, passed to the tasks as a secret
+        moodlepassword = secretsmanager.Secret(self, "Moodlepassword")
+
+        ## ElastiCache Redis for Moodle sessions and the MUC application cache (optional)
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_elasticache/CfnReplicationGroup.html
+        redis = None
+        redis_cluster = None
+        if profile.enable_redis:
+            redis_port = 6379
+            redis_subnet_group = elasticache.CfnSubnetGroup(self, "MoodleRedisSubnetGroup",
+                description="Private subnets for the Moodle Redis cache",
+                subnet_ids=vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS).subnet_ids
+                )
+            redis_security_group = ec2.SecurityGroup(self, "MoodleRedisSecurityGroup",
+                vpc=vpc,
+                description="Moodle Redis cache",
+                allow_all_outbound=False
+                )
+            redis_nodes = profile.redis_nodes    # primary plus replicas
+            redis_cluster = elasticache.CfnReplicationGroup(self, "MoodleRedis",
+                replication_group_description="Moodle sessions and MUC cache",
+                engine="redis",
+                engine_version="7.0",
+                cache_node_type=profile.redis_node_type,
+                num_cache_clusters=redis_nodes,
+                automatic_failover_enabled=redis_nodes > 1,   # needs at least one replica
+                multi_az_enabled=redis_nodes > 1,
+                at_rest_encryption_enabled=True,
+                port=redis_port,
+                cache_subnet_group_name=redis_subnet_group.ref,
+                security_group_ids=[redis_security_group.security_group_id]
+                )
+            redis = ec2.Connections(security_groups=[redis_security_group],
+                default_port=ec2.Port.tcp(redis_port))
+
+        ## S3 object storage for Moodle's filedir with tool_objectfs (optional, needs the prebaked image)
+        ## Files over the size threshold are moved from EFS to S3 by a scheduled task once they are older
+        ## than the minimum age, small and new files stay on EFS. Large files are downloaded straight
+        ## from S3 with pre-signed URLs. Traffic to S3 goes through the free gateway endpoint.
+        ## https://github.com/catalyst/moodle-tool_objectfs
+        files_bucket = None
+        if profile.enable_objectfs:
+            files_bucket = s3.Bucket(self, "MoodleFiles",
+                encryption=s3.BucketEncryption.S3_MANAGED,
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                enforce_ssl=True,
+                lifecycle_rules=[s3.LifecycleRule(
+                    abort_incomplete_multipart_upload_after=Duration.days(7),   # failed large uploads
+                    transitions=[s3.Transition(storage_class=s3.StorageClass.INTELLIGENT_TIERING,
+                        transition_after=Duration.days(0))]
+                    )],
+                removal_policy=RemovalPolicy.DESTROY,  # dev
+                auto_delete_objects=True
+                )
+
+        ## Used by the app stack
+        self.data_base = data_base
+        self.db_proxy = db_proxy
+        self.db_address = db_proxy.endpoint if db_proxy else db_writer_address
+        self.db_reader_address = db_reader_address
+        self.db_port = db_endpoint_port
+        self.file_system = file_system
+        self.access_point = access_point
+        self.config_access_point = config_access_point
+        self.moodlepassword = moodlepassword
+        self.redis = redis
+        self.redis_cluster = redis_cluster
+        self.files_bucket = files_bucket
+
+
+class MoodleEdgeStack(Stack):
+    """ Resources CloudFront needs in us-east-1, the certificate and the WAF web ACL, only made when the CDN is enabled.
+    The app stack reads them with cross region references """
+    def __init__(self, scope: Construct, construct_id: str, props: dict, profile: MoodleProfile = None, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        ## Capacity settings, see profiles.py
+        profile = profile or MoodleProfile()
+
+        zone = hosted_zone(self, props)
+
+        ## CloudFront certificates have to be in us-east-1
+        self.certificate = cert_man.Certificate(self, "CdnCertificate",
+            domain_name=props["domain_name"],
+            certificate_name=f"Moodle LMS {profile.name} CloudFront",
+            validation=cert_man.CertificateValidation.from_dns(zone)
+            )
+
+        ## WAF for the distribution, CloudFront web ACLs have to be in us-east-1 too. At the edge the rate
+        ## limits count the viewer's own IP, nothing a client sends in X-Forwarded-For
+        self.web_acl = waf.CfnWebACL(self, 'WebACL',
+            default_action=waf.CfnWebACL.DefaultActionProperty(allow={}),
+            scope="CLOUDFRONT",
+            visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
+                cloud_watch_metrics_enabled=True,
+                metric_name='webACL',
+                sampled_requests_enabled=True
+            ),
+            name=f'MoodleWAF-{self.stack_name}',     # unique for each site, not each profile
+            rules=waf_rules(profile)
+            )
+
+
+class MoodleServerlessStackV2(Stack):
+    """ ECS cluster, web and worker services, load balancer, CloudFront, WAF and monitoring.
+    Holds no state, so it can be deployed on its own while the network and data stacks stay as they are """
+    def __init__(self, scope: Construct, construct_id: str, props: dict, network: MoodleNetworkStack,
+            data: MoodleDataStack, profile: MoodleProfile = None, edge: MoodleEdgeStack = None, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        ## Capacity settings, see profiles.py
+        profile = profile or MoodleProfile()
+        vpc = network.vpc
+        data_base = data.data_base
+        file_system = data.file_system
+        files_bucket = data.files_bucket
+
+        ## Alarm notifications, subscribe on-call email or chat to this topic
+        alarm_topic = sns.Topic(self, "MoodleAlarmTopic", display_name=f"Moodle {profile.name} alarms")
+        if profile.alarm_email:
+            alarm_topic.add_subscription(sns_subscriptions.EmailSubscription(profile.alarm_email))
+        alarms = []
+
+        ## Alarms for when file I/O is throttling Moodle
+        ## https://docs.aws.amazon.com/efs/latest/ug/efs-metrics.html
+        if profile.efs_throughput_mode == "BURSTING":
+            alarms.append(cloudwatch.Alarm(self, "MoodleEfsBurstCreditAlarm",
+                alarm_description="Moodle EFS is running out of burst credits, throughput will drop to the baseline",
+                metric=cloudwatch.Metric(namespace="AWS/EFS", metric_name="BurstCreditBalance",
+                    dimensions_map={"FileSystemId": file_system.file_system_id},
+                    statistic="Minimum", period=Duration.minutes(5)),
+                threshold=Size.gibibytes(profile.efs_burst_credit_alarm_gib).to_bytes(),
+                comparison_operator=cloudwatch.ComparisonOperator.LESS_THAN_THRESHOLD,
+                evaluation_periods=1
+                ))
+        if profile.efs_performance_mode == "GENERAL_PURPOSE":     # not reported in MAX_IO mode
+            alarms.append(cloudwatch.Alarm(self, "MoodleEfsIoLimitAlarm",
+                alarm_description="Moodle EFS is close to the general purpose I/O limit",
+                metric=cloudwatch.Metric(namespace="AWS/EFS", metric_name="PercentIOLimit",
+                    dimensions_map={"FileSystemId": file_system.file_system_id},
+                    statistic="Maximum", period=Duration.minutes(1)),
+                threshold=profile.efs_io_limit_alarm_percent,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                evaluation_periods=5,
+                datapoints_to_alarm=3
+                ))
+
         ## Variables to pass to ECS task as environment variables
-        endpointaddress = data_base.db_instance_endpoint_address
-        endpointport = data_base.db_instance_endpoint_port
+        endpointaddress = data.db_address
+        endpointport = data.db_port
 
         ## Variables to pass to task as secrets
         dbpassword = ecs.Secret.from_secrets_manager(
             data_base.secret, field="password") # secret containing the password auto generated by ...from_generated_secret("moodle")
-        moodlepassword = secretsmanager.Secret(self, "Moodlepassword")
+        moodlepassword = data.moodlepassword
+
+        ## The first task installs Moodle and persists config.php on EFS, later tasks restore it and only
+        ## check for a database upgrade (see the config volume below). moodle_installed just tells the
+        ## stack the install is done, so tasks get a short health check grace period (profile.grace_period)
+
+        ## Environment variables for the Moodle container
+        # https://github.com/bitnami/containers/blob/main/bitnami/moodle/README.md#user-and-site-configuration
+        environment = {
+            'MOODLE_DATABASE_TYPE': 'mysqli',
+            'MOODLE_DATABASE_HOST': endpointaddress,
+            'MOODLE_DATABASE_PORT_NUMBER': endpointport,
+            'MOODLE_DATABASE_NAME': "moodledb",
+            'MOODLE_DATABASE_USER': "dbadmin",
+            'MOODLE_USERNAME': 'moodleadmin',
+            #'MOODLE_PASSWORD': 'nmoodle',
+            #'MOODLE_EMAIL': 'hello@example.com',
+            'MOODLE_SITE_NAME': 'Scottish Tech Army',
+            'MOODLE_SKIP_BOOTSTRAP': 'no',     # skipped by bitnami anyway once config.php is persisted
+            'MOODLE_SKIP_INSTALL': 'no',
+            'MOODLE_DATA_TO_PERSIST': 'config.php',    # code comes from the image, not EFS
+            'BITNAMI_DEBUG': 'true' if profile.bitnami_debug else 'false',
+            'PHP_UPLOAD_MAX_FILESIZE': '500M'}  # https://github.com/Scottish-Tech-Army/lms/issues/3
+        if profile.prebaked_image:
+            # node local caches on the task's ephemeral storage instead of EFS, set by config-extra.php in the image
+            environment['MOODLE_LOCALCACHEDIR'] = '/var/moodle/localcache'
+            environment['MOODLE_LOCALREQUESTDIR'] = '/var/moodle/request'
+        if data.db_reader_address:
+            # for $CFG->dboptions['readonly'], sends report and gradebook reads to the Aurora readers
+            environment['MOODLE_DATABASE_READONLY_HOST'] = data.db_reader_address
+
+        if data.redis_cluster:
+            environment['MOODLE_REDIS_HOST'] = data.redis_cluster.attr_primary_end_point_address
+            environment['MOODLE_REDIS_PORT'] = data.redis_cluster.attr_primary_end_point_port
+        if files_bucket:
+            environment['MOODLE_OBJECTFS_BUCKET'] = files_bucket.bucket_name
+            environment['MOODLE_OBJECTFS_REGION'] = self.region
+            environment['MOODLE_OBJECTFS_SIZE_THRESHOLD'] = str(profile.objectfs_size_threshold_kib * 1024)
+            environment['MOODLE_OBJECTFS_MINIMUM_AGE'] = str(profile.objectfs_minimum_age)
+            environment['MOODLE_OBJECTFS_PRESIGNED_MIN_SIZE'] = str(profile.objectfs_presigned_min_size_kib * 1024)
+            # read-through cache of files only in S3, on the task's ephemeral storage (cached_s3_file_system.php)
+            environment['MOODLE_OBJECTFS_CACHE_DIR'] = '/var/moodle/objectfs'
+            environment['MOODLE_OBJECTFS_CACHE_SIZE'] = str(profile.objectfs_cache_gib * 1024 ** 3)
+
+        ## OpenTelemetry tracing of web requests (enable_tracing), the PHP extension and SDK in the prebaked
+        ## image trace each request with its MySQL queries and outbound calls, and send the spans to the
+        ## collector sidecar added below. Workers aren't traced, they have no collector.
+        ## https://opentelemetry.io/docs/languages/php/sdk/#configuration
+        web_environment = dict(environment)
+        if profile.enable_tracing:
+            web_environment.update({
+                'OTEL_PHP_PREPEND': '/opt/otel-php/vendor/autoload.php',    # auto_prepend_file in php/opentelemetry.ini
+                'OTEL_PHP_AUTOLOAD_ENABLED': 'true',
+                'OTEL_PHP_EXPERIMENTAL_AUTO_ROOT_SPAN': 'true',     # one trace per request, not per query
+                'OTEL_SERVICE_NAME': f'moodle-{profile.name}',
+                'OTEL_RESOURCE_ATTRIBUTES': f'deployment.environment={profile.name}',
+                'OTEL_TRACES_EXPORTER': 'otlp',
+                'OTEL_METRICS_EXPORTER': 'none',
+                'OTEL_LOGS_EXPORTER': 'none',
+                'OTEL_EXPORTER_OTLP_PROTOCOL': 'http/protobuf',
+                'OTEL_EXPORTER_OTLP_ENDPOINT': 'http://localhost:4318',
+                'OTEL_PROPAGATORS': 'tracecontext,baggage',
+                'OTEL_TRACES_SAMPLER': 'parentbased_traceidratio',
+                'OTEL_TRACES_SAMPLER_ARG': str(profile.tracing_sample_rate)})
+
+        ## Image and secrets shared by the web and background worker tasks
+        ## The pre-baked image in moodle_image/ has the plugins, OPcache and php.ini settings built in
+        if profile.prebaked_image:
+            moodle_image = ecs.ContainerImage.from_asset(
+                os.path.join(os.path.dirname(__file__), "..", "moodle_image"),
+                build_args={"MOODLE_IMAGE": MOODLE_IMAGE},
+                platform=IMAGE_PLATFORMS[profile.cpu_architecture])
+        else:
+            moodle_image = ecs.ContainerImage.from_registry(MOODLE_IMAGE)
+        moodle_secrets = {"MOODLE_DATABASE_PASSWORD": dbpassword,
+                    "MOODLE_PASSWORD": ecs.Secret.from_secrets_manager(moodlepassword)}
 
         ## Task image options for Fargate Task, references bitmani/moodle docker hub image,
         ## defines the task to impliment the containers
         task_image_options=ecs_patterns.ApplicationLoadBalancedTaskImageOptions(
-            image=ecs.ContainerImage.from_registry("bitnami/moodle"),
+            image=moodle_image,
             container_name="MoodleContainer",
             container_port=8080,
-# https://github.com/bitnami/containers/blob/main/bitnami/moodle/README.md#user-and-site-configuration
-            environment={
-                'MOODLE_DATABASE_TYPE': 'mysqli',
-                'MOODLE_DATABASE_HOST': endpointaddress,
-                'MOODLE_DATABASE_PORT_NUMBER': endpointport,
-                'MOODLE_DATABASE_NAME': "moodledb",
-                'MOODLE_DATABASE_USER': "dbadmin",
-                'MOODLE_USERNAME': 'moodleadmin',
-                #'MOODLE_PASSWORD': 'nmoodle',
-                #'MOODLE_EMAIL': 'hello@example.com',
-                'MOODLE_SITE_NAME': 'Scottish Tech Army',
-                'MOODLE_SKIP_BOOTSTRAP': 'no',
-                'MOODLE_SKIP_INSTALL': 'no',
-                'BITNAMI_DEBUG': 'true',
-                'PHP_UPLOAD_MAX_FILESIZE': '500M'},  # https://github.com/Scottish-Tech-Army/lms/issues/3
-            secrets={"MOODLE_DATABASE_PASSWORD": dbpassword,
-                    "MOODLE_PASSWORD": ecs.Secret.from_secrets_manager(moodlepassword)}
+            environment=web_environment,
+            secrets=moodle_secrets
+            )
+
+        ## Graviton (ARM64) or x86 Fargate tasks, the bitnami image is built for both
+        runtime_platform = ecs.RuntimePlatform(
+            cpu_architecture=CPU_ARCHITECTURES[profile.cpu_architecture],
+            operating_system_family=ecs.OperatingSystemFamily.LINUX
             )
 
+        ## Capacity providers, a base of on-demand FARGATE tasks with FARGATE_SPOT for burst tasks
+        ## https://docs.aws.amazon.com/AmazonECS/latest/developerguide/fargate-capacity-providers.html
+        capacity_provider_strategies = None
+        if profile.fargate_spot_weight:     # x86 or Graviton tasks
+            capacity_provider_strategies = [
+                ecs.CapacityProviderStrategy(capacity_provider="FARGATE",
+                    base=profile.fargate_base,     # always on-demand, never interrupted
+                    weight=profile.fargate_weight),
+                ecs.CapacityProviderStrategy(capacity_provider="FARGATE_SPOT",
+                    weight=profile.fargate_spot_weight),
+                ]
+
         ## ECS container cluster for Moodle containers
-        cluster = ecs.Cluster(self, "Moodle-Cluster", vpc=vpc)
+        cluster = ecs.Cluster(self, "Moodle-Cluster", vpc=vpc,
+            enable_fargate_capacity_providers=True,
+            container_insights=profile.container_insights   # task level CPU, memory, network and task counts
+            )
 
         # Zone
-        zone = rt53.HostedZone.from_lookup(self, "TwilightZone", domain_name=props["domain_name"])
+        zone = hosted_zone(self, props)
+
+        ## With CloudFront in front, the ALB is reached on an origin subdomain and
+        ## the site domain points at the distribution
+        cdn_enabled = profile.enable_cdn
+        origin_domain_name = f'origin.{props["domain_name"]}' if cdn_enabled else None
 
-        # Cerificate        
+        # Cerificate
         test_cert = cert_man.Certificate(self, "Certificate",
-            domain_name=props["domain_name"],
-            certificate_name="Moodle LMS dev",  
+            domain_name=origin_domain_name or props["domain_name"],
+            # CloudFront forwards the viewer Host header, so the ALB also has to answer for the site domain
+            subject_alternative_names=[props["domain_name"]] if cdn_enabled else None,
+            certificate_name=f"Moodle LMS {profile.name}",
             validation=cert_man.CertificateValidation.from_dns(zone)
         )
 
@@ -131,199 +684,575 @@ class MoodleServerlessStackV2(Stack):
             "moodleFargateService",
             cluster=cluster,            # Required
             domain_zone=zone, 
+            domain_name=origin_domain_name,   # alias record for the ALB, only needed as the CloudFront origin
             redirect_http=True,
             certificate=test_cert,
-            cpu=256,                    # Default is 256
-            desired_count=1,            # Default is 1 suggested is 2
-            min_healthy_percent=50,     # Default is 50% of desired count
-            memory_limit_mib=1024,      # Default is 512
+            cpu=profile.cpu,                                    # Default is 256
+            desired_count=profile.desired_count,                # Default is 1 suggested is 2
+            min_healthy_percent=profile.min_healthy_percent,    # Default is 50% of desired count
+            memory_limit_mib=profile.memory_limit_mib,          # Default is 512
             public_load_balancer=True,  # Default is False
             assign_public_ip=False,     # deploy Fargate service to Private subnets else Public
             task_image_options=task_image_options,
-            health_check_grace_period=Duration.seconds(900), # Default is 60
+            runtime_platform=runtime_platform,
+            capacity_provider_strategies=capacity_provider_strategies,
+            health_check_grace_period=Duration.seconds(profile.grace_period),  # Default is 60, first install takes a long time
             platform_version=ecs.FargatePlatformVersion.VERSION1_4, # must specify VERSION1_4 for efs to mount
             )
 
+        ## Target group tuning
+        ## The default health check renders the front page every 30 seconds, new tasks get a full
+        ## share of requests while OPcache is still cold and stopping tasks drain for 300 seconds
+        ## https://docs.aws.amazon.com/elasticloadbalancing/latest/application/load-balancer-target-groups.html
+        health_check_path = profile.health_check_path or ("/healthcheck.php" if profile.prebaked_image else "/")
+        application.target_group.configure_health_check(
+            path=health_check_path,
+            interval=Duration.seconds(profile.health_check_interval),
+            timeout=Duration.seconds(profile.health_check_timeout),
+            healthy_threshold_count=profile.healthy_threshold,
+            unhealthy_threshold_count=profile.unhealthy_threshold,
+            healthy_http_codes="200"
+            )
+        application.target_group.set_attribute("deregistration_delay.timeout_seconds", str(profile.deregistration_delay))
+        ## The load balancer only allows slow start with round robin
+        if profile.least_outstanding_requests:
+            application.target_group.set_attribute("load_balancing.algorithm.type", "least_outstanding_requests")
+        elif profile.slow_start:
+            application.target_group.set_attribute("slow_start.duration_seconds", str(profile.slow_start))
+
+        ## ALB access logs, read with alb_latency.py to find the pages that use the most capacity
+        ## https://docs.aws.amazon.com/elasticloadbalancing/latest/application/load-balancer-access-logs.html
+        alb_log_bucket = None
+        if profile.alb_access_logs:
+            alb_log_bucket = s3.Bucket(self, "MoodleAlbLogs",
+                encryption=s3.BucketEncryption.S3_MANAGED,     # the only encryption ALB log delivery supports
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                enforce_ssl=True,
+                lifecycle_rules=[s3.LifecycleRule(expiration=Duration.days(profile.alb_access_log_days))],
+                removal_policy=RemovalPolicy.DESTROY,  # dev
+                auto_delete_objects=True
+                )
+            application.load_balancer.log_access_logs(alb_log_bucket, prefix="alb")
+
         ##  A volume for the containers in EFS
         volume_name = "moodleVolume"        ## referenced in mount point below
+        efs_volume_configuration = ecs.EfsVolumeConfiguration(
+            file_system_id=file_system.file_system_id,
+            authorization_config=ecs.AuthorizationConfig(
+                access_point_id=data.access_point.access_point_id,
+                iam="ENABLED"
+                ),
+            transit_encryption="ENABLED"   # enable encryption for EFS data in transit
+            )
         application.task_definition.add_volume(name=volume_name,
-            efs_volume_configuration=ecs.EfsVolumeConfiguration(
-                file_system_id=file_system.file_system_id,
-                authorization_config=ecs.AuthorizationConfig(
-                    access_point_id=access_point.access_point_id,
-                    iam="ENABLED"
-                    ),
-                transit_encryption="ENABLED"   # enable encryption for EFS data in transit
-                )
+            efs_volume_configuration=efs_volume_configuration
             )
 
-        ##  Mount point for volume
-        application.task_definition.default_container.add_mount_points(
-            ecs.MountPoint(
-                container_path="/bitnami",
-                read_only=False,
-                source_volume=volume_name  # must match name string in add_volume
-                )
+        ## A volume for bitnami's persisted Moodle directory, config.php only (MOODLE_DATA_TO_PERSIST)
+        ## bitnami installs Moodle when it is empty and restores config.php from it when it isn't
+        config_volume_name = "moodleConfigVolume"
+        config_volume_configuration = ecs.EfsVolumeConfiguration(
+            file_system_id=file_system.file_system_id,
+            authorization_config=ecs.AuthorizationConfig(
+                access_point_id=data.config_access_point.access_point_id,
+                iam="ENABLED"
+                ),
+            transit_encryption="ENABLED"
             )
+        application.task_definition.add_volume(name=config_volume_name,
+            efs_volume_configuration=config_volume_configuration
+            )
+
+        ## Fargate ephemeral storage for the container, holds the Moodle code and the local cache directories
+        ## Default is 20 GiB, the pattern has no property for it
+        ephemeral_storage_gib = profile.ephemeral_storage_gib
+        if ephemeral_storage_gib:
+            application.task_definition.node.default_child.add_property_override(
+                "EphemeralStorage.SizeInGiB", ephemeral_storage_gib)
+
+        ##  Mount point for volume, only moodledata is shared between tasks
+        moodle_mount_point = ecs.MountPoint(
+            container_path="/bitnami/moodledata",
+            read_only=False,
+            source_volume=volume_name  # must match name string in add_volume
+            )
+        config_mount_point = ecs.MountPoint(
+            container_path="/bitnami/moodle",
+            read_only=False,
+            source_volume=config_volume_name
+            )
+        application.task_definition.default_container.add_mount_points(moodle_mount_point, config_mount_point)
 
         ## Grant containers access to file system
-        application.task_definition.add_to_task_role_policy(iam.PolicyStatement(actions=
+        efs_client_policy = iam.PolicyStatement(actions=
                 ['elasticfilesystem:ClientWrite',
                 'elasticfilesystem:ClientRead'
                 ],
                 resources=[file_system.file_system_arn])
+        application.task_definition.add_to_task_role_policy(efs_client_policy)
+        if files_bucket:
+            files_bucket.grant_read_write(application.task_definition.task_role)
+
+        ## OpenTelemetry collector sidecar (enable_tracing), Moodle sends it spans on localhost
+        ## and it forwards them to X-Ray with the task role
+        ## https://aws-otel.github.io/docs/setup/ecs
+        if profile.enable_tracing:
+            collector = application.task_definition.add_container("OtelCollector",
+                image=ecs.ContainerImage.from_registry(profile.tracing_collector_image),
+                essential=False,    # Moodle keeps serving if the collector stops, only the traces are lost
+                memory_reservation_mib=profile.tracing_collector_memory,
+                environment={'AOT_CONFIG_CONTENT': TRACING_COLLECTOR_CONFIG.format(region=self.region)},
+                logging=ecs.LogDrivers.aws_logs(stream_prefix="OtelCollector")
+                )
+            application.task_definition.default_container.add_container_dependencies(
+                ecs.ContainerDependency(container=collector, condition=ecs.ContainerDependencyCondition.START))
+            application.task_definition.add_to_task_role_policy(iam.PolicyStatement(actions=
+                ['xray:PutTraceSegments',
+                'xray:PutTelemetryRecords'
+                ],
+                resources=["*"]))
+
+        ######################################
+        ##### Cron and ad-hoc task workers ###
+        ######################################
+
+        ## Moodle cron and ad-hoc tasks run in their own Fargate tasks so background work
+        ## doesn't compete with request handling. Same image, secrets and EFS volume as the web task,
+        ## the bitnami setup script restores config.php from EFS before running the CLI script.
+        ## The setup runs as root, the CLI script as daemon like the web server's PHP, so the cache and temp
+        ## files it leaves in moodledata on EFS can be replaced and purged by the web tasks
+        ## https://docs.moodle.org/en/Cron
+        cron_interval = profile.cron_interval_minutes
+        worker_commands = {
+            # keep picking up scheduled tasks until shortly before the next run starts
+            "MoodleCron": f"php /opt/bitnami/moodle/admin/cli/cron.php --keep-alive={cron_interval * 60 - 60}",
+            # long running ad-hoc task worker, restarts after an hour to pick up code and config changes
+            "MoodleAdhocTask": "php /opt/bitnami/moodle/admin/cli/adhoc_task.php --execute --keep-alive=3600",
+            }
+        adhoc_workers = profile.adhoc_workers   # number of ad-hoc task worker tasks running alongside cron
+        if not adhoc_workers:
+            del worker_commands["MoodleAdhocTask"]
+
+        worker_security_group = ec2.SecurityGroup(self, "MoodleWorkerSecurityGroup",
+            vpc=vpc,
+            description="Moodle cron and ad-hoc task workers"
             )
+        worker_task_definitions = {}
+        for worker_name, worker_command in worker_commands.items():
+            worker_task_definition = ecs.FargateTaskDefinition(self, f"{worker_name}TaskDef",
+                cpu=profile.worker_cpu,
+                memory_limit_mib=profile.worker_memory,
+                ephemeral_storage_gib=ephemeral_storage_gib,
+                runtime_platform=runtime_platform
+                )
+            worker_task_definition.add_volume(name=volume_name,
+                efs_volume_configuration=efs_volume_configuration
+                )
+            worker_task_definition.add_volume(name=config_volume_name,
+                efs_volume_configuration=config_volume_configuration
+                )
+            worker_container = worker_task_definition.add_container(f"{worker_name}Container",
+                image=moodle_image,
+                environment={**environment,
+                    'MOODLE_SKIP_BOOTSTRAP': 'yes'},   # the web task installs and upgrades Moodle, workers only restore it
+                secrets=moodle_secrets,
+                command=["/bin/bash", "-c",
+                    f"/opt/bitnami/scripts/moodle/setup.sh && /post-init.sh && gosu daemon {worker_command}"],
+                logging=ecs.LogDrivers.aws_logs(stream_prefix=worker_name)
+                )
+            # read-only, a worker that starts before the site is installed fails instead of persisting
+            # a config.php that would stop the web task installing Moodle
+            worker_container.add_mount_points(moodle_mount_point, ecs.MountPoint(
+                container_path="/bitnami/moodle",
+                read_only=True,
+                source_volume=config_volume_name
+                ))
+            worker_task_definition.add_to_task_role_policy(efs_client_policy)
+            if files_bucket:
+                files_bucket.grant_read_write(worker_task_definition.task_role)   # cron moves files to S3
+            worker_task_definitions[worker_name] = worker_task_definition
+
+        ## Cron on a schedule
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_ecs_patterns/ScheduledFargateTask.html
+        ecs_patterns.ScheduledFargateTask(self, "MoodleCronTask",
+            cluster=cluster,
+            scheduled_fargate_task_definition_options=ecs_patterns.ScheduledFargateTaskDefinitionOptions(
+                task_definition=worker_task_definitions["MoodleCron"]
+                ),
+            schedule=appscaling.Schedule.rate(Duration.minutes(cron_interval)),
+            security_groups=[worker_security_group],
+            subnet_selection=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
+            platform_version=ecs.FargatePlatformVersion.VERSION1_4, # must specify VERSION1_4 for efs to mount
+            )
+
+        ## Ad-hoc task workers as a long running service
+        if adhoc_workers:
+            ecs.FargateService(self, "MoodleAdhocTaskService",
+                cluster=cluster,
+                task_definition=worker_task_definitions["MoodleAdhocTask"],
+                desired_count=adhoc_workers,
+                security_groups=[worker_security_group],
+                assign_public_ip=False,
+                platform_version=ecs.FargatePlatformVersion.VERSION1_4, # must specify VERSION1_4 for efs to mount
+                )
 
         ## Connections - allows traffic between the default, automatically created security groups
+        ## The data stack's security groups are opened from this side (allow_to), so the ingress rules
+        ## are created in this stack and the data stack doesn't depend on it
         dbport = data_base.connections.default_port
         efsport = file_system.connections.default_port
-        data_base.connections.allow_default_port_from(application.service)
+        application.service.connections.allow_to_default_port(data_base)
         application.service.connections.allow_from(data_base, port_range=dbport)
         application.service.connections.allow_from(file_system, port_range=efsport)
-        file_system.connections.allow_default_port_from(application.service)
+        application.service.connections.allow_to_default_port(file_system)
+        worker_security_group.connections.allow_to_default_port(data_base)
+        worker_security_group.connections.allow_to_default_port(file_system)
+        if data.db_proxy:
+            application.service.connections.allow_to(data.db_proxy, port_range=dbport)
+            worker_security_group.connections.allow_to(data.db_proxy, port_range=dbport)
+        if data.redis:
+            application.service.connections.allow_to_default_port(data.redis)
+            worker_security_group.connections.allow_to_default_port(data.redis)
 
+        ## Autoscaling for the Fargate service
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_ecs/ScalableTaskCount.html
+        scale_in_cooldown = Duration.seconds(profile.scale_in_cooldown)
+        scale_out_cooldown = Duration.seconds(profile.scale_out_cooldown)
+        scaling = application.service.auto_scale_task_count(
+            min_capacity=profile.min_capacity,
+            max_capacity=profile.max_capacity
+            )
+        scaling.scale_on_cpu_utilization("CpuScaling",
+            target_utilization_percent=profile.scale_cpu_target,
+            scale_in_cooldown=scale_in_cooldown,
+            scale_out_cooldown=scale_out_cooldown
+            )
+        scaling.scale_on_memory_utilization("MemoryScaling",
+            target_utilization_percent=profile.scale_memory_target,
+            scale_in_cooldown=scale_in_cooldown,
+            scale_out_cooldown=scale_out_cooldown
+            )
+        scaling.scale_on_request_count("RequestCountScaling",
+            requests_per_target=profile.scale_requests_per_target, # ALB requests per task per minute
+            target_group=application.target_group,
+            scale_in_cooldown=scale_in_cooldown,
+            scale_out_cooldown=scale_out_cooldown
+            )
 
-      
-        ####################
-        ##### WAF stuff ####
-        ####################
+        ## Scheduled scaling windows, e.g. weekday peaks
+        for schedule in profile.scaling_schedules:
+            scaling.scale_on_schedule(schedule["name"],
+                schedule=appscaling.Schedule.cron(**schedule["cron"]),
+                min_capacity=schedule.get("min_capacity"),
+                max_capacity=schedule.get("max_capacity")
+                )
 
-        waf_rules = list()
-
-        """ 0. PHP Rule Set"""
-        """ Contains rules that block request patterns associated with exploiting vulnerabilities specific to the use of PHP,
-        including injection of unsafe PHP functions. This can help prevent exploits that allow an attacker to remotely execute code or commands """
-        aws_php_rule = waf.CfnWebACL.RuleProperty(
-            name='WafPHPRule',
-            priority=0,
-            override_action=waf.CfnWebACL.OverrideActionProperty(count={}),
-            statement=waf.CfnWebACL.StatementProperty(
-                managed_rule_group_statement=waf.CfnWebACL.ManagedRuleGroupStatementProperty(
-                    name='AWSManagedRulesPHPRuleSet',
-                    vendor_name='AWS',
-                    excluded_rules=[]
+
+        ##########################
+        ##### CloudFront CDN #####
+        ##########################
+
+        ## Theme CSS/JS, fonts and images are served from the edge instead of the PHP containers
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_cloudfront/Distribution.html
+        if cdn_enabled:
+            # CloudFront certificates have to be in us-east-1, made by the edge stack
+            cdn_cert = edge.certificate
+
+            ## Only CloudFront sends this header value, see the ALB web ACL below
+            origin_secret = secretsmanager.Secret(self, "MoodleOriginSecret",
+                description="X-Origin-Verify header value CloudFront sends to the Moodle load balancer",
+                generate_secret_string=secretsmanager.SecretStringGenerator(exclude_punctuation=True, password_length=32)
                 )
-            ),
-            visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
-                cloud_watch_metrics_enabled=True,
-                metric_name='aws_php',
-                sampled_requests_enabled=True,
-            )
-        )
-        waf_rules.append(aws_php_rule)
-
-        """ 1. AWS Common Rule Set """
-        """ Contains rules that are generally applicable to web applications.
-        This provides protection against exploitation of a wide range of vulnerabilities,
-        including those described in OWASP publications. """
-        aws_common_rule = waf.CfnWebACL.RuleProperty(
-            name='WafCommonRule',
-            priority=1,
-            override_action=waf.CfnWebACL.OverrideActionProperty(count={}),
-            statement=waf.CfnWebACL.StatementProperty(
-                managed_rule_group_statement=waf.CfnWebACL.ManagedRuleGroupStatementProperty(
-                    name='AWSManagedRulesCommonRuleSet',
-                    vendor_name='AWS',
-                    excluded_rules=[]
+            origin_verify = origin_secret.secret_value.unsafe_unwrap()
+            alb_origin = origins.HttpOrigin(origin_domain_name,
+                protocol_policy=cloudfront.OriginProtocolPolicy.HTTPS_ONLY,
+                custom_headers={ORIGIN_VERIFY_HEADER: origin_verify}
                 )
-            ),
-            visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
-                cloud_watch_metrics_enabled=True,
-                metric_name='aws_common',
-                sampled_requests_enabled=True,
-            )
-        )
-        waf_rules.append(aws_common_rule)
-
-        """ 2. SQL Injection """
-        """ Contains rules that allow you to block request patterns associated with exploitation of SQL databases,
-        like SQL injection attacks. This can help prevent remote injection of unauthorized queries """
-        aws_sqli_rule = waf.CfnWebACL.RuleProperty(
-            name='WafSQLiRule',
-            priority=2,
-            override_action=waf.CfnWebACL.OverrideActionProperty(count={}),
-            statement=waf.CfnWebACL.StatementProperty(
-                managed_rule_group_statement=waf.CfnWebACL.ManagedRuleGroupStatementProperty(
-                    name='AWSManagedRulesSQLiRuleSet',
-                    vendor_name='AWS',
-                    excluded_rules=[]
+
+            """ Theme and javascript urls carry the theme/js revision, so they can be cached for a long time.
+            The query string is part of the key for sites without slash arguments, no cookies or headers """
+            static_cache_policy = cloudfront.CachePolicy(self, "MoodleStaticCachePolicy",
+                comment="Moodle theme, javascript and font files",
+                default_ttl=Duration.days(1),
+                min_ttl=Duration.seconds(0),
+                max_ttl=Duration.days(365),
+                query_string_behavior=cloudfront.CacheQueryStringBehavior.all(),
+                cookie_behavior=cloudfront.CacheCookieBehavior.none(),
+                header_behavior=cloudfront.CacheHeaderBehavior.none(),
+                enable_accept_encoding_gzip=True,
+                enable_accept_encoding_brotli=True
                 )
-            ),
-            visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
-                cloud_watch_metrics_enabled=True,
-                metric_name='aws_sqli',
-                sampled_requests_enabled=True,
-            )
-        )
-        waf_rules.append(aws_sqli_rule)
-
-        """ 3. Linux Rule """
-        """ Contains rules that block request patterns associated with exploitation of vulnerabilities specific to Linux, including LFI attacks.
-        This can help prevent attacks that expose file contents or execute code for which the attacker should not have had access """
-        aws_linux_rule = waf.CfnWebACL.RuleProperty(
-            name='WafLinuxRule',
-            priority=3,
-            override_action=waf.CfnWebACL.OverrideActionProperty(count={}),
-            statement=waf.CfnWebACL.StatementProperty(
-                managed_rule_group_statement=waf.CfnWebACL.ManagedRuleGroupStatementProperty(
-                    name='AWSManagedRulesLinuxRuleSet',
-                    vendor_name='AWS',
-                    excluded_rules=[]
+
+            """ pluginfile.php checks access to course files, so the session cookie is part of the key and
+            nothing is cached unless Moodle sends cacheable headers (default TTL 0) """
+            pluginfile_cache_policy = cloudfront.CachePolicy(self, "MoodlePluginfileCachePolicy",
+                comment="Moodle pluginfile.php, cached per session when Moodle allows it",
+                default_ttl=Duration.seconds(0),
+                min_ttl=Duration.seconds(0),
+                max_ttl=Duration.days(1),
+                query_string_behavior=cloudfront.CacheQueryStringBehavior.all(),
+                cookie_behavior=cloudfront.CacheCookieBehavior.allow_list("MoodleSession"),
+                header_behavior=cloudfront.CacheHeaderBehavior.none(),
+                enable_accept_encoding_gzip=True,
+                enable_accept_encoding_brotli=True
                 )
-            ),
-            visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
-                cloud_watch_metrics_enabled=True,
-                metric_name='aws_linux',
-                sampled_requests_enabled=True,
-            )
-        )
-        waf_rules.append(aws_linux_rule)
-
-        """ 4. Bad Input Rule """
-        """ Contains rules that block request patterns associated with exploitation of vulnerabilities specific to Linux, including LFI attacks.
-        This can help prevent attacks that expose file contents or execute code for which the attacker should not have had access """
-        aws_bad_input_rule = waf.CfnWebACL.RuleProperty(
-            name='WafBadInputRule',
-            priority=4,
-            override_action=waf.CfnWebACL.OverrideActionProperty(count={}),
-            statement=waf.CfnWebACL.StatementProperty(
-                managed_rule_group_statement=waf.CfnWebACL.ManagedRuleGroupStatementProperty(
-                    name='AWSManagedRulesKnownBadInputsRuleSet',
-                    vendor_name='AWS',
-                    excluded_rules=[]
+
+            # Moodle builds urls from wwwroot, pass the site host through to the origin
+            host_header_policy = cloudfront.OriginRequestPolicy(self, "MoodleHostHeaderPolicy",
+                comment="Forward the viewer Host header to Moodle",
+                header_behavior=cloudfront.OriginRequestHeaderBehavior.allow_list("Host"),
+                query_string_behavior=cloudfront.OriginRequestQueryStringBehavior.none(),
+                cookie_behavior=cloudfront.OriginRequestCookieBehavior.none()
+                )
+
+            static_behavior = cloudfront.BehaviorOptions(
+                origin=alb_origin,
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                cache_policy=static_cache_policy,
+                origin_request_policy=host_header_policy,
+                compress=True
                 )
-            ),
-            visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
-                cloud_watch_metrics_enabled=True,
-                metric_name='aws_badinput',
-                sampled_requests_enabled=True,
-            )
-        )
-        waf_rules.append(aws_bad_input_rule)
 
-        """ Create the Web ACL for the WAF using the managed rule sets list (waf_rules)
-        in this case the Web ACL is "REGIONAL" as we are attaching it to the ALB """
+            distribution = cloudfront.Distribution(self, "MoodleDistribution",
+                comment="Moodle LMS",
+                domain_names=[props["domain_name"]],
+                certificate=cdn_cert,
+                web_acl_id=edge.web_acl.attr_arn,     # WAF rules, made by the edge stack
+                price_class=cloudfront.PriceClass.PRICE_CLASS_100,  # Europe and North America edge locations
+                http_version=cloudfront.HttpVersion.HTTP2_AND_3,
+                # Dynamic pages go straight through to the ALB
+                default_behavior=cloudfront.BehaviorOptions(
+                    origin=alb_origin,
+                    viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                    allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
+                    cache_policy=cloudfront.CachePolicy.CACHING_DISABLED,
+                    origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER
+                    ),
+                # Evaluated in order, most specific paths first
+                additional_behaviors={
+                    "/theme/styles.php*": static_behavior,
+                    "/lib/javascript.php*": static_behavior,
+                    "/lib/requirejs.php*": static_behavior,
+                    "/theme/*": static_behavior,
+                    "/pluginfile.php*": cloudfront.BehaviorOptions(
+                        origin=alb_origin,
+                        viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                        cache_policy=pluginfile_cache_policy,
+                        origin_request_policy=host_header_policy,
+                        compress=True
+                        )
+                    }
+                )
+
+            ## Site domain points at the distribution
+            for record_type, record_class in (("A", rt53.ARecord), ("AAAA", rt53.AaaaRecord)):
+                record_class(self, f"MoodleCdnAlias{record_type}",
+                    zone=zone,
+                    record_name=props["domain_name"],
+                    target=rt53.RecordTarget.from_alias(rt53_targets.CloudFrontTarget(distribution))
+                    )
+
+            CfnOutput(self, 'MOODLE-CDN-DOMAIN', value=distribution.distribution_domain_name)
+
+        ####################
+        ##### WAF stuff ####
+        ####################
+
+        ## Behind the CDN the rules are on CloudFront's web ACL in the edge stack, where every request comes
+        ## with the viewer's own IP. The ALB web ACL then only lets in requests with CloudFront's origin
+        ## secret header, so nothing can skip the rules by going to origin.<domain_name> directly
+        if cdn_enabled:
+            alb_default_action = waf.CfnWebACL.DefaultActionProperty(block={})
+            alb_rules = [waf.CfnWebACL.RuleProperty(
+                name="WafFromCloudFront",
+                priority=0,
+                action=waf.CfnWebACL.RuleActionProperty(allow={}),
+                statement=waf.CfnWebACL.StatementProperty(
+                    byte_match_statement=waf.CfnWebACL.ByteMatchStatementProperty(
+                        field_to_match=waf.CfnWebACL.FieldToMatchProperty(single_header={"Name": ORIGIN_VERIFY_HEADER.lower()}),
+                        positional_constraint="EXACTLY",
+                        search_string=origin_verify,
+                        text_transformations=[waf.CfnWebACL.TextTransformationProperty(priority=0, type="NONE")]
+                    )),
+                visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
+                    cloud_watch_metrics_enabled=True,
+                    metric_name="aws_from_cloudfront",
+                    sampled_requests_enabled=False     # the samples would show the secret
+                )
+            )]
+        else:
+            alb_default_action = waf.CfnWebACL.DefaultActionProperty(allow={})
+            alb_rules = waf_rules(profile)
+
+        """ Create the Web ACL for the WAF, in this case the Web ACL is "REGIONAL" as we are attaching it to the ALB """
         web_acl = waf.CfnWebACL(
             self, 'WebACL',
-            default_action=waf.CfnWebACL.DefaultActionProperty(
-                allow={}
-            ),
+            default_action=alb_default_action,
             scope="REGIONAL",
             visibility_config=waf.CfnWebACL.VisibilityConfigProperty(
                 cloud_watch_metrics_enabled=True,
                 metric_name='webACL',
                 sampled_requests_enabled=True
             ),
-            name=f'MoodleWAF-dev',
-            rules=waf_rules
+            name=f'MoodleWAF-{self.stack_name}',     # unique for each site, not each profile
+            rules=alb_rules
         )
 
         """ Associate it with the ALB arn. """
         waf.CfnWebACLAssociation(self, 'WAFACLAssociateALB',
                                  web_acl_arn=web_acl.attr_arn,
                                  resource_arn=application.load_balancer.load_balancer_arn)
-        
+
+        ## Performance dashboard and alarms, from the load balancer down to the NAT instances
+        ## https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_cloudwatch/Dashboard.html
+        one_minute = Duration.minutes(1)
+        five_minutes = Duration.minutes(5)
+        alb_metrics = application.load_balancer.metrics
+        response_times = [alb_metrics.target_response_time(statistic=percentile, period=one_minute, label=percentile)
+            for percentile in ("p50", "p95", "p99")]
+        error_rate = cloudwatch.MathExpression(
+            expression="100 * (FILL(target5xx, 0) + FILL(elb5xx, 0)) / requests",
+            using_metrics={
+                "requests": alb_metrics.request_count(period=one_minute),
+                "target5xx": alb_metrics.http_code_target(elbv2.HttpCodeTarget.TARGET_5XX_COUNT, period=one_minute),
+                "elb5xx": alb_metrics.http_code_elb(elbv2.HttpCodeElb.ELB_5XX_COUNT, period=one_minute)
+                },
+            label="5xx % of requests",
+            period=one_minute
+            )
+        service_cpu = application.service.metric_cpu_utilization(period=one_minute)
+        service_memory = application.service.metric_memory_utilization(period=one_minute)
+        db_cpu = data_base.metric_cpu_utilization(period=one_minute)
+        db_latency = [data_base.metric(name, statistic="Average", period=one_minute, label=name)
+            for name in ("ReadLatency", "WriteLatency")]
+        efs_io = cloudwatch.MathExpression(
+            expression="io / PERIOD(io) / 1048576",
+            using_metrics={"io": cloudwatch.Metric(namespace="AWS/EFS", metric_name="MeteredIOBytes",
+                dimensions_map={"FileSystemId": file_system.file_system_id}, statistic="Sum", period=one_minute)},
+            label="Metered throughput MiB/s",
+            period=one_minute
+            )
+        efs_io_limit = cloudwatch.Metric(namespace="AWS/EFS", metric_name="PercentIOLimit",
+            dimensions_map={"FileSystemId": file_system.file_system_id}, statistic="Maximum", period=one_minute)
+        nat_instance_ids = [gateway.gateway_id for gateway in network.nat_gateway_provider.configured_gateways]
+        nat_network = [cloudwatch.Metric(namespace="AWS/EC2", metric_name=name, dimensions_map={"InstanceId": instance_id},
+                statistic="Sum", period=five_minutes, label=f"{name} {instance_id}")
+            for instance_id in nat_instance_ids for name in ("NetworkIn", "NetworkOut")]
+        nat_cpu_credits = [cloudwatch.Metric(namespace="AWS/EC2", metric_name="CPUCreditBalance",
+                dimensions_map={"InstanceId": instance_id}, statistic="Minimum", period=five_minutes, label=instance_id)
+            for instance_id in nat_instance_ids]   # burstable NAT instances throttle when this runs out
+
+        alarms.append(cloudwatch.Alarm(self, "MoodleResponseTimeAlarm",
+            alarm_description="Moodle p95 response time is high",
+            metric=response_times[1],
+            threshold=profile.alarm_response_time_p95,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+            evaluation_periods=5,
+            datapoints_to_alarm=3,
+            treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING
+            ))
+        alarms.append(cloudwatch.Alarm(self, "Moodle5xxAlarm",
+            alarm_description="Moodle is returning server errors",
+            metric=error_rate,
+            threshold=profile.alarm_5xx_percent,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+            evaluation_periods=5,
+            datapoints_to_alarm=3,
+            treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING
+            ))
+        alarms.append(cloudwatch.Alarm(self, "MoodleUnhealthyTasksAlarm",
+            alarm_description="Moodle tasks are failing load balancer health checks",
+            metric=application.target_group.metrics.unhealthy_host_count(statistic="Maximum", period=one_minute),
+            threshold=0,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+            evaluation_periods=5,
+            datapoints_to_alarm=3
+            ))
+        alarms.append(cloudwatch.Alarm(self, "MoodleServiceCpuAlarm",
+            alarm_description="Moodle tasks are short of CPU, check the service is not at max_capacity",
+            metric=service_cpu,
+            threshold=profile.alarm_cpu_percent,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+            evaluation_periods=10,
+            datapoints_to_alarm=8
+            ))
+        alarms.append(cloudwatch.Alarm(self, "MoodleDbCpuAlarm",
+            alarm_description="Moodle database CPU is high",
+            metric=db_cpu,
+            threshold=profile.alarm_db_cpu_percent,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+            evaluation_periods=10,
+            datapoints_to_alarm=8
+            ))
+        if profile.container_insights:
+            running_tasks = cloudwatch.Metric(namespace="ECS/ContainerInsights", metric_name="RunningTaskCount",
+                dimensions_map={"ClusterName": cluster.cluster_name, "ServiceName": application.service.service_name},
+                statistic="Maximum", period=five_minutes)
+            alarms.append(cloudwatch.Alarm(self, "MoodleMaxCapacityAlarm",
+                alarm_description="Moodle has been at max_capacity for 15 minutes, autoscaling can't add more tasks",
+                metric=running_tasks,
+                threshold=profile.max_capacity,
+                comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+                evaluation_periods=3
+                ))
+        for alarm in alarms:
+            alarm.add_alarm_action(cloudwatch_actions.SnsAction(alarm_topic))
+            alarm.add_ok_action(cloudwatch_actions.SnsAction(alarm_topic))
+
+        dashboard = cloudwatch.Dashboard(self, "MoodleDashboard",
+            dashboard_name=f"{self.stack_name}-{self.region}"    # dashboards are per account, one per site and region
+            )
+        dashboard.add_widgets(cloudwatch.AlarmStatusWidget(title="Alarms", alarms=alarms, width=24, height=3))
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(title="Response time (s)", left=response_times, width=12),
+            cloudwatch.GraphWidget(title="Server errors", left=[error_rate], width=12)
+            )
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(title="Web service CPU / memory %", left=[service_cpu, service_memory],
+                right=[running_tasks] if profile.container_insights else [], width=12),
+            cloudwatch.GraphWidget(title="Database CPU % / connections", left=[db_cpu],
+                right=[data_base.metric_database_connections(period=one_minute)], width=12)
+            )
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(title="Database latency (s)", left=db_latency, width=12),
+            cloudwatch.GraphWidget(title="EFS throughput / I/O limit %", left=[efs_io], right=[efs_io_limit], width=12)
+            )
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(title="NAT instance network (bytes)", left=nat_network, right=nat_cpu_credits, width=24)
+            )
 
         ## Outputs, prints output values
         CfnOutput(self, 'MOODLE-USERNAME', value='moodleadmin')
-        CfnOutput(self, 'MOODLE-PASSWORD-ARN', value=moodlepassword.secret_arn)
\ No newline at end of file
+        CfnOutput(self, 'MOODLE-PASSWORD-ARN', value=moodlepassword.secret_arn)
+        CfnOutput(self, 'MOODLE-ALARM-TOPIC-ARN', value=alarm_topic.topic_arn)
+        if alb_log_bucket:
+            CfnOutput(self, 'MOODLE-ALB-LOG-BUCKET', value=alb_log_bucket.bucket_name)
+        if files_bucket:
+            CfnOutput(self, 'MOODLE-FILES-BUCKET', value=files_bucket.bucket_name)
+
+class MoodleStacks(NamedTuple):
+    network: MoodleNetworkStack
+    data: MoodleDataStack
+    app: MoodleServerlessStackV2
+    edge: Optional[MoodleEdgeStack] = None     # None without the CDN
+
+
+def moodle_stacks(scope: Construct, construct_id: str, props: dict, profile: MoodleProfile = None, **kwargs) -> MoodleStacks:
+    """ The network, data and app stacks of one Moodle site, <construct_id>-Network, <construct_id>-Data
+    and <construct_id>, plus <construct_id>-Edge in us-east-1 for CloudFront. The app stack changes most often
+    and can be deployed by itself with `cdk deploy --exclusively <construct_id>`, the others are only updated
+    when they change """
+    profile = profile or MoodleProfile()
+    network = MoodleNetworkStack(scope, f"{construct_id}-Network", profile=profile, **kwargs)
+    data = MoodleDataStack(scope, f"{construct_id}-Data", network=network, profile=profile, **kwargs)
+    edge = None
+    if profile.enable_cdn:
+        # Same account, the stack regions have to be known for cross region references
+        env = kwargs.get("env")
+        edge = MoodleEdgeStack(scope, f"{construct_id}-Edge", props=props, profile=profile,
+            **{**kwargs, "env": Environment(account=env.account if env else None, region="us-east-1")},
+            cross_region_references=True)
+        kwargs = {**kwargs, "cross_region_references": True}
+    app = MoodleServerlessStackV2(scope, construct_id, props=props, network=network, data=data, profile=profile,
+        edge=edge, **kwargs)
+    return MoodleStacks(network, data, app, edge)
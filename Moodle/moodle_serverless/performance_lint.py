@@ -0,0 +1,136 @@
+""" Performance lint for the Moodle stacks.
+
+PerformanceLint is a CDK Aspect that looks over the synthesized resources for settings that
+have caused capacity problems before, e.g. a single task with no autoscaling or debug logging
+left on. Each finding is reported against the resource as a warning, or as an error that stops
+`cdk synth` and `cdk deploy`, as set by the profile's lint_errors and lint_ignore.
+
+    for stack in filter(None, moodle_stacks(app, "MoodleServerlessStackV2", props=props, profile=profile)):
+        Aspects.of(stack).add(PerformanceLint(profile))
+"""
+import re
+
+import jsii
+from aws_cdk import (
+    Annotations,
+    IAspect,
+    Stack,
+    aws_applicationautoscaling as appscaling,
+    aws_cloudfront as cloudfront,
+    aws_ec2 as ec2,
+    aws_ecs as ecs,
+    aws_efs as efs,
+    aws_rds as rds,
+)
+from constructs import IConstruct
+
+from .profiles import LINT_MAX_GRACE_PERIOD, MoodleProfile
+
+## db.t3, db.t4g... instances run on CPU credits
+BURSTABLE_DB_CLASS = re.compile(r"^db\.t\d")
+DEBUG_VALUES = ("true", "1", "yes", "on")
+
+
+def _resolve(resource, value):
+    """ A property from a typed L1 getter with its tokens resolved, as it will be in the template """
+    return Stack.of(resource).resolve(value)
+
+
+@jsii.implements(IAspect)
+class PerformanceLint:
+    """ Reports performance anti-patterns in the constructs it visits """
+
+    def __init__(self, profile: MoodleProfile = None) -> None:
+        self.profile = profile or MoodleProfile()
+
+    def visit(self, node: IConstruct) -> None:
+        if isinstance(node, ecs.CfnService):
+            self._check_service(node)
+        elif isinstance(node, ecs.CfnTaskDefinition):
+            self._check_task_definition(node)
+        elif isinstance(node, rds.CfnDBInstance):
+            self._check_db_instance(node)
+        elif isinstance(node, efs.CfnFileSystem):
+            self._check_file_system(node)
+        elif isinstance(node, (ec2.CfnNatGateway, ec2.CfnInstance)):
+            self._check_nat(node)
+
+    def report(self, node: IConstruct, check: str, message: str) -> None:
+        if check in self.profile.lint_ignore:
+            return
+        message = f"[{check}] {message} (profile {self.profile.name})"
+        if check in self.profile.lint_errors:
+            Annotations.of(node).add_error(message)
+        else:
+            Annotations.of(node).add_warning(message)
+
+    def _check_service(self, service: ecs.CfnService) -> None:
+        if not _resolve(service, service.load_balancers):
+            return      # background workers, nobody waits for them
+        desired_count = _resolve(service, service.desired_count)
+        if (1 if desired_count is None else desired_count) < 2 and not self._autoscaled(service):
+            self.report(service, "single_task",
+                "The web service runs a single task with no autoscaling, every request waits on one task "
+                "and the site is down while it is replaced. Set desired_count or max_capacity to 2 or more")
+        # the service sets its grace period lazily, which the L1 getter can't return, so it comes from the profile
+        grace_period = self.profile.grace_period
+        if grace_period > LINT_MAX_GRACE_PERIOD:
+            self.report(service, "long_grace_period",
+                f"Health check grace period is {grace_period} seconds, broken tasks keep taking requests for that long. "
+                "Set moodle_installed once Moodle is installed, or a shorter health_check_grace_period")
+
+    def _autoscaled(self, service: ecs.CfnService) -> bool:
+        stack = Stack.of(service)
+        logical_id = stack.get_logical_id(service)
+        for target in stack.node.find_all():
+            if isinstance(target, appscaling.CfnScalableTarget):
+                if (_resolve(target, target.max_capacity) >= 2
+                        and logical_id in str(_resolve(target, target.resource_id))):
+                    return True
+        return False
+
+    def _check_task_definition(self, task_definition: ecs.CfnTaskDefinition) -> None:
+        for container in _resolve(task_definition, task_definition.container_definitions) or []:
+            environment = {variable["name"]: variable.get("value") for variable in container.get("environment", [])}
+            for name, value in environment.items():
+                if name.upper().endswith("DEBUG") and str(value).lower() in DEBUG_VALUES:
+                    self.report(task_definition, "debug_env",
+                        f"{name}={value} in {container['name']}, debug logging slows every request and fills the logs. "
+                        "Set bitnami_debug to false")
+            if container["name"] == "MoodleContainer":
+                # only the prebaked image, built from an asset rather than pulled by name, has the
+                # config-extra.php and tool_forcedcache that point Moodle at MOODLE_REDIS_HOST
+                prebaked = not isinstance(container.get("image"), str)
+                if "MOODLE_REDIS_HOST" not in environment or not prebaked:
+                    self.report(task_definition, "no_cache",
+                        "No Redis cache in use, Moodle sessions and the MUC application cache are on the database and EFS. "
+                        "Set enable_redis with prebaked_image")
+                stack = Stack.of(task_definition)
+                if not any(isinstance(child, cloudfront.CfnDistribution) for child in stack.node.find_all()):
+                    self.report(task_definition, "no_cache",
+                        "No CloudFront distribution, theme, javascript and file requests all reach the tasks. "
+                        "Set enable_cdn")
+
+    def _check_db_instance(self, db_instance: rds.CfnDBInstance) -> None:
+        db_class = _resolve(db_instance, db_instance.db_instance_class) or ""
+        if BURSTABLE_DB_CLASS.match(db_class):
+            self.report(db_instance, "burstable_db",
+                f"{db_class} is a burstable class, the database slows to its baseline CPU once the credits run out. "
+                "Use an m or r class, or db_engine aurora-serverless")
+
+    def _check_file_system(self, file_system: efs.CfnFileSystem) -> None:
+        if (_resolve(file_system, file_system.throughput_mode) or "bursting") == "bursting":
+            self.report(file_system, "bursting_efs",
+                "EFS is in bursting throughput mode, throughput drops to the baseline for the stored size once the "
+                "burst credits run out. Set efs_throughput_mode to ELASTIC")
+
+    def _check_nat(self, node) -> None:
+        if isinstance(node, ec2.CfnInstance) and _resolve(node, node.source_dest_check) is not False:
+            return      # not a NAT instance
+        nats = [child for child in Stack.of(node).node.find_all()
+            if isinstance(child, ec2.CfnNatGateway)
+                or (isinstance(child, ec2.CfnInstance) and _resolve(child, child.source_dest_check) is False)]
+        if len(nats) == 1:
+            self.report(node, "single_nat",
+                "All outbound traffic from the private subnets goes through one NAT, it limits throughput and "
+                "the tasks lose outbound access if its zone fails. Set nat_gateways to 2 or more")
@@ -0,0 +1,463 @@
+""" Sizing profiles for the Moodle stack.
+
+A profile holds every capacity setting of MoodleServerlessStackV2, so a deployment can be
+sized without editing the stack. Named presets cover a cheap dev deployment up to a
+high-load production deployment, and any setting can be overridden from cdk context, e.g.
+
+    "stacks": {
+        "MoodleServerlessStackV2": {"profile": "dev"},
+        "MoodleServerlessStackProd": {"profile": "prod", "domain_name": "lms.example.org", "max_capacity": 30}
+    }
+"""
+from dataclasses import dataclass, fields, replace
+from typing import Optional, Tuple
+
+
+## Default weekday scaling windows, times are UTC (Application Auto Scaling has no time zones here)
+## Raise the floor before learners arrive on weekdays and drop it again in the evening. These are plain
+## weekday crons, they also run in the holidays, set scaling_schedules for the term dates if that matters
+DEFAULT_SCALING_SCHEDULES = (
+    {"name": "WeekdayPeakStart", "cron": {"minute": "30", "hour": "7", "week_day": "MON-FRI"},
+        "min_capacity": 2},
+    {"name": "WeekdayPeakEnd", "cron": {"minute": "0", "hour": "18", "week_day": "MON-FRI"},
+        "min_capacity": 1},
+    )
+
+## WAF rules in priority order, lowest first
+## "rate" rules block a client IP that sends more than "limit" requests in 5 minutes, optionally only
+## counting requests to a "path" prefix and/or with a "method". Schools often put a whole class behind
+## one IP, so the limits are for that rather than for a single learner.
+## "managed" rules are AWS managed rule groups, "count" only reports what they would block.
+## https://docs.aws.amazon.com/waf/latest/developerguide/aws-managed-rule-groups-list.html
+DEFAULT_WAF_RULES = (
+    # Password guessing, a class logging in at once is well under this
+    {"name": "WafLoginRateLimit", "priority": 0, "type": "rate", "limit": 100,
+        "path": "/login/index.php", "method": "POST", "action": "block"},
+    # Web service and mobile app API calls
+    {"name": "WafWebserviceRateLimit", "priority": 1, "type": "rate", "limit": 1500,
+        "path": "/webservice/", "action": "block"},
+    # Any other request, scrapers and floods
+    {"name": "WafRateLimit", "priority": 2, "type": "rate", "limit": 6000, "action": "block"},
+    # Request patterns exploiting PHP, including injection of unsafe PHP functions
+    {"name": "WafPHPRule", "priority": 10, "type": "managed", "rule_group": "AWSManagedRulesPHPRuleSet",
+        "metric": "aws_php", "action": "count"},
+    # Generally applicable rules, including those described in OWASP publications
+    {"name": "WafCommonRule", "priority": 11, "type": "managed", "rule_group": "AWSManagedRulesCommonRuleSet",
+        "metric": "aws_common", "action": "count"},
+    # SQL injection
+    {"name": "WafSQLiRule", "priority": 12, "type": "managed", "rule_group": "AWSManagedRulesSQLiRuleSet",
+        "metric": "aws_sqli", "action": "count"},
+    # Linux specific vulnerabilities including LFI
+    {"name": "WafLinuxRule", "priority": 13, "type": "managed", "rule_group": "AWSManagedRulesLinuxRuleSet",
+        "metric": "aws_linux", "action": "count"},
+    # Request patterns known to be invalid or associated with exploits
+    {"name": "WafBadInputRule", "priority": 14, "type": "managed", "rule_group": "AWSManagedRulesKnownBadInputsRuleSet",
+        "metric": "aws_badinput", "action": "count"},
+    )
+
+## Bot Control, added to the rules with waf_bot_control, it is charged per request
+WAF_BOT_CONTROL_RULE = {"name": "WafBotControlRule", "priority": 20, "type": "managed",
+    "rule_group": "AWSManagedRulesBotControlRuleSet", "metric": "aws_botcontrol", "action": "block"}
+WAF_RULE_TYPES = ("rate", "managed")
+WAF_ACTIONS = ("block", "count")
+WAF_MIN_RATE_LIMIT = 100
+
+## Fargate CPU units and the memory sizes (MiB) allowed with them
+## https://docs.aws.amazon.com/AmazonECS/latest/developerguide/task-cpu-memory-error.html
+FARGATE_MEMORY = {
+    256: [512, 1024, 2048],
+    512: list(range(1024, 4096 + 1, 1024)),
+    1024: list(range(2048, 8192 + 1, 1024)),
+    2048: list(range(4096, 16384 + 1, 1024)),
+    4096: list(range(8192, 30720 + 1, 1024)),
+    8192: list(range(16384, 61440 + 1, 4096)),
+    16384: list(range(32768, 122880 + 1, 8192)),
+    }
+
+DB_ENGINES = ("instance", "aurora-serverless")
+DB_STORAGE_TYPES = ("GP2", "GP3", "IO1")
+DB_LOG_EXPORTS = ("error", "general", "slowquery")
+## RDS for MySQL storage below this is striped over fewer volumes, gp3 IOPS and throughput are fixed at the baseline
+DB_GP3_PROVISIONED_MIN_STORAGE = 400
+CPU_ARCHITECTURE_NAMES = ("X86_64", "ARM64")
+EFS_THROUGHPUT_MODES = ("BURSTING", "ELASTIC", "PROVISIONED")
+EFS_PERFORMANCE_MODES = ("GENERAL_PURPOSE", "MAX_IO")
+EFS_LIFECYCLE_POLICIES = ("NONE", "AFTER_1_DAY", "AFTER_7_DAYS", "AFTER_14_DAYS", "AFTER_30_DAYS",
+    "AFTER_60_DAYS", "AFTER_90_DAYS")
+EFS_OUT_OF_IA_POLICIES = ("NONE", "AFTER_1_ACCESS")
+
+## Checks made by the performance lint at synth, see performance_lint.py
+LINT_CHECKS = ("single_task", "burstable_db", "bursting_efs", "no_cache", "long_grace_period", "debug_env", "single_nat")
+LINT_MAX_GRACE_PERIOD = 300     # seconds
+
+
+@dataclass(frozen=True)
+class MoodleProfile:
+    """ Capacity settings for one Moodle deployment, the defaults are the dev profile """
+    name: str = "dev"
+
+    ## Network
+    max_azs: int = 2
+    nat_instance_type: str = "t3.nano"
+    nat_gateways: int = 1
+    vpc_interface_endpoints: bool = True
+    vpc_efs_endpoint: bool = False
+
+    ## Fargate web service
+    cpu: int = 256
+    memory_limit_mib: int = 1024
+    desired_count: int = 1
+    min_healthy_percent: int = 50
+    cpu_architecture: str = "X86_64"
+    fargate_base: int = 1
+    fargate_weight: int = 1
+    fargate_spot_weight: int = 0
+    ephemeral_storage_gib: Optional[int] = None     # Fargate default is 20
+    prebaked_image: bool = False
+    moodle_installed: bool = False      # only shortens the grace period, tasks find the install on EFS themselves
+    health_check_grace_period: Optional[int] = None  # seconds, 900 for the first install, 120 after
+    bitnami_debug: bool = True
+
+    ## Load balancer target group
+    health_check_path: Optional[str] = None     # /healthcheck.php in the prebaked image, / otherwise
+    health_check_interval: int = 15     # seconds
+    health_check_timeout: int = 5       # seconds
+    healthy_threshold: int = 2
+    unhealthy_threshold: int = 3
+    slow_start: int = 0                 # seconds new tasks take to ramp up to a full share of requests, round robin only
+    deregistration_delay: int = 30      # seconds to drain requests from tasks that are stopping
+    least_outstanding_requests: bool = True     # route to the task with the fewest requests in flight, not round robin
+    alb_access_logs: bool = True
+    alb_access_log_days: int = 30       # days access logs are kept in S3
+
+    ## Autoscaling
+    min_capacity: int = 1
+    max_capacity: int = 4
+    scale_cpu_target: int = 60
+    scale_memory_target: int = 75
+    scale_requests_per_target: int = 250    # ALB requests per task per minute
+    scale_in_cooldown: int = 300
+    scale_out_cooldown: int = 60
+    scaling_schedules: Tuple[dict, ...] = DEFAULT_SCALING_SCHEDULES
+
+    ## Cron and ad-hoc task workers
+    cron_interval_minutes: int = 5
+    adhoc_workers: int = 0
+    worker_cpu: int = 256
+    worker_memory: int = 1024
+
+    ## Database
+    db_engine: str = "instance"
+    db_instance_type: str = "t4g.micro"
+    db_allocated_storage: int = 5       # GiB
+    db_max_allocated_storage: int = 20  # GiB
+    db_storage_type: str = "GP3"
+    db_iops: Optional[int] = None                   # gp3 baseline is 3000, provisioning more needs 400 GiB or more
+    db_storage_throughput: Optional[int] = None     # MiB/s, gp3 baseline is 125, as for db_iops
+    db_buffer_pool_percent: int = 75    # InnoDB buffer pool share of instance memory, Aurora sizes it with the ACUs
+    db_max_connections: Optional[int] = None        # default worked out by RDS from instance memory
+    db_tmp_table_size_mib: int = 64     # in-memory temporary tables before they go to disk
+    db_long_query_time: float = 1       # seconds, slower queries go to the slow query log
+    db_performance_insights: bool = False           # not available on micro and small MySQL instances
+    db_log_exports: Tuple[str, ...] = ("error", "slowquery")
+    db_log_retention: str = "ONE_MONTH"             # CloudWatch Logs RetentionDays name
+    db_readers: int = 1
+    db_min_acu: float = 0.5
+    db_max_acu: float = 4
+    enable_db_proxy: bool = True
+    db_proxy_max_connections_percent: int = 90
+    db_proxy_max_idle_connections_percent: int = 50
+    db_proxy_idle_client_timeout: int = 1800
+    db_proxy_borrow_timeout: int = 120
+
+    ## Caches
+    enable_redis: bool = False      # needs prebaked_image
+    redis_node_type: str = "cache.t4g.micro"
+    redis_nodes: int = 1
+    enable_cdn: bool = True
+
+    ## S3 object storage for large files (tool_objectfs)
+    enable_objectfs: bool = False
+    objectfs_size_threshold_kib: int = 1024     # files bigger than this move to S3, smaller ones stay on EFS
+    objectfs_minimum_age: int = 86400           # seconds before a file moves, recent uploads are often read again
+    objectfs_presigned_min_size_kib: int = 1024     # files bigger than this are downloaded from S3 directly
+    objectfs_cache_gib: int = 5     # each task's cache of files read from S3, on its ephemeral storage, 0 turns it off
+
+    ## EFS
+    efs_throughput_mode: str = "BURSTING"
+    efs_provisioned_throughput_mibps: int = 10
+    efs_performance_mode: str = "GENERAL_PURPOSE"
+    efs_lifecycle_policy: str = "AFTER_14_DAYS"
+    efs_out_of_infrequent_access_policy: str = "AFTER_1_ACCESS"
+    efs_burst_credit_alarm_gib: int = 512
+    efs_io_limit_alarm_percent: int = 90
+
+    ## WAF
+    waf_rules: Tuple[dict, ...] = DEFAULT_WAF_RULES
+    waf_bot_control: bool = False
+    waf_count_only: bool = False        # every rule only counts, e.g. while a load test runs from one machine
+
+    ## Monitoring, alarms are sent to an SNS topic
+    container_insights: bool = True
+    alarm_email: Optional[str] = None           # subscribed to the alarm topic when set
+    alarm_response_time_p95: float = 2          # seconds
+    alarm_5xx_percent: float = 5                # of load balancer requests
+    alarm_cpu_percent: int = 90                 # web service average, autoscaling should keep it lower
+    alarm_db_cpu_percent: int = 80
+
+    ## Tracing, an OpenTelemetry collector sidecar in the web task sends PHP request traces to X-Ray
+    enable_tracing: bool = False
+    tracing_sample_rate: float = 0.05       # share of requests traced, requests traced upstream keep their decision
+    tracing_collector_image: str = "public.ecr.aws/aws-observability/aws-otel-collector:latest"
+    tracing_collector_memory: int = 128     # MiB reserved for the collector out of memory_limit_mib
+
+    ## Performance lint, checks are reported as warnings unless they are listed here
+    lint_errors: Tuple[str, ...] = ()       # fail the synth
+    lint_ignore: Tuple[str, ...] = ()       # not reported
+
+    def __post_init__(self):
+        # Names from cdk context may be in any case
+        for name in ("cpu_architecture", "db_storage_type", "db_log_retention", "efs_throughput_mode", "efs_performance_mode",
+                     "efs_lifecycle_policy", "efs_out_of_infrequent_access_policy"):
+            object.__setattr__(self, name, getattr(self, name).upper())
+        object.__setattr__(self, "scaling_schedules", tuple(self.scaling_schedules))
+        object.__setattr__(self, "db_log_exports", tuple(self.db_log_exports))
+        object.__setattr__(self, "waf_rules", tuple(self.waf_rules))
+        object.__setattr__(self, "lint_errors", tuple(self.lint_errors))
+        object.__setattr__(self, "lint_ignore", tuple(self.lint_ignore))
+        self.validate()
+
+    def validate(self) -> None:
+        """ Raise ValueError for settings that can't be deployed """
+        def check(condition, message):
+            if not condition:
+                raise ValueError(f'Profile "{self.name}": {message}')
+
+        def check_choice(setting, choices):
+            check(getattr(self, setting) in choices,
+                f'{setting} "{getattr(self, setting)}" should be one of {", ".join(choices)}')
+
+        def check_fargate_size(cpu_setting, memory_setting):
+            cpu, memory = getattr(self, cpu_setting), getattr(self, memory_setting)
+            check(cpu in FARGATE_MEMORY,
+                f'{cpu_setting} {cpu} is not a Fargate size, use one of {", ".join(map(str, FARGATE_MEMORY))}')
+            check(memory in FARGATE_MEMORY[cpu],
+                f'{memory_setting} {memory} MiB is not allowed with {cpu} CPU units')
+
+        check(self.max_azs >= 2, "max_azs should be at least 2, the load balancer needs two zones")
+        check(1 <= self.nat_gateways <= self.max_azs, "nat_gateways should be between 1 and max_azs")
+
+        check_fargate_size("cpu", "memory_limit_mib")
+        check_fargate_size("worker_cpu", "worker_memory")
+        check_choice("cpu_architecture", CPU_ARCHITECTURE_NAMES)
+        check(self.fargate_spot_weight >= 0 and self.fargate_weight >= 0 and self.fargate_base >= 0,
+            "fargate_base and the capacity provider weights can't be negative")
+        check(self.ephemeral_storage_gib is None or 21 <= self.ephemeral_storage_gib <= 200,
+            "ephemeral_storage_gib should be between 21 and 200")
+
+        check(self.health_check_path is None or self.health_check_path.startswith("/"),
+            "health_check_path should start with /")
+        check(5 <= self.health_check_interval <= 300, "health_check_interval should be between 5 and 300 seconds")
+        check(2 <= self.health_check_timeout < self.health_check_interval,
+            "health_check_timeout should be at least 2 seconds and less than health_check_interval")
+        check(2 <= self.healthy_threshold <= 10 and 2 <= self.unhealthy_threshold <= 10,
+            "healthy_threshold and unhealthy_threshold should be between 2 and 10")
+        check(self.slow_start == 0 or 30 <= self.slow_start <= 900, "slow_start should be 0 or between 30 and 900 seconds")
+        check(not (self.slow_start and self.least_outstanding_requests),
+            "slow_start only works with round robin, the load balancer rejects it with least_outstanding_requests")
+        check(self.alb_access_log_days >= 1, "alb_access_log_days should be at least 1")
+        check(0 <= self.deregistration_delay <= 3600, "deregistration_delay should be between 0 and 3600 seconds")
+
+        check(1 <= self.min_capacity <= self.max_capacity, "min_capacity should be at least 1 and no more than max_capacity")
+        check(self.min_capacity <= self.desired_count <= self.max_capacity,
+            "desired_count should be between min_capacity and max_capacity")
+        for setting in ("scale_cpu_target", "scale_memory_target", "min_healthy_percent"):
+            check(0 < getattr(self, setting) <= 100, f"{setting} should be a percentage")
+        for schedule in self.scaling_schedules:
+            check({"name", "cron"} <= set(schedule), "scaling_schedules need a name and cron")
+
+        check(self.cron_interval_minutes >= 1, "cron_interval_minutes should be at least 1")
+        check(self.adhoc_workers >= 0, "adhoc_workers can't be negative")
+
+        check_choice("db_engine", DB_ENGINES)
+        check(self.db_allocated_storage <= self.db_max_allocated_storage,
+            "db_allocated_storage should be no more than db_max_allocated_storage")
+        if self.db_engine == "instance":
+            check_choice("db_storage_type", DB_STORAGE_TYPES)
+            check(self.db_storage_type != "IO1" or self.db_iops,
+                "db_iops is needed for IO1 storage")
+            check(self.db_storage_type != "GP3" or not (self.db_iops or self.db_storage_throughput)
+                or self.db_allocated_storage >= DB_GP3_PROVISIONED_MIN_STORAGE,
+                f"gp3 db_iops and db_storage_throughput need db_allocated_storage of {DB_GP3_PROVISIONED_MIN_STORAGE} GiB or more")
+            check(self.db_storage_throughput is None or self.db_storage_type == "GP3",
+                "db_storage_throughput is only for GP3 storage")
+            check(not (self.db_performance_insights and self.db_instance_type.split(".")[-1] in ("micro", "small")),
+                f"Performance Insights is not available on {self.db_instance_type} MySQL instances")
+            check(10 <= self.db_buffer_pool_percent <= 90, "db_buffer_pool_percent should be between 10 and 90")
+        check(self.db_max_connections is None or self.db_max_connections >= 10, "db_max_connections should be at least 10")
+        check(self.db_long_query_time >= 0, "db_long_query_time can't be negative")
+        for export in self.db_log_exports:
+            check(export in DB_LOG_EXPORTS, f'db_log_exports "{export}" should be one of {", ".join(DB_LOG_EXPORTS)}')
+        if self.db_engine == "aurora-serverless":
+            check(self.db_readers >= 1, "Aurora needs at least one reader for read-only queries")
+            check(0.5 <= self.db_min_acu <= self.db_max_acu <= 128,
+                "db_min_acu and db_max_acu should be between 0.5 and 128 ACUs")
+        for setting in ("db_proxy_max_connections_percent", "db_proxy_max_idle_connections_percent"):
+            check(0 < getattr(self, setting) <= 100, f"{setting} should be a percentage")
+
+        check(1 <= self.redis_nodes <= 6, "redis_nodes should be between 1 and 6")
+        check(not self.enable_redis or self.prebaked_image,
+            "enable_redis needs prebaked_image, Moodle is pointed at Redis by config-extra.php and tool_forcedcache in the image")
+
+        check(not self.enable_objectfs or self.prebaked_image,
+            "enable_objectfs needs prebaked_image, tool_objectfs is installed in the image")
+        check(self.objectfs_size_threshold_kib >= 0 and self.objectfs_minimum_age >= 0,
+            "objectfs_size_threshold_kib and objectfs_minimum_age can't be negative")
+        check(0 <= self.objectfs_cache_gib <= (self.ephemeral_storage_gib or 20) // 2,
+            "objectfs_cache_gib should be at most half of ephemeral_storage_gib, the rest holds the Moodle code and local caches")
+
+        check_choice("efs_throughput_mode", EFS_THROUGHPUT_MODES)
+        check_choice("efs_performance_mode", EFS_PERFORMANCE_MODES)
+        check_choice("efs_lifecycle_policy", EFS_LIFECYCLE_POLICIES)
+        check_choice("efs_out_of_infrequent_access_policy", EFS_OUT_OF_IA_POLICIES)
+        for rule in self.all_waf_rules:
+            check({"name", "priority", "type", "action"} <= set(rule), "waf_rules need a name, priority, type and action")
+            check(rule["type"] in WAF_RULE_TYPES, f'WAF rule {rule["name"]} type should be one of {", ".join(WAF_RULE_TYPES)}')
+            check(rule["action"] in WAF_ACTIONS, f'WAF rule {rule["name"]} action should be one of {", ".join(WAF_ACTIONS)}')
+            if rule["type"] == "rate":
+                check(rule.get("limit", 0) >= WAF_MIN_RATE_LIMIT,
+                    f'WAF rule {rule["name"]} limit should be at least {WAF_MIN_RATE_LIMIT} requests in 5 minutes')
+            else:
+                check("rule_group" in rule, f'WAF rule {rule["name"]} needs a rule_group')
+        for key, plural in (("name", "names"), ("priority", "priorities")):
+            values = [rule[key] for rule in self.all_waf_rules]
+            check(len(values) == len(set(values)), f"WAF rule {plural} should be unique")
+
+        for setting in ("alarm_5xx_percent", "alarm_cpu_percent", "alarm_db_cpu_percent"):
+            check(0 < getattr(self, setting) <= 100, f"{setting} should be a percentage")
+        check(self.alarm_response_time_p95 > 0, "alarm_response_time_p95 should be more than 0 seconds")
+        check(self.alarm_email is None or "@" in self.alarm_email, "alarm_email should be an email address")
+        check(not self.enable_tracing or self.prebaked_image,
+            "enable_tracing needs prebaked_image, the OpenTelemetry PHP extension is installed in the image")
+        check(0 <= self.tracing_sample_rate <= 1, "tracing_sample_rate should be between 0 and 1")
+        check(0 < self.tracing_collector_memory < self.memory_limit_mib,
+            "tracing_collector_memory should be more than 0 and less than memory_limit_mib")
+        check(self.efs_provisioned_throughput_mibps >= 1, "efs_provisioned_throughput_mibps should be at least 1")
+
+        for setting in ("lint_errors", "lint_ignore"):
+            for lint_check in getattr(self, setting):
+                check(lint_check in LINT_CHECKS, f'{setting} "{lint_check}" should be one of {", ".join(LINT_CHECKS)}')
+
+    @property
+    def grace_period(self) -> int:
+        """ Health check grace period of the web service in seconds """
+        return self.health_check_grace_period or (120 if self.moodle_installed else 900)
+
+    @property
+    def all_waf_rules(self) -> Tuple[dict, ...]:
+        """ waf_rules plus Bot Control when it is turned on, in priority order """
+        rules = self.waf_rules + ((WAF_BOT_CONTROL_RULE,) if self.waf_bot_control else ())
+        return tuple(sorted(rules, key=lambda rule: rule.get("priority", 0)))
+
+
+## Named presets
+PROFILES = {
+    "dev": MoodleProfile(),
+
+    "staging": MoodleProfile(
+        name="staging",
+        cpu=512,
+        memory_limit_mib=2048,
+        desired_count=2,
+        min_capacity=2,
+        max_capacity=6,
+        scaling_schedules=(),
+        db_instance_type="t4g.medium",
+        db_allocated_storage=20,
+        db_max_allocated_storage=100,
+        db_performance_insights=True,
+        enable_redis=True,
+        prebaked_image=True,
+        efs_throughput_mode="ELASTIC",
+        bitnami_debug=False,
+        lint_errors=("debug_env",),
+        ),
+
+    ## High-load production, sized for exam time peaks
+    "prod": MoodleProfile(
+        name="prod",
+        max_azs=3,
+        nat_instance_type="t3.small",
+        nat_gateways=2,
+        cpu=1024,
+        memory_limit_mib=4096,
+        desired_count=3,
+        min_capacity=3,
+        max_capacity=20,
+        fargate_base=3,
+        fargate_spot_weight=2,
+        ephemeral_storage_gib=40,
+        prebaked_image=True,
+        bitnami_debug=False,
+        scale_requests_per_target=600,
+        scaling_schedules=(
+            {"name": "WeekdayPeakStart", "cron": {"minute": "30", "hour": "7", "week_day": "MON-FRI"},
+                "min_capacity": 6},
+            {"name": "WeekdayPeakEnd", "cron": {"minute": "0", "hour": "18", "week_day": "MON-FRI"},
+                "min_capacity": 3},
+            ),
+        adhoc_workers=2,
+        worker_cpu=512,
+        worker_memory=2048,
+        db_engine="aurora-serverless",
+        db_readers=1,
+        db_min_acu=1,
+        db_max_acu=16,
+        db_performance_insights=True,
+        db_long_query_time=0.5,
+        enable_redis=True,
+        redis_node_type="cache.t4g.medium",
+        redis_nodes=2,
+        enable_objectfs=True,
+        efs_throughput_mode="ELASTIC",
+        lint_errors=("single_task", "burstable_db", "bursting_efs", "no_cache", "debug_env", "single_nat"),
+        ),
+    }
+
+
+def profile_from_context(settings) -> MoodleProfile:
+    """ Build a profile from cdk context, either a preset name or a dict with an optional
+    "profile" preset name plus settings that override it """
+    if settings is None:
+        settings = {}
+    if isinstance(settings, str):
+        settings = {"profile": settings}
+    overrides = dict(settings)
+    preset = overrides.pop("profile", "dev")
+    if preset not in PROFILES:
+        raise ValueError(f'Unknown profile "{preset}", expected one of {", ".join(PROFILES)}')
+
+    known = {setting.name for setting in fields(MoodleProfile)}
+    unknown = sorted(set(overrides) - known)
+    if unknown:
+        raise ValueError(f'Unknown profile settings: {", ".join(unknown)}')
+    base = PROFILES[preset]
+    for setting, value in overrides.items():
+        overrides[setting] = _from_context_string(value, getattr(base, setting))
+    return replace(base, **overrides)
+
+
+def _from_context_string(value, default):
+    """ Values given with `cdk deploy -c setting=value` arrive as strings """
+    if not isinstance(value, str) or isinstance(default, str):
+        return value
+    if isinstance(default, tuple):
+        return tuple(item.strip() for item in value.split(",") if item.strip())
+    if isinstance(default, bool):
+        return value.lower() in ("true", "1", "yes")
+    if isinstance(default, (int, float)) or default is None:
+        try:
+            return int(value) if value.isdigit() else float(value)
+        except ValueError:
+            return value
+    return value
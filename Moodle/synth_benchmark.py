@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+## Times building the network, data and app stacks and synthesizing their templates for each
+## preset profile, to keep an eye on `cdk synth` and unit test times as the stacks grow.
+##
+##   python3 synth_benchmark.py
+##   python3 synth_benchmark.py --profiles prod --repeat 5
+##
+## Each run starts from a new cdk.App, as `cdk synth` and the tests do. The very first run loads
+## the construct library code into the jsii node process, so it's reported separately.
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import aws_cdk as cdk
+
+from moodle_serverless.moodle_serverless_stack import moodle_stacks
+from moodle_serverless.profiles import PROFILES
+
+ENV = cdk.Environment(account='131458236732', region='eu-west-2')
+PROPS = {"domain_name": "example.org", "hosted_zone_id": None, "hosted_zone_name": None}
+
+
+def synth_once(profile):
+    """ (seconds building the stacks, seconds synthesizing them) """
+    with tempfile.TemporaryDirectory() as outdir:
+        start = time.perf_counter()
+        app = cdk.App(outdir=outdir)
+        moodle_stacks(app, "MoodleServerlessStackV2", env=ENV, props=PROPS, profile=profile)
+        built = time.perf_counter()
+        app.synth()
+        return built - start, time.perf_counter() - built
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time stack construction and synthesis for the preset profiles")
+    parser.add_argument("--profiles", default=",".join(PROFILES), help="comma separated profiles (default all presets)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per profile (default 3)")
+    args = parser.parse_args(argv)
+
+    names = args.profiles.split(",")
+    construct, synth = synth_once(PROFILES[names[0]])
+    print(f"first run ({names[0]}) {construct:.2f} s construct, {synth:.2f} s synth")
+    print(f'{"profile":<10} {"construct s":>12} {"synth s":>9} {"total s":>9}   median of {args.repeat}')
+    for name in names:
+        runs = [synth_once(PROFILES[name]) for _ in range(args.repeat)]
+        construct = statistics.median(run[0] for run in runs)
+        synth = statistics.median(run[1] for run in runs)
+        print(f"{name:<10} {construct:>12.2f} {synth:>9.2f} {construct + synth:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
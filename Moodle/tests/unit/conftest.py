@@ -0,0 +1,37 @@
+import functools
+
+import aws_cdk as cdk
+import aws_cdk.assertions as assertions
+import pytest
+
+from moodle_serverless.moodle_serverless_stack import MoodleStacks, moodle_stacks
+from moodle_serverless.profiles import PROFILES
+
+ENV = cdk.Environment(account='131458236732', region='eu-west-2')
+
+PROPS = {
+    "domain_name": "commcouncil.scot",
+    "hosted_zone_id": "Z00217581OBDF54QYM4OF",
+    "hosted_zone_name": "commcouncil.scot"
+    }
+
+## Synthesizing the stacks takes seconds of jsii calls, so each preset is synthesized once per test
+## run and the templates are shared. Templates are only read by the assertions, never changed.
+## Tests for settings outside the presets still build their own cdk.App().
+
+@functools.lru_cache(maxsize=None)
+def synth_profile(name):
+    """ Templates of the network, data, app and edge stacks for a preset profile """
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=ENV, props=PROPS, profile=PROFILES[name])
+    return MoodleStacks(*(stack and assertions.Template.from_stack(stack) for stack in stacks))
+
+@pytest.fixture(scope="session")
+def templates():
+    """ The dev profile, the default """
+    return synth_profile("dev")
+
+@pytest.fixture(scope="session", params=sorted(PROFILES))
+def profile_templates(request):
+    """ (profile name, templates) for each preset """
+    return request.param, synth_profile(request.param)
@@ -0,0 +1,88 @@
+import gzip
+import io
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+import alb_latency
+
+LOG_LINES = [
+    'https 2023-05-15T08:00:01.000000Z app/moodle/50dc6c495c0c9188 192.168.131.39:2817 10.0.0.1:80 0.001 0.480 0.000 200 200 '
+    '34 366 "GET https://moodle.example.org:443/course/view.php?id=12 HTTP/2.0" "Mozilla/5.0" ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2 '
+    'arn:aws:elasticloadbalancing:eu-west-2:123456789012:targetgroup/moodle/73e2d6bc24d8a067 "Root=1-58337262-36d228ad5d99923122bbe354" '
+    '"moodle.example.org" "arn:aws:acm:eu-west-2:123456789012:certificate/12345678" 0 2023-05-15T08:00:00.519000Z "forward" "-" "-" '
+    '"10.0.0.1:80" "200" "-" "-"',
+    'https 2023-05-15T08:00:02.000000Z app/moodle/50dc6c495c0c9188 192.168.131.40:2817 10.0.0.2:80 0.001 2.100 0.001 200 200 '
+    '34 366 "GET https://moodle.example.org:443/pluginfile.php/27/mod_resource/content/1/notes.pdf HTTP/2.0" "Mozilla/5.0" - - '
+    'arn:aws:elasticloadbalancing:eu-west-2:123456789012:targetgroup/moodle/73e2d6bc24d8a067 "Root=1-58337262-36d228ad5d99923122bbe355" '
+    '"moodle.example.org" "-" 0 2023-05-15T08:00:00.519000Z "forward" "-" "-" "10.0.0.2:80" "200" "-" "-"',
+    'https 2023-05-15T08:00:03.000000Z app/moodle/50dc6c495c0c9188 192.168.131.41:2817 - -1 -1 -1 503 - '
+    '34 366 "POST https://moodle.example.org:443/login/index.php HTTP/2.0" "Mozilla/5.0" - - '
+    'arn:aws:elasticloadbalancing:eu-west-2:123456789012:targetgroup/moodle/73e2d6bc24d8a067 "Root=1-58337262-36d228ad5d99923122bbe356" '
+    '"moodle.example.org" "-" 0 2023-05-15T08:00:00.519000Z "forward" "-" "-" "-" "-" "-" "-"',
+    'not a log line',
+]
+
+
+def test_endpoint_is_the_moodle_script():
+    assert alb_latency.endpoint("https://moodle.example.org:443/course/view.php?id=12") == "/course/view.php"
+    assert alb_latency.endpoint("https://moodle.example.org:443/pluginfile.php/27/mod_resource/content/1/notes.pdf") == "/pluginfile.php"
+    assert alb_latency.endpoint("https://moodle.example.org:443/") == "/"
+    assert alb_latency.endpoint("https://moodle.example.org:443/lib/javascript.php/1684137600/lib/requirejs.js") == "/lib/javascript.php"
+    assert alb_latency.endpoint("https://moodle.example.org:443/theme/boost/pix/favicon.ico") == "/theme/*"
+    assert alb_latency.endpoint("https://moodle.example.org:443/robots.txt") == "/robots.txt"
+
+def test_endpoints_bounded_for_many_distinct_paths():
+    report = alb_latency.LatencyReport()
+    entry = alb_latency.LOG_LINE.match(LOG_LINES[0]).groupdict()
+    for probe in range(3 * alb_latency.MAX_ENDPOINTS):
+        report.add(dict(entry, url=f"https://moodle.example.org:443/probe{probe}.php"))
+        report.add(dict(entry, url=f"https://moodle.example.org:443/static/{probe}/file.js"))
+    # the endpoints seen first, plus one for the rest
+    assert len(report.requests) == len(report.latency) == alb_latency.MAX_ENDPOINTS + 1
+    assert report.requests[alb_latency.OTHER] == 2 * alb_latency.MAX_ENDPOINTS + 1
+    assert report.requests["/static/*"] == 3 * alb_latency.MAX_ENDPOINTS
+    assert sum(report.requests.values()) == 6 * alb_latency.MAX_ENDPOINTS
+
+def test_histogram_percentiles_within_five_percent():
+    histogram = alb_latency.LatencyHistogram()
+    for millisecond in range(1, 1001):
+        histogram.add(millisecond / 1000)
+    assert histogram.count == 1000
+    assert 0.5 <= histogram.percentile(50) <= 0.5 * 1.05
+    assert 0.95 <= histogram.percentile(95) <= 0.95 * 1.05
+    assert histogram.percentile(100) == 1.0
+
+def test_report_from_parsed_lines():
+    report = alb_latency.LatencyReport(top=2).add_all(alb_latency.parse_lines(LOG_LINES))
+    assert sum(report.requests.values()) == 3
+    assert report.errors == {"/login/index.php": 1}
+    # the 503 never reached a target, so it has no latencies
+    assert report.latency["/login/index.php"]["target_processing_time"].count == 0
+    assert report.busiest() == ["/pluginfile.php", "/course/view.php"]
+    assert max(report.slowest)[1] == "GET https://moodle.example.org:443/pluginfile.php/27/mod_resource/content/1/notes.pdf"
+    out = io.StringIO()
+    report.print(out)
+    assert "3 requests to 3 endpoints" in out.getvalue()
+
+def test_reads_gzipped_logs_from_a_directory(tmp_path):
+    (tmp_path / "2023" / "05").mkdir(parents=True)
+    with gzip.open(tmp_path / "2023" / "05" / "moodle_1.log.gz", "wt") as log_file:
+        log_file.write("\n".join(LOG_LINES) + "\n")
+    (tmp_path / "README.txt").write_text("not a log file")
+    entries = list(alb_latency.parse_lines(alb_latency.read_lines([str(tmp_path)])))
+    assert [entry["method"] for entry in entries] == ["GET", "GET", "POST"]
+
+def test_streams_logs_from_s3():
+    client = boto3.client("s3", region_name="eu-west-2", aws_access_key_id="test", aws_secret_access_key="test")
+    compressed = gzip.compress(("\n".join(LOG_LINES) + "\n").encode())
+    with Stubber(client) as stubber:
+        stubber.add_response("list_objects_v2",
+            {"Contents": [{"Key": "alb/moodle_1.log.gz"}, {"Key": "alb/ELBAccessLogTestFile"}]},
+            {"Bucket": "logs", "Prefix": "alb/"})
+        stubber.add_response("get_object",
+            {"Body": StreamingBody(io.BytesIO(compressed), len(compressed))},
+            {"Bucket": "logs", "Key": "alb/moodle_1.log.gz"})
+        entries = list(alb_latency.parse_lines(alb_latency.read_lines(["s3://logs/alb/"], client)))
+    assert len(entries) == 3
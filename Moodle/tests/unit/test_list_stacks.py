@@ -0,0 +1,146 @@
+import datetime
+import json
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import list_stacks
+
+CREATED = datetime.datetime(2023, 5, 15, 8, 0, tzinfo=datetime.timezone.utc)
+
+def stack(name, region, account='131458236732', outputs=()):
+    return {
+        'StackName': name,
+        'StackId': f'arn:aws:cloudformation:{region}:{account}:stack/{name}/5b3a4e10-f2f5-11ed-a05b-0242ac120003',
+        'StackStatus': 'CREATE_COMPLETE',
+        'CreationTime': CREATED,
+        'Outputs': [{'OutputKey': key, 'OutputValue': value} for key, value in outputs]
+    }
+
+def cloudformation_client(region):
+    return boto3.client('cloudformation', region_name=region, aws_access_key_id='test', aws_secret_access_key='test')
+
+def test_parse_arn():
+    arn = list_stacks.parse_arn('arn:aws:cloudformation:us-east-1:123456789012:stack/MoodleServerlessStackV2/5b3a4e10')
+    assert arn['region'] == 'us-east-1'
+    assert arn['account'] == '123456789012'
+    assert arn['resource'] == 'stack/MoodleServerlessStackV2/5b3a4e10'
+    with pytest.raises(ValueError):
+        list_stacks.parse_arn('MoodleServerlessStackV2')
+
+def test_describe_all_stacks_follows_next_token():
+    client = cloudformation_client('eu-west-2')
+    with Stubber(client) as stubber:
+        stubber.add_response('describe_stacks', {'Stacks': [stack('One', 'eu-west-2')], 'NextToken': 'page2'}, {})
+        stubber.add_response('describe_stacks', {'Stacks': [stack('Two', 'eu-west-2')]}, {'NextToken': 'page2'})
+        stacks = list_stacks.describe_all_stacks(client)
+        stubber.assert_no_pending_responses()
+    assert [s['StackName'] for s in stacks] == ['One', 'Two']
+
+def test_pull_stacks_across_regions():
+    london, virginia = cloudformation_client('eu-west-2'), cloudformation_client('us-east-1')
+    with Stubber(london) as london_stubber, Stubber(virginia) as virginia_stubber:
+        london_stubber.add_response('describe_stacks', {'Stacks': [stack('MoodleServerlessStackV2', 'eu-west-2')]}, {})
+        virginia_stubber.add_response('describe_stacks', {'Stacks': [stack('MoodleCertificate', 'us-east-1', account='210987654321')]}, {})
+        stacks, region, account, alias = list_stacks.pull_stacks([london, virginia])
+    assert [s['StackName'] for s in stacks['Stacks']] == ['MoodleServerlessStackV2', 'MoodleCertificate']
+    assert region == 'eu-west-2, us-east-1'
+    assert account == '131458236732, 210987654321'
+
+def test_stacks_json():
+    stacks = {'Stacks': [stack('MoodleServerlessStackV2', 'eu-west-2', outputs=[('MOODLE-USERNAME', 'moodleadmin')])]}
+    listing = json.loads(list_stacks.stacks_json(stacks))
+    assert listing == [{
+        'StackName': 'MoodleServerlessStackV2',
+        'StackStatus': 'CREATE_COMPLETE',
+        'Region': 'eu-west-2',
+        'Account': '131458236732',
+        'Description': None,
+        'CreationTime': '2023-05-15T08:00:00+00:00',
+        'LastUpdatedTime': None,
+        'Outputs': {'MOODLE-USERNAME': 'moodleadmin'}
+    }]
+
+SECRET_ARN = 'arn:aws:secretsmanager:eu-west-2:131458236732:secret:moodlepassword-AbC123'
+DB_SECRET_ARN = 'arn:aws:secretsmanager:eu-west-2:131458236732:secret:MoodleServerlessStackV2-moodle-db-xYz789'
+
+@pytest.fixture
+def secrets_manager(monkeypatch):
+    client = boto3.client('secretsmanager', region_name='eu-west-2', aws_access_key_id='test', aws_secret_access_key='test')
+    monkeypatch.setattr(list_stacks, '_clients', {(None, 'eu-west-2'): client})
+    monkeypatch.setattr(list_stacks, '_secret_cache', {})
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+def test_secret_name_from_arn():
+    assert list_stacks.secret_name(SECRET_ARN) == 'moodlepassword'
+    assert list_stacks.secret_name(DB_SECRET_ARN) == 'MoodleServerlessStackV2-moodle-db'
+
+def test_secret_arns_from_stack_outputs():
+    outputs = [('MOODLE-USERNAME', 'moodleadmin'), ('MOODLE-PASSWORD-ARN', SECRET_ARN),
+        ('MOODLE-ALARM-TOPIC-ARN', 'arn:aws:sns:eu-west-2:131458236732:MoodleAlarmTopic')]
+    assert list_stacks.secret_arns(stack('MoodleServerlessStackV2', 'eu-west-2', outputs=outputs)) == [SECRET_ARN]
+
+def test_secrets_fetched_in_one_batch_and_cached(secrets_manager):
+    secrets_manager.add_response('batch_get_secret_value', {'SecretValues': [
+        {'ARN': SECRET_ARN, 'SecretString': 'admin-password'},
+        {'ARN': DB_SECRET_ARN, 'SecretString': '{"password": "db-password"}'}
+    ], 'Errors': []}, {'SecretIdList': [SECRET_ARN, DB_SECRET_ARN]})
+    values = list_stacks.get_secrets([SECRET_ARN, DB_SECRET_ARN])
+    assert values[SECRET_ARN] == 'admin-password'
+    # the second call is answered from the cache, the stubber has no more responses
+    assert list_stacks.get_secrets([DB_SECRET_ARN]) == {DB_SECRET_ARN: '{"password": "db-password"}'}
+
+def test_secrets_fall_back_to_single_gets(secrets_manager):
+    secrets_manager.add_client_error('batch_get_secret_value', service_error_code='AccessDeniedException')
+    secrets_manager.add_response('get_secret_value', {'ARN': SECRET_ARN, 'SecretString': 'admin-password'}, {'SecretId': SECRET_ARN})
+    assert list_stacks.get_secrets([SECRET_ARN]) == {SECRET_ARN: 'admin-password'}
+
+def test_outputs_printed_when_a_secret_is_unreadable(secrets_manager, monkeypatch, capsys):
+    outputs = [('MOODLE-USERNAME', 'moodleadmin'), ('MOODLE-PASSWORD-ARN', SECRET_ARN)]
+    monkeypatch.setattr(list_stacks, 'stacks', {'Stacks': [stack('MoodleServerlessStackV2', 'eu-west-2', outputs=outputs)]}, raising=False)
+    for name in ('region', 'account', 'alias'):
+        monkeypatch.setattr(list_stacks, name, '', raising=False)
+    choices = iter(['0', 'q'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(choices))
+    secrets_manager.add_client_error('batch_get_secret_value', service_error_code='AccessDeniedException')
+    secrets_manager.add_client_error('get_secret_value', service_error_code='AccessDeniedException')
+    with pytest.raises(SystemExit):
+        list_stacks.print_output()
+    printed = capsys.readouterr().out
+    assert 'MOODLE-USERNAME:     moodleadmin' in printed
+    assert f'MOODLE-PASSWORD-ARN:     {SECRET_ARN}' in printed
+
+def test_secrets_read_with_the_profile_that_listed_the_stack(tmp_path, monkeypatch):
+    (tmp_path / 'credentials').write_text(
+        '[lms-stag]\naws_access_key_id = stag\naws_secret_access_key = stag\n'
+        '[lms-prod]\naws_access_key_id = prod\naws_secret_access_key = prod\n')
+    (tmp_path / 'config').write_text('[profile lms-stag]\nregion = eu-west-2\n[profile lms-prod]\nregion = eu-west-2\n')
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'credentials'))
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'config'))
+    for name in ('_clients', '_secret_cache', '_client_sessions', '_stack_sessions'):
+        monkeypatch.setattr(list_stacks, name, {})
+
+    prod_secret = 'arn:aws:secretsmanager:eu-west-2:210987654321:secret:moodlepassword-XyZ789'
+    sessions, clients = list_stacks.cloudformation_clients(['lms-stag', 'lms-prod'])
+    staging, prod = (stack(name, 'eu-west-2', account=account, outputs=[('MOODLE-PASSWORD-ARN', arn)])
+        for name, account, arn in (('MoodleStaging', '131458236732', SECRET_ARN), ('MoodleProd', '210987654321', prod_secret)))
+    with Stubber(clients[0]) as stag_stubber, Stubber(clients[1]) as prod_stubber:
+        stag_stubber.add_response('describe_stacks', {'Stacks': [staging]}, {})
+        prod_stubber.add_response('describe_stacks', {'Stacks': [prod]}, {})
+        stacks, region, account, alias = list_stacks.pull_stacks(clients)
+
+    listed = {s['StackName']: s for s in stacks['Stacks']}
+    assert list_stacks.stack_session(listed['MoodleStaging']) is sessions[0]
+    assert list_stacks.stack_session(listed['MoodleProd']) is sessions[1]
+    # each account's secret is fetched with that account's credentials
+    prod_client = list_stacks.secrets_client('eu-west-2', sessions[1])
+    assert prod_client is not list_stacks.secrets_client('eu-west-2', sessions[0])
+    with Stubber(prod_client) as stubber:
+        stubber.add_response('batch_get_secret_value', {'SecretValues': [{'ARN': prod_secret, 'SecretString': 'prod-password'}],
+            'Errors': []}, {'SecretIdList': [prod_secret]})
+        values = list_stacks.get_secrets(list_stacks.secret_arns(listed['MoodleProd']), list_stacks.stack_session(listed['MoodleProd']))
+        stubber.assert_no_pending_responses()
+    assert values == {prod_secret: 'prod-password'}
@@ -1,7 +1,12 @@
+import json
+import os
+import re
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
 
-from moodle_serverless.moodle_serverless_stack import MoodleServerlessStackV2
+from moodle_serverless.moodle_serverless_stack import MOODLE_IMAGE, moodle_stacks
+from moodle_serverless.profiles import MoodleProfile
 import aws_cdk as cdk
 
 props = {
@@ -13,38 +18,28 @@ props = {
 # CDK documentation can be found here:
 # https://docs.aws.amazon.com/cdk/api/v1/python/aws_cdk.assertions.html
 
-def test_vpc_exists():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_vpc_exists(templates):
+    template = templates.network
     # Assert that we have created only one VPC
     template.resource_count_is("AWS::EC2::VPC", 1)
 
-def test_vpc_has_four_subnets():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_vpc_has_four_subnets(templates):
+    template = templates.network
     # Assert we have only four subnets
     template.resource_count_is("AWS::EC2::Subnet", 4)
 
-def test_vpc_has_public_subnets():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_vpc_has_public_subnets(templates):
+    template = templates.network
     # Assert we have a public subnet
     template.has_resource_properties("AWS::EC2::Subnet", {"MapPublicIpOnLaunch": True})
 
-def test_vpc_has_private_subnets():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_vpc_has_private_subnets(templates):
+    template = templates.network
     # Assert we have a private subnet
     template.has_resource_properties("AWS::EC2::Subnet", {"MapPublicIpOnLaunch": False})
 
-def test_vpc_has_two_public_subnets():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_vpc_has_two_public_subnets(templates):
+    template = templates.network
     # Assert we have a public subnet 1
     template.has_resource_properties("AWS::EC2::Subnet", {"Tags": [
      {
@@ -57,7 +52,7 @@ def test_vpc_has_two_public_subnets():
      },
      {
       "Key": "Name",
-      "Value": "MoodleServerlessStackV2/Vpc/PublicSubnet1"
+      "Value": "MoodleServerlessStackV2-Network/Vpc/PublicSubnet1"
      }
     ]})
 
@@ -73,14 +68,12 @@ def test_vpc_has_two_public_subnets():
      },
      {
       "Key": "Name",
-      "Value": "MoodleServerlessStackV2/Vpc/PublicSubnet2"
+      "Value": "MoodleServerlessStackV2-Network/Vpc/PublicSubnet2"
      }
     ]})
 
-def test_vpc_has_two_private_subnets():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_vpc_has_two_private_subnets(templates):
+    template = templates.network
     # Assert we have a private subnet 1
     template.has_resource_properties("AWS::EC2::Subnet", {"Tags": [
      {
@@ -93,7 +86,7 @@ def test_vpc_has_two_private_subnets():
      },
      {
       "Key": "Name",
-      "Value": "MoodleServerlessStackV2/Vpc/PrivateSubnet1"
+      "Value": "MoodleServerlessStackV2-Network/Vpc/PrivateSubnet1"
      }
     ]})
 
@@ -109,74 +102,56 @@ def test_vpc_has_two_private_subnets():
      },
      {
       "Key": "Name",
-      "Value": "MoodleServerlessStackV2/Vpc/PrivateSubnet2"
+      "Value": "MoodleServerlessStackV2-Network/Vpc/PrivateSubnet2"
      }
     ]})
 
-def test_only_one_nat_gateway():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
-    # Assert that we have created only one NAT Gateway
-    template.resource_count_is("AWS::EC2::NatGateway", 1)
+def test_only_one_nat_instance(templates):
+    template = templates.network
+    # Assert that we have created only one NAT, an instance rather than a NAT Gateway
+    template.resource_count_is("AWS::EC2::NatGateway", 0)
+    template.resource_count_is("AWS::EC2::Instance", 1)
+    template.has_resource_properties("AWS::EC2::Instance", {"SourceDestCheck": False})
 
-def test_DBinstance_is_correct_type():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_DBinstance_is_correct_type(templates):
+    template = templates.data
     template.has_resource_properties("AWS::RDS::DBInstance", {"DBInstanceClass": "db.t4g.micro"})
 
-def test_DBinstance_storage_is_correct_size():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_DBinstance_storage_is_correct_size(templates):
+    template = templates.data
     template.has_resource_properties("AWS::RDS::DBInstance", {"AllocatedStorage": "5"})
 
-def test_Fargate_task_vCPU_is_correct_size():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_Fargate_task_vCPU_is_correct_size(templates):
+    template = templates.app
     template.has_resource_properties("AWS::ECS::TaskDefinition", {"Cpu": "256"})
 
-def test_Fargate_task_memory_is_correct_size():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_Fargate_task_memory_is_correct_size(templates):
+    template = templates.app
     template.has_resource_properties("AWS::ECS::TaskDefinition", {"Memory": "1024"})
 
-def test_Fargate_desired_task_count():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_Fargate_desired_task_count(templates):
+    template = templates.app
     template.has_resource_properties("AWS::ECS::Service", {"DesiredCount": 1})
 
-def test_Fargate_in_private_subnet():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_Fargate_in_private_subnet(templates):
+    template = templates.app
     template.has_resource_properties("AWS::ECS::Service", {"NetworkConfiguration":
         {
             "AwsvpcConfiguration": {"AssignPublicIp": "DISABLED"}
         }
     })
 
-def test_load_balancer_deployed():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_load_balancer_deployed(templates):
+    template = templates.app
     template.resource_count_is("AWS::ElasticLoadBalancingV2::LoadBalancer", 1)
 
-def test_load_balancer_is_correct_type():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_load_balancer_is_correct_type(templates):
+    template = templates.app
     template.has_resource_properties("AWS::ElasticLoadBalancingV2::LoadBalancer", {"Type": "application"})
 
 
-def test_load_balancer_is_redirecting_HTTP_to_HTTPS():
-    app = cdk.App()
-    test_stack = MoodleServerlessStackV2(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'), props=props)
-    template = assertions.Template.from_stack(test_stack)
+def test_load_balancer_is_redirecting_HTTP_to_HTTPS(templates):
+    template = templates.app
     template.has_resource_properties("AWS::ElasticLoadBalancingV2::Listener",{"DefaultActions": [
      {
       "RedirectConfig": {
@@ -188,14 +163,579 @@ def test_load_balancer_is_redirecting_HTTP_to_HTTPS():
      }
     ]})
 
+def test_target_group_tuned_for_php(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::ElasticLoadBalancingV2::TargetGroup", {
+        "HealthCheckPath": "/",
+        "HealthCheckIntervalSeconds": 15,
+        "HealthCheckTimeoutSeconds": 5,
+        "HealthyThresholdCount": 2,
+        "UnhealthyThresholdCount": 3,
+        "TargetGroupAttributes": assertions.Match.array_with([
+            {"Key": "deregistration_delay.timeout_seconds", "Value": "30"},
+            {"Key": "load_balancing.algorithm.type", "Value": "least_outstanding_requests"}
+        ])
+    })
+    (target_group,) = template.find_resources("AWS::ElasticLoadBalancingV2::TargetGroup").values()
+    assert "slow_start.duration_seconds" not in [attribute["Key"]
+        for attribute in target_group["Properties"]["TargetGroupAttributes"]]
 
+def test_slow_start_with_round_robin():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(least_outstanding_requests=False, slow_start=60))
+    template = assertions.Template.from_stack(stacks.app)
+    (target_group,) = template.find_resources("AWS::ElasticLoadBalancingV2::TargetGroup").values()
+    attributes = {attribute["Key"]: attribute["Value"] for attribute in target_group["Properties"]["TargetGroupAttributes"]}
+    assert attributes["slow_start.duration_seconds"] == "60"
+    assert "load_balancing.algorithm.type" not in attributes
+
+def test_prebaked_image_health_check_path():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(prebaked_image=True))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ElasticLoadBalancingV2::TargetGroup", {"HealthCheckPath": "/healthcheck.php"})
+
+def test_alb_access_logs_to_s3(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::ElasticLoadBalancingV2::LoadBalancer", {"LoadBalancerAttributes": assertions.Match.array_with([
+        {"Key": "access_logs.s3.enabled", "Value": "true"},
+        {"Key": "access_logs.s3.prefix", "Value": "alb"}
+    ])})
+    template.has_resource_properties("AWS::S3::Bucket", {"LifecycleConfiguration": {"Rules": [
+        assertions.Match.object_like({"ExpirationInDays": 30, "Status": "Enabled"})
+    ]}})
+
+def test_Fargate_service_has_scalable_target(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "MinCapacity": 1,
+        "MaxCapacity": 4,
+        "ScalableDimension": "ecs:service:DesiredCount",
+        "ScheduledActions": assertions.Match.array_with([
+            assertions.Match.object_like({
+                "ScheduledActionName": "WeekdayPeakStart",
+                "Schedule": "cron(30 7 ? * MON-FRI *)",
+                "ScalableTargetAction": {"MinCapacity": 2}
+            })
+        ])
+    })
 
+def test_Fargate_service_has_target_tracking_policies(templates):
+    template = templates.app
+    # CPU, memory and ALB request count per target
+    template.resource_count_is("AWS::ApplicationAutoScaling::ScalingPolicy", 3)
+    for metric_type in ["ECSServiceAverageCPUUtilization", "ECSServiceAverageMemoryUtilization", "ALBRequestCountPerTarget"]:
+        template.has_resource_properties("AWS::ApplicationAutoScaling::ScalingPolicy", {
+            "PolicyType": "TargetTrackingScaling",
+            "TargetTrackingScalingPolicyConfiguration": assertions.Match.object_like({
+                "PredefinedMetricSpecification": assertions.Match.object_like({"PredefinedMetricType": metric_type}),
+                "ScaleInCooldown": 300,
+                "ScaleOutCooldown": 60
+            })
+        })
+
+def test_scaling_bounds_set_from_props():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(desired_count=2, min_capacity=2, max_capacity=10, scaling_schedules=()))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "MinCapacity": 2,
+        "MaxCapacity": 10,
+        "ScheduledActions": assertions.Match.absent()
+    })
 
+def test_no_redis_by_default(templates):
+    template = templates.data
+    template.resource_count_is("AWS::ElastiCache::ReplicationGroup", 0)
 
+def test_redis_endpoint_passed_to_task():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(prebaked_image=True, enable_redis=True))
+    data_template = assertions.Template.from_stack(stacks.data)
+    template = assertions.Template.from_stack(stacks.app)
+    data_template.has_resource_properties("AWS::ElastiCache::ReplicationGroup", {
+        "Engine": "redis",
+        "CacheNodeType": "cache.t4g.micro",
+        "NumCacheClusters": 1
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({"Environment": assertions.Match.array_with([
+            {"Name": "MOODLE_REDIS_HOST", "Value": {"Fn::ImportValue": assertions.Match.string_like_regexp("MoodleRedisPrimaryEndPointAddress")}}
+        ])})
+    ]})
+    # Fargate tasks can reach Redis, the rule is in the app stack so the data stack doesn't depend on it
+    template.has_resource_properties("AWS::EC2::SecurityGroupIngress", {"FromPort": 6379, "ToPort": 6379})
+
+def test_cloudfront_distribution_in_front_of_alb(templates):
+    template = templates.app
+    template.resource_count_is("AWS::CloudFront::Distribution", 1)
+    template.has_resource_properties("AWS::CloudFront::Distribution", {"DistributionConfig": assertions.Match.object_like({
+        "Aliases": ["commcouncil.scot"],
+        "Origins": [assertions.Match.object_like({"DomainName": "origin.commcouncil.scot"})],
+        "CacheBehaviors": [
+            assertions.Match.object_like({"PathPattern": "/theme/styles.php*"}),
+            assertions.Match.object_like({"PathPattern": "/lib/javascript.php*"}),
+            assertions.Match.object_like({"PathPattern": "/lib/requirejs.php*"}),
+            assertions.Match.object_like({"PathPattern": "/theme/*"}),
+            assertions.Match.object_like({"PathPattern": "/pluginfile.php*"})
+        ]
+    })})
+
+def test_cloudfront_certificate_in_us_east_1(templates):
+    assert templates.edge.to_json()["Resources"]
+    templates.edge.has_resource_properties("AWS::CertificateManager::Certificate", {"DomainName": "commcouncil.scot"})
+    # validated in the zone from the props, not a placeholder from a failed us-east-1 lookup
+    templates.edge.has_resource_properties("AWS::CertificateManager::Certificate", {"DomainValidationOptions": [
+        {"DomainName": "commcouncil.scot", "HostedZoneId": "Z00217581OBDF54QYM4OF"}
+    ]})
+    # read by the app stack from the edge stack's exports in SSM
+    templates.app.has_resource_properties("AWS::CloudFront::Distribution", {"DistributionConfig": assertions.Match.object_like({
+        "ViewerCertificate": assertions.Match.object_like({
+            "AcmCertificateArn": {"Fn::GetAtt": [assertions.Match.string_like_regexp("ExportsReader"), assertions.Match.any_value()]}
+        })
+    })})
+
+def test_pluginfile_cache_key_includes_session(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::CloudFront::CachePolicy", {"CachePolicyConfig": assertions.Match.object_like({
+        "DefaultTTL": 0,
+        "ParametersInCacheKeyAndForwardedToOrigin": assertions.Match.object_like({
+            "CookiesConfig": {"CookieBehavior": "whitelist", "Cookies": ["MoodleSession"]},
+            "QueryStringsConfig": {"QueryStringBehavior": "all"}
+        })
+    })})
+
+def test_site_domain_points_at_cloudfront(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::Route53::RecordSet", {
+        "Name": "commcouncil.scot.",
+        "Type": "A",
+        "AliasTarget": assertions.Match.object_like({"DNSName": {"Fn::GetAtt": [assertions.Match.any_value(), "DomainName"]}})
+    })
+    template.has_resource_properties("AWS::Route53::RecordSet", {"Name": "origin.commcouncil.scot.", "Type": "A"})
 
+def test_no_cloudfront_when_disabled():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(enable_cdn=False))
+    assert stacks.edge is None
+    template = assertions.Template.from_stack(stacks.app)
+    template.resource_count_is("AWS::CloudFront::Distribution", 0)
+    template.has_resource_properties("AWS::CertificateManager::Certificate", {"DomainName": "commcouncil.scot"})
+
+def test_database_behind_rds_proxy(templates):
+    data_template = templates.data
+    template = templates.app
+    data_template.resource_count_is("AWS::RDS::DBProxy", 1)
+    data_template.has_resource_properties("AWS::RDS::DBProxyTargetGroup", {"ConnectionPoolConfigurationInfo": {
+        "MaxConnectionsPercent": 90,
+        "MaxIdleConnectionsPercent": 50,
+        "ConnectionBorrowTimeout": 120,
+        "SessionPinningFilters": ["EXCLUDE_VARIABLE_SETS"]
+    }})
+    # Moodle connects to the proxy endpoint
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({"Environment": assertions.Match.array_with([
+            {"Name": "MOODLE_DATABASE_HOST", "Value": {"Fn::ImportValue": assertions.Match.string_like_regexp("MoodleDbProxy.*Endpoint")}}
+        ])})
+    ]})
 
+def test_no_rds_proxy_when_disabled():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(enable_db_proxy=False))
+    template = assertions.Template.from_stack(stacks.data)
+    template.resource_count_is("AWS::RDS::DBProxy", 0)
 
+def test_aurora_serverless_with_reader():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(db_engine="aurora-serverless", db_max_acu=8))
+    data_template = assertions.Template.from_stack(stacks.data)
+    template = assertions.Template.from_stack(stacks.app)
+    data_template.has_resource_properties("AWS::RDS::DBCluster", {
+        "Engine": "aurora-mysql",
+        "ServerlessV2ScalingConfiguration": {"MinCapacity": 0.5, "MaxCapacity": 8}
+    })
+    # writer plus one reader
+    data_template.resource_count_is("AWS::RDS::DBInstance", 2)
+    data_template.all_resources_properties("AWS::RDS::DBInstance", {"DBInstanceClass": "db.serverless"})
+    # read-only queries go through the read-only proxy endpoint
+    data_template.has_resource_properties("AWS::RDS::DBProxyEndpoint", {"TargetRole": "READ_ONLY",
+        "DBProxyEndpointName": "moodleserverlessstackv2-data-reader"})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({"Environment": assertions.Match.array_with([
+            {"Name": "MOODLE_DATABASE_READONLY_HOST", "Value": {"Fn::ImportValue": assertions.Match.string_like_regexp("MoodleDbProxyReaderEndpoint")}}
+        ])})
+    ]})
 
+def test_single_instance_has_no_readonly_host(templates):
+    template = templates.data
+    template.resource_count_is("AWS::RDS::DBCluster", 0)
+    template.resource_count_is("AWS::RDS::DBProxyEndpoint", 0)
+
+def test_db_parameter_group_and_slow_query_log(templates):
+    template = templates.data
+    template.has_resource_properties("AWS::RDS::DBParameterGroup", {"Parameters": {
+        "innodb_buffer_pool_size": "{DBInstanceClassMemory*75/100}",
+        "tmp_table_size": str(64 * 1024 * 1024),
+        "slow_query_log": "1",
+        "long_query_time": "1",
+        "log_output": "FILE"
+    }})
+    template.has_resource_properties("AWS::RDS::DBInstance", {
+        "StorageType": "gp3",
+        "EnableCloudwatchLogsExports": ["error", "slowquery"],
+        "DBParameterGroupName": assertions.Match.any_value()
+    })
 
+def test_db_gp3_iops_and_performance_insights():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(db_instance_type="m6g.large", db_allocated_storage=400, db_max_allocated_storage=1000,
+            db_iops=12000, db_storage_throughput=500, db_performance_insights=True, db_max_connections=400))
+    template = assertions.Template.from_stack(stacks.data)
+    template.has_resource_properties("AWS::RDS::DBInstance", {
+        "Iops": 12000,
+        "StorageThroughput": 500,
+        "EnablePerformanceInsights": True
+    })
+    template.has_resource_properties("AWS::RDS::DBParameterGroup", {"Parameters": {"max_connections": "400"}})
+
+def test_cron_runs_as_scheduled_task(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::Events::Rule", {"ScheduleExpression": "rate(5 minutes)"})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "ContainerDefinitions": [assertions.Match.object_like({
+            # setup as root, cron as the web server's user so its files on EFS stay writable by the web tasks
+            "Command": ["/bin/bash", "-c", assertions.Match.string_like_regexp(
+                r"setup\.sh && /post-init\.sh && gosu daemon php /opt/bitnami/moodle/admin/cli/cron\.php")],
+            "MountPoints": assertions.Match.array_with([
+                {"ContainerPath": "/bitnami/moodledata", "ReadOnly": False, "SourceVolume": "moodleVolume"}])
+        })],
+        "Volumes": [assertions.Match.object_like({"Name": "moodleVolume"}), assertions.Match.object_like({"Name": "moodleConfigVolume"})]
+    })
+    # no ad-hoc workers unless asked for
+    template.resource_count_is("AWS::ECS::Service", 1)
 
+def test_adhoc_task_workers():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(adhoc_workers=2, worker_cpu=512))
+    template = assertions.Template.from_stack(stacks.app)
+    template.resource_count_is("AWS::ECS::Service", 2)
+    template.has_resource_properties("AWS::ECS::Service", {"DesiredCount": 2})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Cpu": "512",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Command": ["/bin/bash", "-c", assertions.Match.string_like_regexp("gosu daemon php /opt/bitnami/moodle/admin/cli/adhoc_task.php --execute")]
+        })]
+    })
+
+def test_prebaked_image_once_installed():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(prebaked_image=True, moodle_installed=True))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({
+            "Name": "MoodleContainer",
+            "Image": {"Fn::Sub": assertions.Match.string_like_regexp("container-assets")},
+            "Environment": assertions.Match.array_with([
+                # bitnami skips the install itself when it finds config.php on EFS
+                {"Name": "MOODLE_SKIP_BOOTSTRAP", "Value": "no"},
+                {"Name": "MOODLE_LOCALCACHEDIR", "Value": "/var/moodle/localcache"}
+            ])
+        })
+    ]})
+    template.has_resource_properties("AWS::ECS::Service", {"HealthCheckGracePeriodSeconds": 120})
+
+def test_first_install_keeps_long_grace_period(templates):
+    template = templates.app
+    template.has_resource_properties("AWS::ECS::Service", {"HealthCheckGracePeriodSeconds": 900})
+
+def test_only_moodledata_and_config_on_efs(templates):
+    template = templates.app
+    templates.data.has_resource_properties("AWS::EFS::AccessPoint", {"RootDirectory": assertions.Match.object_like({"Path": "/moodledata"})})
+    templates.data.has_resource_properties("AWS::EFS::AccessPoint", {"RootDirectory": assertions.Match.object_like({"Path": "/moodle"})})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({
+            "Name": "MoodleContainer",
+            "MountPoints": [
+                {"ContainerPath": "/bitnami/moodledata", "ReadOnly": False, "SourceVolume": "moodleVolume"},
+                {"ContainerPath": "/bitnami/moodle", "ReadOnly": False, "SourceVolume": "moodleConfigVolume"}
+            ],
+            "Environment": assertions.Match.array_with([
+                {"Name": "MOODLE_DATA_TO_PERSIST", "Value": "config.php"}
+            ])
+        })
+    ]})
+    # the local cache settings are read by config-extra.php, which is only in the prebaked image
+    web_task = template.find_resources("AWS::ECS::TaskDefinition", {"Properties": {"ContainerDefinitions": [
+        assertions.Match.object_like({"Name": "MoodleContainer"})]}})
+    (web_task,) = web_task.values()
+    assert "MOODLE_LOCALCACHEDIR" not in [variable["Name"]
+        for variable in web_task["Properties"]["ContainerDefinitions"][0]["Environment"]]
+    # workers restore config.php but can't write it
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({
+            "Name": "MoodleCronContainer",
+            "MountPoints": assertions.Match.array_with([
+                {"ContainerPath": "/bitnami/moodle", "ReadOnly": True, "SourceVolume": "moodleConfigVolume"}
+            ])
+        })
+    ]})
+
+def test_objectfs_bucket_wired_to_tasks():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(prebaked_image=True, enable_objectfs=True, objectfs_size_threshold_kib=512))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({"Environment": assertions.Match.array_with([
+            {"Name": "MOODLE_OBJECTFS_BUCKET", "Value": assertions.Match.any_value()},
+            {"Name": "MOODLE_OBJECTFS_SIZE_THRESHOLD", "Value": "524288"},
+            {"Name": "MOODLE_OBJECTFS_CACHE_DIR", "Value": "/var/moodle/objectfs"},
+            {"Name": "MOODLE_OBJECTFS_CACHE_SIZE", "Value": str(5 * 1024 ** 3)}
+        ])})
+    ]})
+    # web and cron task roles can use the bucket
+    policies = template.find_resources("AWS::IAM::Policy", {"Properties": {"PolicyDocument": {"Statement": assertions.Match.array_with([
+        assertions.Match.object_like({"Action": assertions.Match.array_with(["s3:PutObject"])})
+    ])}}})
+    assert len(policies) == 2
+
+def test_tracing_collector_sidecar():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(prebaked_image=True, enable_tracing=True, tracing_sample_rate=0.2))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {"ContainerDefinitions": [
+        assertions.Match.object_like({"Name": "MoodleContainer",
+            "DependsOn": [{"ContainerName": "OtelCollector", "Condition": "START"}],
+            "Environment": assertions.Match.array_with([
+                {"Name": "OTEL_EXPORTER_OTLP_ENDPOINT", "Value": "http://localhost:4318"},
+                {"Name": "OTEL_TRACES_SAMPLER_ARG", "Value": "0.2"}
+            ])}),
+        assertions.Match.object_like({"Name": "OtelCollector", "Essential": False, "MemoryReservation": 128,
+            "Environment": [{"Name": "AOT_CONFIG_CONTENT", "Value": assertions.Match.string_like_regexp("awsxray")}]})
+    ]})
+    template.has_resource_properties("AWS::IAM::Policy", {"PolicyDocument": {"Statement": assertions.Match.array_with([
+        assertions.Match.object_like({"Action": ["xray:PutTraceSegments", "xray:PutTelemetryRecords"], "Resource": "*"})
+    ])}})
+    # workers have no collector to send spans to
+    cron = template.find_resources("AWS::ECS::TaskDefinition", {"Properties": {"ContainerDefinitions": [
+        assertions.Match.object_like({"Name": "MoodleCronContainer"})]}})
+    (cron,) = cron.values()
+    assert not any(variable["Name"].startswith("OTEL_")
+        for variable in cron["Properties"]["ContainerDefinitions"][0]["Environment"])
+
+def test_ephemeral_storage_size_from_props():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(ephemeral_storage_gib=40))
+    template = assertions.Template.from_stack(stacks.app)
+    # web task and cron task
+    assert len(template.find_resources("AWS::ECS::TaskDefinition", {"Properties": {"EphemeralStorage": {"SizeInGiB": 40}}})) == 2
+
+def test_efs_bursting_by_default_with_alarms(templates):
+    template = templates.app
+    templates.data.has_resource_properties("AWS::EFS::FileSystem",
+        {"PerformanceMode": "generalPurpose", "ThroughputMode": "bursting"})
+    template.has_resource_properties("AWS::CloudWatch::Alarm", {"MetricName": "BurstCreditBalance", "Namespace": "AWS/EFS"})
+    template.has_resource_properties("AWS::CloudWatch::Alarm", {"MetricName": "PercentIOLimit", "Threshold": 90})
+
+def test_efs_throughput_mode_from_props():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(efs_throughput_mode="provisioned", efs_provisioned_throughput_mibps=50, efs_lifecycle_policy="AFTER_30_DAYS"))
+    template = assertions.Template.from_stack(stacks.app)
+    assertions.Template.from_stack(stacks.data).has_resource_properties("AWS::EFS::FileSystem", {
+        "ThroughputMode": "provisioned",
+        "ProvisionedThroughputInMibps": 50,
+        "LifecyclePolicies": assertions.Match.array_with([{"TransitionToIA": "AFTER_30_DAYS"}])
+    })
+    # no burst credits outside bursting mode
+    assert not template.find_resources("AWS::CloudWatch::Alarm", {"Properties": {"MetricName": "BurstCreditBalance"}})
+
+def test_vpc_endpoints_for_aws_services(templates):
+    template = templates.network
+    template.has_resource_properties("AWS::EC2::VPCEndpoint", {"VpcEndpointType": "Gateway"})
+    # ECR API, ECR docker, Secrets Manager, CloudWatch Logs
+    assert len(template.find_resources("AWS::EC2::VPCEndpoint", {"Properties": {"VpcEndpointType": "Interface"}})) == 4
+    template.has_resource_properties("AWS::EC2::VPCEndpoint", {
+        "ServiceName": "com.amazonaws.eu-west-2.secretsmanager",
+        "PrivateDnsEnabled": True
+    })
+
+def test_nat_instance_from_props():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(nat_instance_type="t3.small", nat_gateways=2, vpc_interface_endpoints=False))
+    template = assertions.Template.from_stack(stacks.network)
+    template.resource_count_is("AWS::EC2::Instance", 2)
+    template.has_resource_properties("AWS::EC2::Instance", {"InstanceType": "t3.small"})
+    template.resource_count_is("AWS::EC2::VPCEndpoint", 1)
+
+def test_graviton_task_definition():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(cpu_architecture="arm64"))
+    template = assertions.Template.from_stack(stacks.app)
+    template.all_resources_properties("AWS::ECS::TaskDefinition", {
+        "RuntimePlatform": {"CpuArchitecture": "ARM64", "OperatingSystemFamily": "LINUX"}
+    })
+
+def test_prebaked_image_built_for_task_architecture():
+    for cpu_architecture, platform in (("X86_64", "linux/amd64"), ("ARM64", "linux/arm64")):
+        app = cdk.App()
+        stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+            props=props, profile=MoodleProfile(prebaked_image=True, cpu_architecture=cpu_architecture))
+        assembly = app.synth()
+        with open(os.path.join(assembly.directory, f"{stacks.app.artifact_id}.assets.json")) as manifest:
+            images = json.load(manifest)["dockerImages"].values()
+        assert [image["source"]["platform"] for image in images] == [platform]
+        assert [image["source"]["dockerBuildArgs"] for image in images] == [{"MOODLE_IMAGE": MOODLE_IMAGE}]
+
+def test_image_inputs_pinned():
+    with open(os.path.join(os.path.dirname(__file__), "..", "..", "moodle_image", "Dockerfile")) as dockerfile:
+        dockerfile = dockerfile.read()
+    # the image built by docker compose is the one the stack deploys
+    assert f"ARG MOODLE_IMAGE={MOODLE_IMAGE}\n" in dockerfile
+    assert re.search(r":\d+\.\d+\.\d+$", MOODLE_IMAGE)
+    assert not re.search(r"^FROM \S+:(latest|\d+)\s", dockerfile, re.MULTILINE)
+    assert not re.search(r"_REF=HEAD", dockerfile)
+    requirements = re.findall(r"^\s+([a-z-]+/[\w.:-]+)(?: \\)?$", dockerfile, re.MULTILINE)
+    assert len(requirements) == 6 and all(re.search(r":\d+\.\d+\.\d+$", requirement) for requirement in requirements)
+
+def test_fargate_spot_capacity_provider_strategy():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(fargate_base=2, fargate_spot_weight=3))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ECS::ClusterCapacityProviderAssociations", {
+        "CapacityProviders": ["FARGATE", "FARGATE_SPOT"]
+    })
+    template.has_resource_properties("AWS::ECS::Service", {"CapacityProviderStrategy": [
+        {"CapacityProvider": "FARGATE", "Base": 2, "Weight": 1},
+        {"CapacityProvider": "FARGATE_SPOT", "Weight": 3}
+    ]})
 
+def test_fargate_spot_with_arm64_tasks():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(cpu_architecture="ARM64", fargate_spot_weight=2))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "RuntimePlatform": {"CpuArchitecture": "ARM64", "OperatingSystemFamily": "LINUX"}
+    })
+    template.has_resource_properties("AWS::ECS::Service", {"CapacityProviderStrategy": [
+        {"CapacityProvider": "FARGATE", "Base": 1, "Weight": 1},
+        {"CapacityProvider": "FARGATE_SPOT", "Weight": 2}
+    ]})
+
+def test_sites_with_the_same_profile_have_their_own_names():
+    app = cdk.App()
+    env = cdk.Environment(account='131458236732', region='eu-west-2')
+    sites = [moodle_stacks(app, site, env=env, props=props, profile=MoodleProfile(enable_cdn=False))
+        for site in ("MoodleSiteA", "MoodleSiteB")]
+    names = []
+    for stacks in sites:
+        template = assertions.Template.from_stack(stacks.app)
+        (dashboard,) = template.find_resources("AWS::CloudWatch::Dashboard").values()
+        (web_acl,) = template.find_resources("AWS::WAFv2::WebACL").values()
+        names.append((dashboard["Properties"]["DashboardName"], web_acl["Properties"]["Name"]))
+    assert names == [("MoodleSiteA-eu-west-2", "MoodleWAF-MoodleSiteA"), ("MoodleSiteB-eu-west-2", "MoodleWAF-MoodleSiteB")]
+
+def test_dashboard_and_alarms_notify_topic():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(alarm_email="ops@example.org"))
+    template = assertions.Template.from_stack(stacks.app)
+    template.resource_count_is("AWS::CloudWatch::Dashboard", 1)
+    template.has_resource_properties("AWS::SNS::Subscription", {"Protocol": "email", "Endpoint": "ops@example.org"})
+    template.has_resource_properties("AWS::ECS::Cluster", {"ClusterSettings": [{"Name": "containerInsights", "Value": "enabled"}]})
+    template.has_resource_properties("AWS::CloudWatch::Alarm", {
+        "Metrics": [{"MetricStat": assertions.Match.object_like({
+            "Metric": assertions.Match.object_like({"MetricName": "TargetResponseTime"}),
+            "Stat": "p95"
+        })}],
+        "Threshold": 2
+    })
+    # every alarm, including the EFS ones, notifies the topic
+    for alarm in template.find_resources("AWS::CloudWatch::Alarm").values():
+        assert len(alarm["Properties"]["AlarmActions"]) == 1
+
+def test_waf_on_cloudfront_behind_cdn(templates):
+    # rate limits count the viewer IP CloudFront sees, not the client controlled X-Forwarded-For
+    templates.edge.has_resource_properties("AWS::WAFv2::WebACL", {
+        "Scope": "CLOUDFRONT",
+        "Rules": assertions.Match.array_with([
+            assertions.Match.object_like({
+                "Name": "WafLoginRateLimit",
+                "Priority": 0,
+                "Action": {"Block": {"CustomResponse": {"ResponseCode": 429}}},
+                "Statement": {"RateBasedStatement": assertions.Match.object_like({
+                    "Limit": 100,
+                    "AggregateKeyType": "IP",
+                    "ScopeDownStatement": {"AndStatement": assertions.Match.any_value()}
+                })}
+            }),
+            assertions.Match.object_like({
+                "Name": "WafPHPRule",
+                "OverrideAction": {"Count": {}}
+            })
+        ])
+    })
+    templates.app.has_resource_properties("AWS::CloudFront::Distribution", {"DistributionConfig": assertions.Match.object_like({
+        "WebACLId": {"Fn::GetAtt": [assertions.Match.string_like_regexp("ExportsReader"), assertions.Match.any_value()]},
+        "Origins": [assertions.Match.object_like({
+            "OriginCustomHeaders": [{"HeaderName": "X-Origin-Verify", "HeaderValue": assertions.Match.any_value()}]
+        })]
+    })})
+
+def test_alb_only_accepts_requests_from_cloudfront(templates):
+    templates.app.has_resource_properties("AWS::WAFv2::WebACL", {
+        "Scope": "REGIONAL",
+        "DefaultAction": {"Block": {}},
+        "Rules": [assertions.Match.object_like({
+            "Name": "WafFromCloudFront",
+            "Action": {"Allow": {}},
+            "Statement": {"ByteMatchStatement": assertions.Match.object_like({
+                "FieldToMatch": {"SingleHeader": {"Name": "x-origin-verify"}},
+                "PositionalConstraint": "EXACTLY",
+                "SearchString": {"Fn::Join": ["", assertions.Match.array_with([
+                    assertions.Match.string_like_regexp("resolve:secretsmanager")])]}
+            })}
+        })]
+    })
+
+def test_waf_rules_from_profile():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(enable_cdn=False, waf_bot_control=True, waf_rules=(
+            {"name": "WafRateLimit", "priority": 0, "type": "rate", "limit": 500, "action": "block"},
+            {"name": "WafSQLiRule", "priority": 1, "type": "managed", "rule_group": "AWSManagedRulesSQLiRuleSet", "action": "block"})))
+    template = assertions.Template.from_stack(stacks.app)
+    template.has_resource_properties("AWS::WAFv2::WebACL", {"Rules": [
+        assertions.Match.object_like({"Name": "WafRateLimit",
+            "Statement": {"RateBasedStatement": {"Limit": 500, "AggregateKeyType": "IP"}}}),
+        assertions.Match.object_like({"Name": "WafSQLiRule", "OverrideAction": {"None": {}}}),
+        assertions.Match.object_like({"Name": "WafBotControlRule", "Priority": 20})
+    ]})
+
+def test_waf_count_only_for_load_tests():
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=MoodleProfile(waf_bot_control=True, waf_count_only=True))
+    template = assertions.Template.from_stack(stacks.edge)
+    template.has_resource_properties("AWS::WAFv2::WebACL", {"Rules": assertions.Match.array_with([
+        assertions.Match.object_like({"Name": "WafLoginRateLimit", "Action": {"Count": {}}}),
+        assertions.Match.object_like({"Name": "WafBotControlRule", "OverrideAction": {"Count": {}}})
+    ])})
+    # the origin lock still applies
+    assertions.Template.from_stack(stacks.app).has_resource_properties("AWS::WAFv2::WebACL", {"DefaultAction": {"Block": {}}})
@@ -0,0 +1,78 @@
+import aws_cdk as cdk
+import aws_cdk.assertions as assertions
+import aws_cdk.aws_ecs as ecs
+import pytest
+
+from moodle_serverless.moodle_serverless_stack import moodle_stacks
+from moodle_serverless.performance_lint import PerformanceLint
+from moodle_serverless.profiles import MoodleProfile, PROFILES, profile_from_context
+
+props = {
+    "domain_name": "commcouncil.scot",
+    "hosted_zone_id": "Z00217581OBDF54QYM4OF",
+    "hosted_zone_name": "commcouncil.scot"
+    }
+
+def linted_stacks(profile):
+    app = cdk.App()
+    stacks = moodle_stacks(app, "MoodleServerlessStackV2", env=cdk.Environment(account='131458236732', region='eu-west-2'),
+        props=props, profile=profile)
+    for stack in filter(None, stacks):
+        cdk.Aspects.of(stack).add(PerformanceLint(profile))
+    return stacks
+
+def finding(check):
+    return assertions.Match.string_like_regexp(rf"^\[{check}\]")
+
+def test_dev_profile_findings_are_warnings():
+    stacks = linted_stacks(PROFILES["dev"])
+    network, data, app, edge = (assertions.Annotations.from_stack(stack) for stack in stacks)
+    network.has_warning("*", finding("single_nat"))
+    data.has_warning("*", finding("burstable_db"))
+    data.has_warning("*", finding("bursting_efs"))
+    app.has_warning("/MoodleServerlessStackV2/moodleFargateService/TaskDef/Resource", finding("debug_env"))
+    app.has_warning("*", finding("no_cache"))
+    app.has_warning("*", finding("long_grace_period"))
+    # dev scales out to max_capacity 4
+    app.has_no_warning("*", finding("single_task"))
+    for annotations in (network, data, app, edge):
+        annotations.has_no_error("*", assertions.Match.any_value())
+
+def test_prod_profile_has_no_errors():
+    for stack in filter(None, linted_stacks(PROFILES["prod"])):
+        assertions.Annotations.from_stack(stack).has_no_error("*", assertions.Match.any_value())
+
+def test_single_task_without_autoscaling():
+    stacks = linted_stacks(MoodleProfile(max_capacity=1, scaling_schedules=()))
+    assertions.Annotations.from_stack(stacks.app).has_warning("*", finding("single_task"))
+
+def test_lint_errors_and_ignore_from_profile():
+    stacks = linted_stacks(MoodleProfile(lint_errors=("debug_env", "burstable_db"), lint_ignore=("single_nat",)))
+    assertions.Annotations.from_stack(stacks.app).has_error("*", finding("debug_env"))
+    data = assertions.Annotations.from_stack(stacks.data)
+    data.has_error("*", finding("burstable_db"))
+    data.has_warning("*", finding("bursting_efs"))
+    network = assertions.Annotations.from_stack(stacks.network)
+    network.has_no_warning("*", finding("single_nat"))
+    network.has_no_error("*", finding("single_nat"))
+
+def test_redis_counts_as_a_cache_with_the_prebaked_image():
+    stacks = linted_stacks(MoodleProfile(prebaked_image=True, enable_redis=True))
+    assertions.Annotations.from_stack(stacks.app).has_no_warning("*", finding("no_cache"))
+
+def test_redis_host_ignored_by_the_stock_image():
+    stack = cdk.Stack(cdk.App(), "MoodleServerlessStackV2")
+    task_definition = ecs.FargateTaskDefinition(stack, "TaskDef")
+    task_definition.add_container("MoodleContainer", container_name="MoodleContainer",
+        image=ecs.ContainerImage.from_registry("bitnami/moodle"), environment={"MOODLE_REDIS_HOST": "redis.example"})
+    cdk.Aspects.of(stack).add(PerformanceLint(MoodleProfile()))
+    assertions.Annotations.from_stack(stack).has_warning("*",
+        assertions.Match.string_like_regexp(r"^\[no_cache\] No Redis cache in use"))
+
+def test_unknown_lint_check_rejected():
+    with pytest.raises(ValueError, match="lint_errors"):
+        MoodleProfile(lint_errors=("slow",))
+
+def test_lint_checks_from_command_line_context():
+    profile = profile_from_context({"lint_errors": "debug_env, no_cache"})
+    assert profile.lint_errors == ("debug_env", "no_cache")
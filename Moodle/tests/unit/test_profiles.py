@@ -0,0 +1,105 @@
+import pytest
+
+from moodle_serverless.profiles import MoodleProfile, PROFILES, profile_from_context
+
+def test_default_profile_is_dev():
+    assert MoodleProfile() == PROFILES["dev"]
+
+def test_presets_are_valid():
+    for name, profile in PROFILES.items():
+        assert profile.name == name
+        profile.validate()
+
+def test_fargate_memory_must_match_cpu():
+    with pytest.raises(ValueError, match="memory_limit_mib 8192 MiB"):
+        MoodleProfile(cpu=256, memory_limit_mib=8192)
+    with pytest.raises(ValueError, match="cpu 300"):
+        MoodleProfile(cpu=300)
+
+def test_unknown_db_engine_rejected():
+    with pytest.raises(ValueError, match="db_engine"):
+        MoodleProfile(db_engine="postgres")
+
+def test_unknown_efs_throughput_mode_rejected():
+    with pytest.raises(ValueError, match="efs_throughput_mode"):
+        MoodleProfile(efs_throughput_mode="turbo")
+
+def test_slow_start_rejected_with_least_outstanding_requests():
+    with pytest.raises(ValueError, match="slow_start only works with round robin"):
+        MoodleProfile(slow_start=60, least_outstanding_requests=True)
+    assert MoodleProfile(slow_start=60, least_outstanding_requests=False).slow_start == 60
+
+def test_gp3_provisioned_iops_need_400_gib():
+    with pytest.raises(ValueError, match="db_allocated_storage of 400 GiB"):
+        MoodleProfile(db_iops=6000)
+
+def test_performance_insights_rejected_on_micro_instances():
+    with pytest.raises(ValueError, match="Performance Insights"):
+        MoodleProfile(db_performance_insights=True)
+
+def test_health_check_timeout_below_interval():
+    with pytest.raises(ValueError, match="health_check_timeout"):
+        MoodleProfile(health_check_interval=10, health_check_timeout=10)
+
+def test_waf_rule_priorities_unique():
+    with pytest.raises(ValueError, match="priorities should be unique"):
+        MoodleProfile(waf_rules=(
+            {"name": "WafRateLimit", "priority": 0, "type": "rate", "limit": 500, "action": "block"},
+            {"name": "WafPHPRule", "priority": 0, "type": "managed", "rule_group": "AWSManagedRulesPHPRuleSet", "action": "count"}))
+
+def test_objectfs_needs_prebaked_image():
+    with pytest.raises(ValueError, match="enable_objectfs"):
+        MoodleProfile(enable_objectfs=True)
+
+def test_objectfs_cache_fits_in_ephemeral_storage():
+    with pytest.raises(ValueError, match="objectfs_cache_gib"):
+        MoodleProfile(objectfs_cache_gib=15)
+    assert MoodleProfile(objectfs_cache_gib=15, ephemeral_storage_gib=40).objectfs_cache_gib == 15
+
+def test_redis_needs_prebaked_image():
+    with pytest.raises(ValueError, match="enable_redis"):
+        MoodleProfile(enable_redis=True)
+
+def test_tracing_needs_prebaked_image_and_sample_rate():
+    with pytest.raises(ValueError, match="enable_tracing"):
+        MoodleProfile(enable_tracing=True)
+    with pytest.raises(ValueError, match="tracing_sample_rate"):
+        MoodleProfile(prebaked_image=True, enable_tracing=True, tracing_sample_rate=5)
+
+def test_desired_count_within_scaling_bounds():
+    with pytest.raises(ValueError, match="desired_count"):
+        MoodleProfile(min_capacity=2, max_capacity=4)
+
+def test_profile_from_preset_name():
+    assert profile_from_context("prod") == PROFILES["prod"]
+    assert profile_from_context(None) == PROFILES["dev"]
+
+def test_profile_from_context_overrides():
+    profile = profile_from_context({"profile": "staging", "max_capacity": 12, "cpu_architecture": "arm64"})
+    assert profile.name == "staging"
+    assert profile.max_capacity == 12
+    assert profile.cpu_architecture == "ARM64"
+    assert profile.cpu == PROFILES["staging"].cpu
+
+def test_profile_from_context_rejects_unknown_names():
+    with pytest.raises(ValueError, match="Unknown profile"):
+        profile_from_context("huge")
+    with pytest.raises(ValueError, match="max_tasks"):
+        profile_from_context({"profile": "dev", "max_tasks": 10})
+
+def test_command_line_context_strings_converted():
+    profile = profile_from_context({"max_capacity": "9", "prebaked_image": "true", "enable_redis": "true", "db_max_acu": "8",
+        "ephemeral_storage_gib": "40"})
+    assert profile.max_capacity == 9
+    assert profile.enable_redis is True
+    assert profile.db_max_acu == 8.0
+    assert profile.ephemeral_storage_gib == 40
+
+def test_preset_stacks(profile_templates):
+    name, templates = profile_templates
+    profile = PROFILES[name]
+    templates.app.has_resource_properties("AWS::ECS::TaskDefinition", {"Cpu": str(profile.cpu), "Memory": str(profile.memory_limit_mib)})
+    templates.app.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget",
+        {"MinCapacity": profile.min_capacity, "MaxCapacity": profile.max_capacity})
+    templates.data.resource_count_is("AWS::RDS::DBCluster", 1 if profile.db_engine == "aurora-serverless" else 0)
+    templates.data.resource_count_is("AWS::ElastiCache::ReplicationGroup", 1 if profile.enable_redis else 0)
@@ -0,0 +1,42 @@
+import difflib
+import json
+import os
+import re
+
+import pytest
+
+from moodle_serverless.moodle_serverless_stack import MoodleStacks
+
+## Golden templates of every stack for each preset profile, in snapshots/<profile>/<stack>.json.
+## Any change to a synthesized template fails here with a diff, check the change is the one you
+## meant and write the new snapshots with
+##   UPDATE_SNAPSHOTS=1 python -m pytest tests/unit/test_snapshots.py
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), "snapshots")
+
+## Asset hashes change with the CDK version and the moodle_image/ files, not with the stack code
+ASSET_HASH = re.compile(r"[0-9a-f]{64}")
+
+def normalize(template):
+    """ Sorted, indented JSON with the asset hashes masked, so diffs are stable and readable """
+    return ASSET_HASH.sub("<asset-hash>", json.dumps(template, indent=2, sort_keys=True)) + "\n"
+
+@pytest.mark.parametrize("stack", MoodleStacks._fields)
+def test_template_matches_snapshot(profile_templates, stack):
+    name, templates = profile_templates
+    if getattr(templates, stack) is None:
+        pytest.skip(f"No {stack} stack in the {name} profile")
+    actual = normalize(getattr(templates, stack).to_json())
+    path = os.path.join(SNAPSHOT_DIR, name, f"{stack}.json")
+    if os.getenv("UPDATE_SNAPSHOTS"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as snapshot:
+            snapshot.write(actual)
+    if not os.path.exists(path):
+        pytest.fail(f"No snapshot {path}, write it with UPDATE_SNAPSHOTS=1")
+    with open(path) as snapshot:
+        expected = snapshot.read()
+    diff = "".join(difflib.unified_diff(expected.splitlines(True), actual.splitlines(True),
+        fromfile=f"snapshots/{name}/{stack}.json", tofile=f"{name} {stack} stack"))
+    if diff:
+        pytest.fail(f"The {name} {stack} template has changed, UPDATE_SNAPSHOTS=1 to accept it:\n{diff}", pytrace=False)